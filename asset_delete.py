@@ -8,13 +8,20 @@ from pathlib import Path
 import traceback
 from siprawn import util
 from siprawn import env
+from siprawn import wiki
 
 
 
-def run(chipid=None, vendor=None, user=None, dry=True):
+def run(chipid=None, vendor=None, user=None, dry=True, link_index_fn=wiki.LINK_INDEX_FN):
     env.setup_env_default()
 
     page_fn = env.WWW_DIR + f"/archive/data/pages/{user}/{vendor}/{chipid}.txt"
+    # Other pages that will have broken links
+    backlinks = wiki.BacklinkIndex(wiki.LinkIndex(link_index_fn)).update()
+    backlinks.save()
+    for linking_fn in backlinks.chip_pages(vendor, chipid):
+        if linking_fn != page_fn:
+            print(f"WARNING: linked from {linking_fn}")
     print(f"rm -f {page_fn}")
     print("  Exists: ", os.path.exists(page_fn))
     if os.path.exists(page_fn) and not dry:
@@ -56,8 +63,11 @@ def main():
     parser.add_argument("--vendor", required=True)
     parser.add_argument("--chipid", required=True)
     parser.add_argument("--user", required=True)
+    parser.add_argument("--link-index",
+                        default=wiki.LINK_INDEX_FN,
+                        help="Cache of links found on each page")
     args = parser.parse_args()
-    run(vendor=args.vendor, chipid=args.chipid, user=args.user, dry=args.dry)
+    run(vendor=args.vendor, chipid=args.chipid, user=args.user, dry=args.dry, link_index_fn=args.link_index)
 
 
 if __name__ == "__main__":
@@ -8,7 +8,8 @@ from pathlib import Path
 import traceback
 from siprawn import util
 from siprawn import env
-import subprocess
+from siprawn import wiki
+from siprawn import rewrite
 
 def parse_vendor_chipid(vendor_chipid):
     vendor, chipid = vendor_chipid.split("_")
@@ -16,20 +17,33 @@ def parse_vendor_chipid(vendor_chipid):
     util.validate_chipid(chipid)
     return vendor, chipid
 
-def diff_strings(s1, s2):
-    fn1 = "/tmp/si_left.txt"
-    fn2 = "/tmp/si_right.txt"
-    with open(fn1, "w") as f:
-        f.write(s1)
-    with open(fn2, "w") as f:
-        f.write(s2)
-
-    print("")
-    print("****************************************")
-    print("diff")
-    subprocess.run(["diff", "-w", fn1, fn2], check=False, stderr=subprocess.PIPE)
-    print("****************************************")
-    print("")
+def rename_mapping(old_vendor, old_chipid, new_vendor, new_chipid, own_page=False):
+    """
+    Page text rewrites for a chip rename, see siprawn.rewrite
+    own_page: the chip's own page, which also has its media + vendor tag
+    """
+    mapping = {
+        # Page reference
+        # [[https://siliconprawn.org/map/efabless/gf-mpw18h1-slot4-openfasoc/mcmaster_mit20x/|mit20x]]
+        f"/{old_vendor}/{old_chipid}/": f"/{new_vendor}/{new_chipid}/",
+        # * [[https://siliconprawn.org/map/efabless/gf-mpw18h1-slot4-openfasoc/single/efabless_gf-mpw18h1-slot4-openfasoc_mcmaster_mit20x.jpg|Single]] (22444x17485, 41.3425MiB)
+        f"/{old_vendor}_{old_chipid}_": f"/{new_vendor}_{new_chipid}_",
+    }
+    if own_page:
+        # Image reference
+        # {{:mcmaster:efabless:gf-mpw18h1-slot4-openfasoc:pack_top.jpg?300|}}
+        mapping[f":{old_vendor}:{old_chipid}:"] = f":{new_vendor}:{new_chipid}:"
+        # vendor_efabless => vendor_tiny-tapeout
+        mapping[f"vendor_{old_vendor}"] = f"vendor_{new_vendor}"
+    return mapping
+
+def rename_rewriter(old_vendor, old_chipid, new_vendor, new_chipid):
+    """
+    Rewriter for the chip's own page
+    The vendor tag is a whole name: vendor_foo isn't part of vendor_foobar
+    """
+    return rewrite.Rewriter(rename_mapping(old_vendor, old_chipid, new_vendor, new_chipid, own_page=True),
+                            whole=[f"vendor_{old_vendor}"])
 
 def rename_page(old_vcu, new_vcu, dry):
     """
@@ -52,25 +66,15 @@ def rename_page(old_vcu, new_vcu, dry):
         print(f"  Page: found {user}:{old_vendor}:{old_chipid}")
         with open(old_page_fn, "r") as f:
             page_txt = f.read()
-        # Image reference
-        # {{:mcmaster:efabless:gf-mpw18h1-slot4-openfasoc:pack_top.jpg?300|}}
-        page_txt = page_txt.replace("{old_vendor}:{old_chipid}", "{new_vendor}:{new_chipid}")
-        page_txt_new = page_txt
-        # Page reference
-        # [[https://siliconprawn.org/map/efabless/gf-mpw18h1-slot4-openfasoc/mcmaster_mit20x/|mit20x]]
-        # * [[https://siliconprawn.org/map/efabless/gf-mpw18h1-slot4-openfasoc/single/efabless_gf-mpw18h1-slot4-openfasoc_mcmaster_mit20x.jpg|Single]] (22444x17485, 41.3425MiB)
-        page_txt_new = page_txt_new.replace(f"/{old_vendor}/{old_chipid}/", f"/{new_vendor}/{new_chipid}/")
-        page_txt_new = page_txt_new.replace(f"/{old_vendor}_{old_chipid}_", f"/{new_vendor}_{new_chipid}_")
-        # vendor_efabless => vendor_tiny-tapeout
-        page_txt_new = page_txt_new.replace(f"vendor_{old_vendor}", f"vendor_{new_vendor}")
+        rewriter = rename_rewriter(old_vendor, old_chipid, new_vendor, new_chipid)
+        page_txt_new, _counts = rewriter.apply(page_txt)
         if page_txt_new == page_txt:
             print(page_txt_new)
         else:
-            diff_strings(page_txt, page_txt_new)
+            print(rewrite.unified_diff(page_txt, page_txt_new, old_page_fn))
         print("  Write new txt")
         if not dry:
-            with open(old_page_fn, "w") as f:
-                f.write(page_txt_new)
+            rewrite.write_page(old_page_fn, page_txt_new)
         # FIXME: sudo -u www-data mkdir /var/www/archive/data/pages/infosecdj/tiny-tapeout/
         print(f"  mv {old_page_fn} {new_page_fn}")
         if not dry:
@@ -87,7 +91,16 @@ def rename_page(old_vcu, new_vcu, dry):
             shutil.move(old_data_dir, new_data_dir)
 
 
-def run(old_vendor_chipid, new_vendor_chipid, dry=True):
+def rename_backlinks(page_fns, old_vc, new_vc, dry):
+    """
+    Fix links from pages other than the chip's own pages
+    """
+    print("Linking pages: %u" % len(page_fns))
+    npages, nreplacements = rewrite.rewrite_pages(page_fns, rename_mapping(*old_vc, *new_vc), dry=dry)
+    print("Linking pages changed: %u, %u replacements" % (npages, nreplacements))
+
+
+def run(old_vendor_chipid, new_vendor_chipid, dry=True, link_index_fn=wiki.LINK_INDEX_FN):
     env.setup_env_default()
 
     assert old_vendor_chipid != new_vendor_chipid, old_vendor_chipid
@@ -100,6 +113,10 @@ def run(old_vendor_chipid, new_vendor_chipid, dry=True):
     print("Checking " + glob_str)
     old_page_fns = glob.glob(glob_str)
     print("Found %u pages" % len(old_page_fns))
+    # Find these before anything moves
+    backlinks = wiki.BacklinkIndex(wiki.LinkIndex(link_index_fn)).update()
+    backlink_fns = [fn for fn in backlinks.chip_pages(old_vendor, old_chipid) if fn not in old_page_fns]
+    backlinks.save()
     for old_page_fn in old_page_fns:
         old_user = old_page_fn.split("/")[-3]
         print(f"  page user {old_user}")
@@ -144,6 +161,7 @@ def run(old_vendor_chipid, new_vendor_chipid, dry=True):
 
     rename_single_images()
     move_map_files()
+    rename_backlinks(backlink_fns, (old_vendor, old_chipid), (new_vendor, new_chipid), dry=dry)
 
 
 def main():
@@ -152,10 +170,13 @@ def main():
     parser = argparse.ArgumentParser(
         description="Rename a vendor + chipid, updating map files + wiki pages (best effort)")
     util.add_bool_arg(parser, "--dry", default=True)
+    parser.add_argument("--link-index",
+                        default=wiki.LINK_INDEX_FN,
+                        help="Cache of links found on each page")
     parser.add_argument("old_vendor_chipid")
     parser.add_argument("new_vendor_chipid")
     args = parser.parse_args()
-    run(old_vendor_chipid=args.old_vendor_chipid, new_vendor_chipid=args.new_vendor_chipid, dry=args.dry)
+    run(old_vendor_chipid=args.old_vendor_chipid, new_vendor_chipid=args.new_vendor_chipid, dry=args.dry, link_index_fn=args.link_index)
 
 
 if __name__ == "__main__":
@@ -10,25 +10,29 @@ import json
 import datetime
 from siprawn import metadata
 from siprawn import env
+from siprawn import walk
+from siprawn import viewer
+import functools
 
 
 class CustomPage(Exception):
     pass
 
 
-def html2meta(txt):
-    # auto generated
-    # Make some assumptions how its formatted
-    # initViewer({"tilesAlignedTopLeft": true, "scale": null, ... , "name_raw": "???"});
-    for l in txt.split("\n"):
-        if l.find("initViewer") < 0:
-            continue
-        js = l.strip().replace("initViewer(", "").replace(");", "")
-        return json.loads(js)
+def html2meta(fn, index=None):
+    """
+    index: viewer.ViewerIndex to reuse previous parses
+    """
+    try:
+        if index:
+            return index.get(fn)
+        return viewer.read_viewer_meta(fn)
+    except viewer.ViewerNotFound:
+        pass
     # A special custom page
     # /var/www/map/mos/6581r3/vec-a/index.html
     # print a warning and move on
-    if "SiProjection" in txt:
+    if "SiProjection" in open(fn).read():
         raise CustomPage()
 
     raise ValueError("unexpected page")
@@ -87,10 +91,10 @@ def guess_collection(person_cc, copyright_db):
     return None
 
 
-def run_page(fn, meta, copyright_db):
+def run_page(fn, meta, copyright_db, index=None):
     custom = False
     try:
-        pagej = html2meta(open(fn).read())
+        pagej = html2meta(fn, index=index)
     except CustomPage:
         print("  WARNING: custom page")
         pagej = None
@@ -152,7 +156,57 @@ def run_page(fn, meta, copyright_db):
         metaj["custom_map"] = True
 
 
-def run(fndir=None, fn_out=None, ignore_errors=False):
+def topage(fn):
+    pos = fn.find("www/map")
+    fn = fn[pos + len("www/map"):]
+    return "https://siliconprawn.org/map" + fn
+
+
+# Set per worker by load_viewer_index()
+g_viewer_index = None
+
+
+def load_viewer_index(fn):
+    global g_viewer_index
+
+    g_viewer_index = viewer.ViewerIndex(fn)
+
+
+def run_chip(records, copyright_db, ignore_errors=False):
+    """
+    Return (meta for this chip, pages, errors, new viewer index entries)
+    """
+    meta = {}
+    errors = 0
+    npages = 0
+    for record in records:
+        if record.type != walk.MAP_DIR:
+            continue
+        html_page = os.path.join(record.path, "index.html")
+        print("Page:", html_page)
+        print("  %s" % topage(html_page))
+        try:
+            npages += 1
+            run_page(html_page,
+                     meta,
+                     copyright_db=copyright_db,
+                     index=g_viewer_index)
+        except Exception as e:
+            errors += 1
+            if ignore_errors:
+                traceback.print_exc()
+            else:
+                raise
+    return meta, npages, errors, g_viewer_index.take_new()
+
+
+def run(fndir=None,
+        fn_out=None,
+        ignore_errors=False,
+        vendor=None,
+        chipid=None,
+        jobs=1,
+        viewer_index_fn=viewer.VIEWER_INDEX_FN):
     """
     Search /wiki and try to guess linked images based on collection
     """
@@ -168,33 +222,34 @@ def run(fndir=None, fn_out=None, ignore_errors=False):
         assert "www/map" in fndir
         assert os.path.basename(fndir) == "map"
 
-        def topage(fn):
-            pos = fndir.find("www/map")
-            fn = fn[pos + len("www/map"):]
-            return "https://siliconprawn.org/map/" + fn
-
         errors = 0
         npages = 0
-        for vendor_dir in glob.glob("%s/*" % fndir):
-            # print(vendor_dir)
-            for chipid_dir in glob.glob("%s/*" % vendor_dir):
-                # print(chipid_dir)
-                for html_page in glob.glob("%s/*/index.html" % chipid_dir):
-                    print("Page:", html_page)
-                    print("  %s" % topage(html_page))
-                    try:
-                        npages += 1
-                        run_page(html_page, meta, copyright_db=copyright_db)
-                    except Exception as e:
-                        errors += 1
-                        if ignore_errors:
-                            traceback.print_exc()
-                        else:
-                            raise
-        js = json.dumps(meta, sort_keys=True, indent=4, separators=(',', ': '))
+        index = viewer.ViewerIndex(viewer_index_fn)
+        try:
+            chips = walk.map_chips(functools.partial(
+                run_chip,
+                copyright_db=copyright_db,
+                ignore_errors=ignore_errors),
+                                   map_dir=fndir,
+                                   vendor=vendor,
+                                   chipid=chipid,
+                                   jobs=jobs,
+                                   initializer=load_viewer_index,
+                                   initargs=(viewer_index_fn, ))
+            for chip_meta, chip_pages, chip_errors, chip_index in chips:
+                npages += chip_pages
+                errors += chip_errors
+                metadata.merge_meta(meta, chip_meta)
+                index.merge(chip_index)
+        finally:
+            index.save()
         if fn_out:
-            open(fn_out, "w").write(js)
+            metadata.write_meta(meta, fn_out)
         else:
+            js = json.dumps(meta,
+                            sort_keys=True,
+                            indent=4,
+                            separators=(',', ': '))
             print("")
             print("")
             print("")
@@ -213,9 +268,19 @@ def main():
         description="Rewrite a page to point to new URL scheme")
     parser.add_argument("--ignore-errors", action="store_true")
     parser.add_argument("--fndir")
-    parser.add_argument("fn_out", nargs="?")
+    parser.add_argument("fn_out",
+                        nargs="?",
+                        help="DB to write (.json, .ndjson, .db)")
+    parser.add_argument("--viewer-index",
+                        default=viewer.VIEWER_INDEX_FN,
+                        help="Cache of parsed index.html metadata")
+    walk.add_walk_args(parser)
     args = parser.parse_args()
-    run(args.fndir, fn_out=args.fn_out, ignore_errors=args.ignore_errors)
+    run(args.fndir,
+        fn_out=args.fn_out,
+        ignore_errors=args.ignore_errors,
+        viewer_index_fn=args.viewer_index,
+        **walk.walk_kwargs(args))
 
 
 if __name__ == "__main__":
@@ -9,9 +9,11 @@ import re
 import json
 from siprawn import metadata
 from siprawn import env
+from siprawn import wiki
+import functools
 
 
-def run_page(fn, meta):
+def run_page(fn, meta, index=None):
     """
     Assume that links on page are correctly attributed
     This is important as they are already canonical
@@ -24,19 +26,13 @@ def run_page(fn, meta):
 
     collection, page_vendor, page_chipid = auser_page.parse_page_fn_uvc(fn)
 
+    if index is None:
+        index = wiki.LinkIndex(None)
     has_url = False
-    txt = open(fn, "r").read()
-    ignore_errors = False
-    if "{{tag>auser_ignore_errors}}" in txt:
-        ignore_errors = True
-    for url in re.findall(r'(https?://[^\s]+)', txt):
+    ignore_errors = "auser_ignore_errors" in index.tags(fn)
+    for url in index.links(fn):
         has_url = True
-        # [[https://siliconprawn.org/map/intel/80502/mz_mit5x/|MZ @ mit5x]]
-        # https://siliconprawn.org/map/intel/80502/mz_mit5x/|MZ
         print("  url", url)
-        ppos = url.find("|")
-        if ppos >= 0:
-            url = url[0:ppos]
 
         if "siliconprawn.org/map" not in url:
             print("    Skip: not a /map URL")
@@ -85,7 +81,48 @@ def run_page(fn, meta):
         print("  SKIP: no URLs")
 
 
-def run(fndir, fn_out=None, ignore_errors=False):
+def topage(fn):
+    pos = fn.find("data/pages")
+    fn = fn[pos + len("data/pages"):]
+    fn = fn.replace(".txt", "")
+    return "https://siliconprawn.org/archive/doku.php?id=" + fn.replace(
+        "/", ":")
+
+
+# Set per worker by load_link_index()
+g_link_index = None
+
+
+def load_link_index(fn):
+    global g_link_index
+
+    g_link_index = wiki.LinkIndex(fn)
+
+
+def run_one(path, ignore_errors=False):
+    """
+    Return (meta for this page, errors, new link index entries)
+    """
+    meta = {}
+    errors = 0
+    print("Page:", path)
+    print("  %s" % topage(path))
+    try:
+        run_page(path, meta, index=g_link_index)
+    except Exception as e:
+        errors += 1
+        if ignore_errors:
+            traceback.print_exc()
+        else:
+            raise
+    return meta, errors, g_link_index.take_new()
+
+
+def run(fndir,
+        fn_out=None,
+        ignore_errors=False,
+        jobs=1,
+        link_index_fn=wiki.LINK_INDEX_FN):
     """
     Search /wiki and try to guess linked images based on collection
     """
@@ -100,43 +137,30 @@ def run(fndir, fn_out=None, ignore_errors=False):
         assert "data/pages" in fndir
         assert os.path.basename(fndir) == "pages"
 
-        def topage(fn):
-            pos = fndir.find("data/pages")
-            fn = fn[pos + len("data/pages"):]
-            fn = fn.replace(".txt", "")
-            return "https://siliconprawn.org/archive/doku.php?id=" + fn.replace(
-                "/", ":")
-
         errors = 0
-        nusers = 0
+        nusers = len(list(wiki.collection_user_dirs(fndir)))
         npages = 0
-        for user_dir in glob.glob("%s/*" % fndir):
-            start_page = os.path.join(user_dir, "start.txt")
-            if not os.path.exists(start_page):
-                continue
-            start_txt = open(start_page, "r").read()
-            # Must be a user page
-            if "{{tag>collection}}" not in start_txt:
-                continue
-            nusers += 1
-            # Now recurse and find all vendor/chipid pages
-            for path in Path(user_dir).rglob('*.txt'):
-                path = str(path)
-                print("Page:", path)
-                print("  %s" % topage(path))
-                try:
-                    npages += 1
-                    run_page(path, meta)
-                except Exception as e:
-                    errors += 1
-                    if ignore_errors:
-                        traceback.print_exc()
-                    else:
-                        raise
-        js = json.dumps(meta, sort_keys=True, indent=4, separators=(',', ': '))
+        index = wiki.LinkIndex(link_index_fn)
+        try:
+            for page_meta, page_errors, page_index in wiki.map_pages(
+                    functools.partial(run_one, ignore_errors=ignore_errors),
+                    wiki.collection_pages(fndir),
+                    jobs=jobs,
+                    initializer=load_link_index,
+                    initargs=(link_index_fn, )):
+                npages += 1
+                errors += page_errors
+                metadata.merge_meta(meta, page_meta)
+                index.merge(page_index)
+        finally:
+            index.save()
         if fn_out:
-            open(fn_out, "w").write(js)
+            metadata.write_meta(meta, fn_out)
         else:
+            js = json.dumps(meta,
+                            sort_keys=True,
+                            indent=4,
+                            separators=(',', ': '))
             print("")
             print("")
             print("")
@@ -156,9 +180,22 @@ def main():
         description="Rewrite a page to point to new URL scheme")
     parser.add_argument("--ignore-errors", action="store_true")
     parser.add_argument("--fndir")
-    parser.add_argument("fn_out", nargs="?")
+    parser.add_argument("fn_out",
+                        nargs="?",
+                        help="DB to write (.json, .ndjson, .db)")
+    parser.add_argument("--jobs",
+                        type=int,
+                        default=1,
+                        help="Pages to process in parallel")
+    parser.add_argument("--link-index",
+                        default=wiki.LINK_INDEX_FN,
+                        help="Cache of links found on each page")
     args = parser.parse_args()
-    run(args.fndir, fn_out=args.fn_out, ignore_errors=args.ignore_errors)
+    run(args.fndir,
+        fn_out=args.fn_out,
+        ignore_errors=args.ignore_errors,
+        jobs=args.jobs,
+        link_index_fn=args.link_index)
 
 
 if __name__ == "__main__":
@@ -4,16 +4,16 @@ Seed new scheme by marking all assets with an unknown collection
 Also create baseline metadata noting file types
 """
 
-import shutil
 import re
 import os
 import glob
 from pathlib import Path
 import traceback
 from siprawn import util
-from siprawn import simap
 import glob
 from siprawn import env
+from siprawn import walk
+from siprawn import plan
 
 
 def single_fn_add_user(fn, collection):
@@ -33,71 +33,76 @@ Maybe some sort of consistency checker after
 """
 
 
-def run(mapdir, dry=False, ignore_errors=False):
+def run_chip(records):
+    """
+    Return plan.ChipPlan for this chip dir
+    """
+    chip = records[0]
+    print("Check", chip.chipid)
+    chip_plan = plan.ChipPlan(chip.vendor, chip.chipid, chip.chip_dir)
+    new_collection = "unknown"
+    if any(record.type == walk.MANIFEST for record in records):
+        print("  skip: eixsting manifest")
+        return chip_plan
+    """
+    chipid/single high resolution photos
+    """
+    for record in records:
+        if record.type != walk.SINGLE_IMAGE:
+            continue
+        base_fn = record.name
+        print(f"  check {base_fn}")
+        if ".thumb" in base_fn:
+            print("    Skip .thumb")
+            continue
+        fn_orig = record.path
+        if not ".jpg" in fn_orig and not ".tif" in fn_orig and not ".png" in fn_orig and not ".xcf" in fn_orig:
+            raise ValueError("Unexpected fn %s" % fn_orig)
+        base_fn_new = single_fn_add_user(base_fn, collection=new_collection)
+        reg_fn = os.path.join("single", base_fn_new)
+        chip_plan.move(os.path.join("single", base_fn), reg_fn)
+        chip_plan.manifest_add(reg_fn,
+                               collection=new_collection,
+                               type_="image")
+    """
+    Map file
+    """
+    for record in records:
+        if record.type != walk.MAP_DIR:
+            continue
+        print(f"  check {record.path}/index.html")
+        orig_map_dir = record.name
+        new_map_dir = new_collection + "_" + orig_map_dir
+        chip_plan.move(orig_map_dir, new_map_dir)
+        chip_plan.manifest_add(new_map_dir,
+                               collection=new_collection,
+                               type_="map")
+    return chip_plan
+
+
+def run(mapdir,
+        dry=False,
+        ignore_errors=False,
+        vendor=None,
+        chipid=None,
+        jobs=1,
+        plan_fn=None):
     env.setup_env_default()
 
     mapdir = env.MAP_DIR
-    new_collection = "unknown"
     assert "www/map" in mapdir
     assert os.path.basename(mapdir) == "map"
-    for vendor_dir in sorted(os.listdir(mapdir)):
-        vendor_dir = os.path.join(mapdir, vendor_dir)
-        if not os.path.isdir(vendor_dir):
-            print("Skip special", vendor_dir)
-            continue
-        for chipid_dir in sorted(os.listdir(vendor_dir)):
-            print("Check", chipid_dir)
-            chipid_dir = os.path.join(vendor_dir, chipid_dir)
-            mfn = chipid_dir + "/.manifest"
-            if os.path.exists(mfn):
-                print("  skip: eixsting manifest")
-                continue
-            """
-            chipid/single high resolution photos
-            """
-            single_dir = os.path.join(chipid_dir, "single")
-            if os.path.exists(single_dir):
-                for base_fn in sorted(os.listdir(single_dir)):
-                    print(f"  check {base_fn}")
-                    if ".thumb" in base_fn:
-                        print("    Skip .thumb")
-                        continue
-                    fn_orig = os.path.join(single_dir, base_fn)
-                    if not os.path.isfile(fn_orig):
-                        print("    Skip dir")
-                        continue
-                    if not ".jpg" in fn_orig and not ".tif" in fn_orig and not ".png" in fn_orig and not ".xcf" in fn_orig:
-                        raise ValueError("Unexpected fn %s" % fn_orig)
-                    base_fn_new = single_fn_add_user(base_fn,
-                                                     collection=new_collection)
-                    print(f"    {base_fn} => {base_fn_new}")
-                    fn_new = os.path.join(single_dir, base_fn_new)
-                    reg_fn = os.path.join("single", base_fn_new)
-                    print(f"    manfesting image: {reg_fn}")
-                    print(f"    mv {fn_orig} => {fn_new}")
-                    if not dry:
-                        shutil.move(fn_orig, fn_new)
-                        simap.map_manifest_add_file(chipid_dir,
-                                                    reg_fn,
-                                                    collection=new_collection,
-                                                    type_="image")
-            """
-            Map file
-            """
-            for index_fn in sorted(glob.glob(chipid_dir + "/*/index.html")):
-                print(f"  check {index_fn}")
-                orig_map_dir = os.path.basename(os.path.dirname(index_fn))
-                new_map_dir = new_collection + "_" + orig_map_dir
-                fn_orig = os.path.join(chipid_dir, orig_map_dir)
-                fn_new = os.path.join(chipid_dir, new_map_dir)
-                print(f"    manfesting map: {new_map_dir}")
-                print(f"    mv {fn_orig} => {fn_new}")
-                if not dry:
-                    shutil.move(fn_orig, fn_new)
-                    simap.map_manifest_add_file(chipid_dir,
-                                                new_map_dir,
-                                                collection=new_collection,
-                                                type_="map")
+    chips = list(
+        walk.map_chips(run_chip,
+                       map_dir=mapdir,
+                       vendor=vendor,
+                       chipid=chipid,
+                       jobs=jobs))
+    plan.save_apply(chips,
+                    "auser_map2unk",
+                    plan_fn=plan_fn,
+                    dry=dry,
+                    jobs=jobs)
 
 
 def main():
@@ -108,8 +113,16 @@ def main():
     util.add_bool_arg(parser, "--dry", default=True)
     parser.add_argument("--ignore-errors", action="store_true")
     parser.add_argument("--fndir")
+    walk.add_walk_args(parser)
+    plan.add_plan_args(parser)
     args = parser.parse_args()
-    run(args.fndir, dry=args.dry, ignore_errors=args.ignore_errors)
+    if plan.run_plan_args(args, jobs=args.jobs):
+        return
+    run(args.fndir,
+        dry=args.dry,
+        ignore_errors=args.ignore_errors,
+        plan_fn=args.plan,
+        **walk.walk_kwargs(args))
 
 
 if __name__ == "__main__":
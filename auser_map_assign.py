@@ -3,14 +3,15 @@
 Use copyright databases to rename files in /map
 """
 
-import shutil
 import re
 import os
 import glob
 from pathlib import Path
 import traceback
 from siprawn import util
-from siprawn import simap
+from siprawn import metadata
+from siprawn import walk
+from siprawn import plan
 import glob
 import json
 from siprawn import env
@@ -19,6 +20,9 @@ import datetime
 
 def match_db_entry(db, vendor, chipid, basename, type_):
     """
+    db: metadata.MetaIndex
+    Source DB entries look like:
+
     "ad633jnz-fake": [
         {
             "basename": "mz_mit20x",
@@ -49,20 +53,7 @@ def match_db_entry(db, vendor, chipid, basename, type_):
             "vendor": "ad"
         }
     """
-    vendorj = db.get(vendor, {})
-    ret = []
-    for entryj in vendorj.get(chipid, []):
-        if entryj.get("type") != type_:
-            continue
-        if basename == entryj.get("basename"):
-            ret.append(entryj)
-    if len(ret) == 0:
-        return None
-    elif len(ret) == 1:
-        return ret[0]
-    else:
-        print(ret)
-        raise Exception("too many matches")
+    return db.get(vendor, chipid, type_, basename)
 
 
 def collection_assign_map(url, archive_db=None, map_db=None):
@@ -165,115 +156,128 @@ def map_fn_rename_collection(fn, collection):
     return collection + "_" + flavor
 
 
-def run(archive_db=None, map_db=None, dry=False, ignore_errors=False):
-    archive_db = json.load(open(archive_db))
-    map_db = json.load(open(map_db))
+# Set per worker by load_dbs()
+g_archive_db = None
+g_map_db = None
+
+
+def load_dbs(archive_db_fn, map_db_fn):
+    global g_archive_db
+    global g_map_db
+
+    g_archive_db = metadata.load_meta_index(archive_db_fn)
+    g_map_db = metadata.load_meta_index(map_db_fn)
+
+
+def run_chip(records):
+    """
+    Return plan.ChipPlan for this chip dir
+    """
+    archive_db = g_archive_db
+    map_db = g_map_db
+    chip = records[0]
+    chipid_dir = chip.chip_dir
+    chip_plan = plan.ChipPlan(chip.vendor, chip.chipid, chipid_dir)
+    print("")
+    print("Check", chipid_dir)
+
+    for record in records:
+        if record.type != walk.SINGLE_IMAGE:
+            continue
+        base_fn = record.name
+        print(f"Found single/{base_fn}")
+        fn_orig = record.path
+        reg_fn_orig = os.path.join("single", base_fn)
+        if ".thumb" in base_fn:
+            # Instead of fixing thumbnails, just regenerate them
+            chip_plan.remove(reg_fn_orig)
+        else:
+            if not ".jpg" in fn_orig and not ".tif" in fn_orig and not ".png" in fn_orig and not ".xcf" in fn_orig:
+                raise ValueError("Unexpected fn %s" % fn_orig)
+            new_meta = collection_assign_single(base_fn,
+                                                archive_db=archive_db,
+                                                map_db=map_db)
+            if not new_meta:
+                print("  Completely failed to assign :(")
+            else:
+                if "copyright_year" not in new_meta:
+                    file_year = datetime.datetime.fromtimestamp(
+                        os.path.getctime(fn_orig)).year
+                    new_meta["copyright_year"] = file_year
+                    print(f"  Detect file year {file_year}")
+                new_collection = new_meta.get("collection")
+                if not new_collection:
+                    print("  Matched w/o collection :(")
+                    manifest_fn = reg_fn_orig
+                else:
+                    print(f"  Matched collection {new_collection}")
+                    base_fn_new = single_fn_rename_collection(
+                        base_fn, collection=new_collection)
+                    manifest_fn = os.path.join("single", base_fn_new)
+                    chip_plan.move(reg_fn_orig, manifest_fn)
+
+                chip_plan.manifest_add(
+                    manifest_fn,
+                    collection=new_meta.get("collection"),
+                    copyright_year=new_meta["copyright_year"],
+                    type_="image")
+    """
+    Map file
+    """
+    for record in records:
+        if record.type != walk.MAP_DIR:
+            continue
+        index_fn = os.path.join(record.path, "index.html")
+        print(f"Found {index_fn}")
+        orig_map_dir = record.name
+        new_meta = collection_assign_map(index_fn,
+                                         archive_db=archive_db,
+                                         map_db=map_db)
+        if not new_meta:
+            print("  Completely failed to assign :(")
+        else:
+            new_collection = new_meta.get("collection")
+            if not new_collection:
+                print("  Matched w/o collection :(")
+                manifest_fn = orig_map_dir
+            else:
+                print(f"  Matched collection {new_collection}")
+                manifest_fn = map_fn_rename_collection(
+                    orig_map_dir, collection=new_collection)
+                chip_plan.move(orig_map_dir, manifest_fn)
+            chip_plan.manifest_add(manifest_fn,
+                                   collection=new_meta.get("collection"),
+                                   copyright_year=new_meta["copyright_year"],
+                                   type_="map")
+    return chip_plan
+
+
+def run(archive_db=None,
+        map_db=None,
+        dry=False,
+        ignore_errors=False,
+        vendor=None,
+        chipid=None,
+        jobs=1,
+        plan_fn=None):
     env.setup_env_default()
 
     mapdir = env.MAP_DIR
-    new_collection = "unknown"
     assert "www/map" in mapdir
     assert os.path.basename(mapdir) == "map"
-    for vendor_dir in sorted(os.listdir(mapdir)):
-        vendor_dir = os.path.join(mapdir, vendor_dir)
-        if not os.path.isdir(vendor_dir):
-            print("skip non-dir", vendor_dir)
-            continue
-        for chipid_dir in sorted(os.listdir(vendor_dir)):
-            print("")
-            chipid_dir = os.path.join(vendor_dir, chipid_dir)
-            print("Check", chipid_dir)
-
-            single_dir = os.path.join(chipid_dir, "single")
-            if os.path.exists(single_dir):
-                for base_fn in sorted(os.listdir(single_dir)):
-                    print(f"Found single/{base_fn}")
-                    fn_orig = os.path.join(single_dir, base_fn)
-                    if not os.path.isfile(fn_orig):
-                        print("  skip non-file")
-                        continue
-                    if ".thumb" in base_fn:
-                        # Instead of fixing thumbnails, just regenerate them
-                        print(f"  rm {fn_orig}")
-                        if not dry:
-                            os.unlink(fn_orig)
-                    else:
-                        if not ".jpg" in fn_orig and not ".tif" in fn_orig and not ".png" in fn_orig and not ".xcf" in fn_orig:
-                            raise ValueError("Unexpected fn %s" % fn_orig)
-                        new_meta = collection_assign_single(
-                            base_fn, archive_db=archive_db, map_db=map_db)
-                        if not new_meta:
-                            print("  Completely failed to assign :(")
-                        else:
-                            if "copyright_year" not in new_meta:
-                                file_year = datetime.datetime.fromtimestamp(
-                                    os.path.getctime(fn_orig)).year
-                                new_meta["copyright_year"] = file_year
-                                print(f"  Detect file year {file_year}")
-                            new_collection = new_meta.get("collection")
-                            if not new_collection:
-                                print("  Matched w/o collection :(")
-                                manifest_fn = fn_orig
-                            else:
-                                print(f"  Matched collection {new_collection}")
-                                base_fn_new = single_fn_rename_collection(
-                                    base_fn, collection=new_collection)
-                                print(f"  {base_fn} => {base_fn_new}")
-                                fn_new = os.path.join(single_dir, base_fn_new)
-                                reg_fn = os.path.join("single", base_fn_new)
-                                manifest_fn = reg_fn
-                                print(f"  mv {fn_orig} => {fn_new}")
-                                if not dry:
-                                    shutil.move(fn_orig, fn_new)
-
-                            copyright_year = new_meta["copyright_year"]
-                            print(
-                                f"  manifesting image: {manifest_fn}, year={copyright_year}"
-                            )
-                            if not dry:
-                                simap.map_manifest_add_file(
-                                    chipid_dir,
-                                    manifest_fn,
-                                    collection=new_meta.get("collection"),
-                                    copyright_year=copyright_year,
-                                    type_="image")
-            """
-            Map file
-            """
-            for index_fn in sorted(glob.glob(chipid_dir + "/*/index.html")):
-                print(f"Found {index_fn}")
-                orig_map_dir = os.path.basename(os.path.dirname(index_fn))
-                new_meta = collection_assign_map(index_fn,
-                                                 archive_db=archive_db,
-                                                 map_db=map_db)
-                if not new_meta:
-                    print("  Completely failed to assign :(")
-                else:
-                    new_collection = new_meta.get("collection")
-                    if not new_collection:
-                        print("  Matched w/o collection :(")
-                        manifest_fn = orig_map_dir
-                    else:
-                        print(f"  Matched collection {new_collection}")
-                        base_fn_new = map_fn_rename_collection(
-                            orig_map_dir, collection=new_collection)
-                        fn_orig = os.path.join(chipid_dir, orig_map_dir)
-                        fn_new = os.path.join(chipid_dir, base_fn_new)
-                        manifest_fn = base_fn_new
-                        print(f"  mv {fn_orig} => {fn_new}")
-                        if not dry:
-                            shutil.move(fn_orig, fn_new)
-                    copyright_year = new_meta["copyright_year"]
-                    print(
-                        f"  manifesting map: {manifest_fn}, year={copyright_year}"
-                    )
-                    if not dry:
-                        simap.map_manifest_add_file(
-                            chipid_dir,
-                            manifest_fn,
-                            collection=new_meta.get("collection"),
-                            copyright_year=copyright_year,
-                            type_="map")
+    chips = list(
+        walk.map_chips(run_chip,
+                       map_dir=mapdir,
+                       vendor=vendor,
+                       chipid=chipid,
+                       jobs=jobs,
+                       initializer=load_dbs,
+                       initargs=(archive_db, map_db)))
+    plan.save_apply(chips,
+                    "auser_map_assign",
+                    plan_fn=plan_fn,
+                    dry=dry,
+                    jobs=jobs)
 
 
 def main():
@@ -282,10 +286,20 @@ def main():
     parser = argparse.ArgumentParser(
         description="Assign copyright to files in /map")
     util.add_bool_arg(parser, "--dry", default=True)
-    parser.add_argument("--archive-db")
-    parser.add_argument("--map-db")
+    parser.add_argument("--archive-db",
+                        help="auser_copyright_wiki output (.json, .ndjson, .db)")
+    parser.add_argument("--map-db",
+                        help="auser_copyright_map output (.json, .ndjson, .db)")
+    walk.add_walk_args(parser)
+    plan.add_plan_args(parser)
     args = parser.parse_args()
-    run(archive_db=args.archive_db, map_db=args.map_db, dry=args.dry)
+    if plan.run_plan_args(args, jobs=args.jobs):
+        return
+    run(archive_db=args.archive_db,
+        map_db=args.map_db,
+        dry=args.dry,
+        plan_fn=args.plan,
+        **walk.walk_kwargs(args))
 
 
 if __name__ == "__main__":
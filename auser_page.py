@@ -12,6 +12,9 @@ from pathlib import Path
 import traceback
 from siprawn import util
 from siprawn import env
+from siprawn import wiki
+from siprawn import rewrite
+import functools
 
 
 def parse_page_fn_uvc(fn):
@@ -44,8 +47,11 @@ class Mismatch(Exception):
     pass
 
 
-def run_page(fn, dry=False):
+def run_page(fn, dry=False, index=None):
+    if index is None:
+        index = wiki.LinkIndex(None)
     # Already ran?
+    # .nouser: original page, kept next to it
     if os.path.exists(fn + ".nouser"):
         print("SKIP:", fn)
         return
@@ -57,8 +63,13 @@ def run_page(fn, dry=False):
     print(f"    user: {user}")
     print(f"    vendor: {page_vendor}")
     print(f"    chipid: {page_chipid}")
+    links = index.links(fn)
+    if not links:
+        print("  SKIP: no URLs")
+        return
     txt_orig = open(fn, "r").read()
-    txt = open(fn, "r").read()
+    # url => new url, applied in one pass at the end
+    mapping = {}
     """
     Old url:
     https://siliconprawn.org/map/intel/80c186/mz_mit20x/
@@ -75,14 +86,9 @@ def run_page(fn, dry=False):
     siliconprawn.org/map/intel/80c186/single/intel_80c186_ => siliconprawn.org/map/intel/80c186/single/intel_80c186_mcmaster_
     """
     has_url = False
-    for url in re.findall(r'(https?://[^\s]+)', txt):
+    for url in links:
         has_url = True
-        # [[https://siliconprawn.org/map/intel/80502/mz_mit5x/|MZ @ mit5x]]
-        # https://siliconprawn.org/map/intel/80502/mz_mit5x/|MZ
         print("  url", url)
-        ppos = url.find("|")
-        if ppos >= 0:
-            url = url[0:ppos]
 
         if "siliconprawn.org/map" not in url:
             print("    Skip")
@@ -145,13 +151,15 @@ def run_page(fn, dry=False):
             assert re.match("https?://siliconprawn.org/map/.+/", url)
             new = url.replace(f"{vendor}/{chipid}/",
                               f"{vendor_new}/{chipid_new}/{user}_")
-        old1 = str(txt)
         print("    Old", url)
         print("    New", new)
-        txt = txt.replace(url, new)
-        if old1 == txt:
-            print("    Replace failed :(")
-            raise Exception("Replace failed :(")
+        mapping[url] = new
+
+    rewriter = rewrite.Rewriter(mapping)
+    txt, counts = rewriter.apply(txt_orig)
+    if rewriter.missing(counts):
+        print("    Replace failed :(", rewriter.missing(counts))
+        raise Exception("Replace failed :(")
 
     if not has_url:
         print("  SKIP: no URLs")
@@ -159,58 +167,82 @@ def run_page(fn, dry=False):
         print("  WARNING: unmodified")
     else:
         if dry:
-            if 0:
-                print("")
-                print("")
-                print("")
-                print(txt)
+            print(rewrite.unified_diff(txt_orig, txt, fn), end="")
         else:
-            print("  Shifting...")
-            shutil.move(fn, fn + ".nouser")
+            print("  Backing up to %s..." % (fn + ".nouser"))
+            # Only a complete backup marks the page as done
+            shutil.copy2(fn, fn + ".nouser.tmp")
+            os.replace(fn + ".nouser.tmp", fn + ".nouser")
             print("  Committing...")
-            with open(fn, "w") as f:
-                f.write(txt)
+            rewrite.write_page(fn, txt)
+
+
+# Set per worker by load_link_index()
+g_link_index = None
+
+
+def load_link_index(fn):
+    global g_link_index
+
+    g_link_index = wiki.LinkIndex(fn)
+
+
+def run_one(path, dry=True, ignore_errors=False):
+    """
+    Return (errors, new link index entries)
+    """
+    errors = 0
+    print("Page:", path)
+    try:
+        run_page(path, dry=dry, index=g_link_index)
+    except Exception as e:
+        errors += 1
+        if ignore_errors:
+            if type(e) is Mismatch:
+                pass
+            else:
+                traceback.print_exc()
+        else:
+            raise
+    return errors, g_link_index.take_new()
 
 
-def run(fndir, dry=True, ignore_errors=False):
+def run(fndir,
+        dry=True,
+        ignore_errors=False,
+        jobs=1,
+        link_index_fn=wiki.LINK_INDEX_FN):
     env.setup_env_default()
 
+    index = wiki.LinkIndex(link_index_fn)
     if fndir:
         assert ".txt" in fndir
         assert os.path.isfile(fndir)
-        run_page(fndir, dry=dry)
+        try:
+            run_page(fndir, dry=dry, index=index)
+        finally:
+            index.save()
     else:
         fndir = env.WWW_DIR + "/archive/data/pages"
         assert "data/pages" in fndir
         assert os.path.basename(fndir) == "pages"
         errors = 0
-        nusers = 0
+        nusers = len(list(wiki.collection_user_dirs(fndir)))
         npages = 0
-        for user_dir in glob.glob("%s/*" % fndir):
-            start_page = os.path.join(user_dir, "start.txt")
-            if not os.path.exists(start_page):
-                continue
-            start_txt = open(start_page, "r").read()
-            # Must be a user page
-            if "{{tag>collection}}" not in start_txt:
-                continue
-            nusers += 1
-            # Now recurse and find all vendor/chipid pages
-            for path in Path(user_dir).rglob('*.txt'):
-                path = str(path)
-                print("Page:", path)
-                try:
-                    npages += 1
-                    run_page(path, dry=dry)
-                except Exception as e:
-                    errors += 1
-                    if ignore_errors:
-                        if type(e) is Mismatch:
-                            pass
-                        else:
-                            traceback.print_exc()
-                    else:
-                        raise
+        try:
+            for page_errors, page_index in wiki.map_pages(
+                    functools.partial(run_one,
+                                      dry=dry,
+                                      ignore_errors=ignore_errors),
+                    wiki.collection_pages(fndir),
+                    jobs=jobs,
+                    initializer=load_link_index,
+                    initargs=(link_index_fn, )):
+                npages += 1
+                errors += page_errors
+                index.merge(page_index)
+        finally:
+            index.save()
         print("Users: %u" % nusers)
         print("Pages: %u" % npages)
         print("Errors: %u" % errors)
@@ -224,8 +256,19 @@ def main():
     util.add_bool_arg(parser, "--dry", default=True)
     parser.add_argument("--ignore-errors", action="store_true")
     parser.add_argument("--fndir")
+    parser.add_argument("--jobs",
+                        type=int,
+                        default=1,
+                        help="Pages to process in parallel")
+    parser.add_argument("--link-index",
+                        default=wiki.LINK_INDEX_FN,
+                        help="Cache of links found on each page")
     args = parser.parse_args()
-    run(args.fndir, dry=args.dry, ignore_errors=args.ignore_errors)
+    run(args.fndir,
+        dry=args.dry,
+        ignore_errors=args.ignore_errors,
+        jobs=args.jobs,
+        link_index_fn=args.link_index)
 
 
 if __name__ == "__main__":
@@ -1,30 +1,189 @@
 from discord.ext import tasks
 import discord
 import asyncio
+import os
+import threading
+import time
 import urllib.request
+import urllib.error
+
+try:
+    # Needs PYTHONPATH to include the siliconprawn checkout
+    from siprawn import events
+except ImportError:
+    events = None
 
 client = discord.Client(intents=discord.Intents.default())
 
 web_domain = "https://siliconprawn.org/"
 
+# Thumbnails already announced, one per line
+# Survives restarts so nothing gets posted twice
+POSTED_FN = "discord_posted.txt"
+
+# When running on the server, follow the local event feed instead of polling
+WWW_DIR = "/var/www"
+EVENTS_FN = WWW_DIR + "/lib/events.jsonl"
+EVENTS_CURSOR_FN = "discord_cursor.txt"
+# Maps are announced once autothumb has made their thumbnail
+# Give up waiting after this long (autothumb manual mode runs hourly)
+THUMB_WAIT = 3 * 60 * 60
+
+# on_ready fires again on every reconnect, only start following once
+started = False
+
+# Validators from the last 200 response
+gallery_etag = None
+gallery_last_modified = None
+
+
+def fetch_gallery():
+    """
+    Blocking conditional GET of gallery.txt
+    Return its contents or None if unchanged since last time
+    """
+    global gallery_etag
+    global gallery_last_modified
+
+    req = urllib.request.Request(web_domain + "gallery.txt")
+    if gallery_etag:
+        req.add_header("If-None-Match", gallery_etag)
+    if gallery_last_modified:
+        req.add_header("If-Modified-Since", gallery_last_modified)
+    try:
+        with urllib.request.urlopen(req, timeout=30) as f:
+            contents = f.read().decode("utf-8")
+            gallery_etag = f.headers.get("ETag")
+            gallery_last_modified = f.headers.get("Last-Modified")
+            return contents
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None
+        raise
+
+
+def parse_gallery(contents):
+    """
+    Return list of (thumb link, map link), newest first
+    """
+    ret = []
+    for l in contents.split("\n"):
+        parts = l.split("\t")
+        if len(parts) < 3:
+            continue
+        ret.append((parts[1], parts[2]))
+    return ret
+
+
+def load_posted():
+    if not os.path.exists(POSTED_FN):
+        return None
+    with open(POSTED_FN, "r") as f:
+        return set(l.strip() for l in f if l.strip())
+
+
+def mark_posted(thumb_link):
+    posted.add(thumb_link)
+    with open(POSTED_FN, "a") as f:
+        f.write(thumb_link + "\n")
+
+
 @tasks.loop(seconds=10.0)
 async def fetch_post_pic():
     print("loop")
-    global pic_channel
-    global last_url
-    contents = urllib.request.urlopen(web_domain + "gallery.txt").read().decode("utf-8")
-    thumb_link = contents.split("\n")[0].split("\t")[1]
-    map_link = contents.split("\n")[0].split("\t")[2]
+    global posted
+    # Don't stall the event loop on the network
+    try:
+        contents = await asyncio.to_thread(fetch_gallery)
+    except (urllib.error.URLError, OSError) as e:
+        # ex: site briefly down. Try again next time
+        print("WARNING: gallery fetch failed: %s" % (e, ))
+        return
+    if contents is None:
+        print("Still old one")
+        return
+    entries = parse_gallery(contents)
+
+    # First run ever: don't spam the channel with the whole gallery
+    if posted is None:
+        print("Seeding %u already posted" % len(entries))
+        posted = set()
+        for thumb_link, _map_link in entries:
+            mark_posted(thumb_link)
+        return
+
+    # Several maps may have landed between polls, post oldest first
+    for thumb_link, map_link in reversed(entries):
+        await post_pic(thumb_link, web_domain + map_link)
+
+
+async def post_pic(thumb_link, map_url, has_thumb=True):
+    if thumb_link in posted:
+        return
+    print("Send new one")
     print(thumb_link)
-    print(map_link)
-    if thumb_link != last_url:
-        print("Send new one")
-        last_url = thumb_link
-        embed = discord.Embed(title = "New picture drop !", url=web_domain + map_link, description="Can add fields etc following data on the server")
+    print(map_url)
+    embed = discord.Embed(title = "New picture drop !", url=map_url, description="Can add fields etc following data on the server")
+    if has_thumb:
         embed.set_thumbnail(url=web_domain + thumb_link)
+    # Claim it before awaiting so another caller doesn't post it too
+    posted.add(thumb_link)
+    try:
         await pic_channel.send(embed=embed)
-    else:
-        print("Still old one")
+    except Exception:
+        # Try again later
+        posted.discard(thumb_link)
+        raise
+    mark_posted(thumb_link)
+
+
+def event_thumb(event):
+    """
+    foo.jpg => foo.thumb.jpg, same as autothumb
+    """
+    withoutext, ext = os.path.splitext(event["single"])
+    return withoutext + ".thumb" + ext
+
+
+def follow_events(loop, poll=5.0):
+    """
+    Thread: post maps as simapper completes them
+    The saved cursor stays before the oldest map still waiting on its
+    thumbnail so a restart picks those up again
+    """
+    cursor_db = events.Cursor(EVENTS_CURSOR_FN)
+    # First run: only new maps
+    cursor = cursor_db.load(default=events.end_cursor(fn=EVENTS_FN))
+    saved_cursor = None
+    # [(cursor before event, event)]
+    waiting = []
+    while True:
+        for event, next_cursor in events.read(cursor, fn=EVENTS_FN):
+            if event.get("type") == events.MAP_COMPLETED:
+                waiting.append((cursor, event))
+            cursor = next_cursor
+
+        still_waiting = []
+        for event_cursor, event in waiting:
+            thumb_link = event_thumb(event)
+            has_thumb = os.path.exists(os.path.join(WWW_DIR, thumb_link))
+            if not has_thumb and time.time() - event["time"] < THUMB_WAIT:
+                still_waiting.append((event_cursor, event))
+                continue
+            future = asyncio.run_coroutine_threadsafe(
+                post_pic(thumb_link, event["map"], has_thumb=has_thumb),
+                loop)
+            try:
+                future.result()
+            except Exception as e:
+                print("WARNING: failed to post %s: %s" % (thumb_link, e))
+        waiting = still_waiting
+        save_cursor = waiting[0][0] if waiting else cursor
+        if save_cursor != saved_cursor:
+            cursor_db.save(save_cursor)
+            saved_cursor = save_cursor
+        time.sleep(poll)
+
 
 @client.event
 async def on_ready():
@@ -32,10 +191,23 @@ async def on_ready():
     print(client.user.name)
     print(client.user.id)
     print('------')
+    global started
+    if started:
+        print("Reconnected")
+        return
+    started = True
     global pic_channel
     pic_channel = client.get_channel(CHANID_HERE)
-    global last_url
-    last_url = ""
-    fetch_post_pic.start()
+    global posted
+    posted = load_posted()
+    if events and os.path.exists(EVENTS_FN):
+        print("Following " + EVENTS_FN)
+        if posted is None:
+            posted = set()
+        threading.Thread(target=follow_events,
+                         args=(asyncio.get_running_loop(), ),
+                         daemon=True).start()
+    else:
+        fetch_post_pic.start()
 
 client.run('TOKEN_HERE')
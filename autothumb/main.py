@@ -1,12 +1,20 @@
 import os
 import argparse
-from time import sleep
+from time import sleep, monotonic
 from glob import glob
+import heapq
 import shutil
+import threading
+import datetime
+import json
+import concurrent.futures
+import sqlite3
 
 import PIL
 from PIL import Image
 from watchdog.observers import Observer
+# Needs PYTHONPATH to include the siliconprawn checkout, see refresh-loop.sh
+from siprawn import walk
 
 # Have to disable DecompressionBombError limits because these images are large
 PIL.Image.MAX_IMAGE_PIXELS = None
@@ -24,7 +32,8 @@ MAP_DIR = "/var/www/map"
 if not os.path.exists(MAP_DIR):
     MAP_DIR = "map"
     print("WARNING: dev mode")
-assert os.path.exists(MAP_DIR)
+# State lives with the site, not wherever the process happened to start
+LIB_DIR = os.path.join(os.path.dirname(os.path.abspath(MAP_DIR)), "lib")
 
 THUMBFILELIST = "gallery.txt"
 
@@ -32,63 +41,284 @@ SMALL_MAX_WIDTH = SMALL_MAX_HEIGHT = 300
 
 FORCE_REGEN = False
 
+# Seconds of quiet before a burst of file events is processed
+DEBOUNCE_S = 2.0
+# ...but don't let a steady trickle of events hold things up forever
+DEBOUNCE_MAX_S = 30.0
+
+# Manual mode worker processes
+JOBS = os.cpu_count() or 1
+# Estimated image decode memory allowed in flight at once
+# None => half of what's currently available
+MEM_BUDGET = None
+# Sources already regenerated by an interrupted --force pass
+BACKFILL_JOURNAL = os.path.join(LIB_DIR, "autothumb_backfill.txt")
+# Manual mode record of what has been thumbnailed
+STATE_DB = os.path.join(LIB_DIR, "autothumb_state.db")
+# Stat every source instead of only looking in changed single/ dirs
+# Catches images overwritten in place
+FULL_SCAN = False
+
+# Also emit smaller / modern format thumbnails next to .thumb.<ext>
+# ex: foo.jpg => foo.thumb.150w.webp, foo.thumb.150w.jpg, ...
+THUMB_VARIANTS = False
+# Bounding box sizes
+VARIANT_SIZES = (150, 300, 600)
+# (extension, PIL format, save options), best first
+# Unsupported formats are dropped at startup. JPEG is the fallback
+VARIANT_FORMATS = [
+    ("avif", "AVIF", {
+        "quality": 60
+    }),
+    ("webp", "WEBP", {
+        "quality": 80,
+        "method": 6
+    }),
+    ("jpg", "JPEG", {
+        "quality": 85,
+        "optimize": True,
+        "progressive": True
+    }),
+]
+# Variant listing for gallery.txt entries
+THUMBFEED = "gallery.json"
+
+
+def variant_formats():
+    try:
+        # Older Pillow needs the plugin for AVIF
+        import pillow_avif  # noqa: F401
+    except ImportError:
+        pass
+    Image.init()
+    return [x for x in VARIANT_FORMATS if x[1] in Image.SAVE]
+
+
+VARIANT_FORMATS = variant_formats()
 
-def thumb(path):
+
+def thumb(path, force=None, variants=None):
+    """
+    Generate the thumbnail for path if needed
+    Return the thumbnail path if one exists afterwards
+    """
+    if force is None:
+        force = FORCE_REGEN
+    if variants is None:
+        variants = THUMB_VARIANTS
 
     if ".thumb" in path:
-        return
+        return None
 
     if path.rsplit(".", 1)[-1].lower() not in ALLOWED_ENDINGS:
-        return
+        return None
 
     if path.split(os.path.sep)[-2] != "single":
-        return
+        return None
 
-    withoutext, ext = path.rsplit(".", 1)
-    smallthumbpath = withoutext + ".thumb." + ext
+    smallthumbpath = thumb_name(path)
 
-    if not FORCE_REGEN and os.path.exists(smallthumbpath):
-        return
+    if not force and not thumbs_missing(path, variants=variants):
+        return smallthumbpath
 
     print("Resizing", path)
 
     img = Image.open(path)
-    img.thumbnail((SMALL_MAX_WIDTH, SMALL_MAX_HEIGHT), Image.LANCZOS)
-    img.save(smallthumbpath)
+    if not variants:
+        img.thumbnail((SMALL_MAX_WIDTH, SMALL_MAX_HEIGHT), Image.LANCZOS)
+        img.save(smallthumbpath)
+        return smallthumbpath
+
+    # Decode once at the largest size needed and derive the rest from that
+    biggest = max(VARIANT_SIZES + (SMALL_MAX_WIDTH, SMALL_MAX_HEIGHT))
+    img.thumbnail((biggest, biggest), Image.LANCZOS)
+    small = img.copy()
+    small.thumbnail((SMALL_MAX_WIDTH, SMALL_MAX_HEIGHT), Image.LANCZOS)
+    small.save(smallthumbpath)
+
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+    for size in VARIANT_SIZES:
+        sized = img.copy()
+        sized.thumbnail((size, size), Image.LANCZOS)
+        for ext, format_, options in VARIANT_FORMATS:
+            out = sized
+            if format_ == "JPEG" and out.mode != "RGB":
+                out = out.convert("RGB")
+            out.save(variant_name(path, size, ext), format_, **options)
+    return smallthumbpath
+
+
+def thumb_name(path):
+    withoutext, ext = path.rsplit(".", 1)
+    return withoutext + ".thumb." + ext
+
+
+def thumb_source_stem(path):
+    """
+    foo.thumb.jpg, foo.thumb.150w.webp, etc => foo
+    """
+    dirname, basename = os.path.split(path)
+    return os.path.join(dirname, basename.split(".thumb.", 1)[0])
+
+
+def variant_name(path, size, ext):
+    withoutext, _ext = path.rsplit(".", 1)
+    return "%s.thumb.%uw.%s" % (withoutext, size, ext)
+
+
+def variant_names(path):
+    """
+    Yield (size, extension, path) for all enabled variants
+    """
+    for size in VARIANT_SIZES:
+        for ext, _format, _options in VARIANT_FORMATS:
+            yield size, ext, variant_name(path, size, ext)
+
+
+def thumbs_missing(path, variants=None):
+    if variants is None:
+        variants = THUMB_VARIANTS
+    if not os.path.exists(thumb_name(path)):
+        return True
+    if variants:
+        for _size, _ext, fn in variant_names(path):
+            if not os.path.exists(fn):
+                return True
+    return False
+
+
+def is_thumb(path):
+    """
+    The main .thumb.<ext> thumbnail, not a sized variant
+    """
+    basename = os.path.basename(path)
+    if path.split(os.path.sep)[-2] != "single" or ".thumb." not in basename:
+        return False
+    return basename.split(".thumb.", 1)[1].lower() in ALLOWED_ENDINGS
+
+
+class Gallery:
+    """
+    Newest GALLERY_IMAGES thumbnails for gallery.txt
+
+    Kept as a bounded min-heap of (mtime, path) so the oldest entry is on top
+    Seeded once from a full scan, then updated one thumbnail at a time
+    """
+    def __init__(self, size=GALLERY_IMAGES):
+        self.size = size
+        self.heap = []
+        # path to mtime for what's currently in the heap
+        self.mtimes = {}
+
+    def seed(self, thumbpaths=None):
+        if thumbpaths is None:
+            print("Gallery: scanning for thumbnails")
+            thumbpaths = glob(MAP_DIR + "/**/single/*.thumb.*", recursive=True)
+        for path in thumbpaths:
+            if is_thumb(path):
+                self.add(path)
+        print("Gallery: seeded %u / %u thumbnails" %
+              (len(self.heap), self.size))
+
+    def add(self, path, mtime=None):
+        """
+        Return True if the gallery changed
+        """
+        if mtime is None:
+            try:
+                mtime = os.path.getmtime(path)
+            except FileNotFoundError:
+                return False
+
+        old_mtime = self.mtimes.get(path)
+        if old_mtime is not None:
+            if old_mtime == mtime:
+                return False
+            # Regenerated: drop the stale entry
+            # Heap is GALLERY_IMAGES long so this is cheap
+            self.heap = [x for x in self.heap if x[1] != path]
+            heapq.heapify(self.heap)
+            del self.mtimes[path]
+
+        entry = (mtime, path)
+        if len(self.heap) < self.size:
+            heapq.heappush(self.heap, entry)
+        elif entry > self.heap[0]:
+            _mtime, evicted = heapq.heapreplace(self.heap, entry)
+            del self.mtimes[evicted]
+        else:
+            return False
+        self.mtimes[path] = mtime
+        return True
 
+    def newest(self):
+        return [path for _mtime, path in sorted(self.heap, reverse=True)]
 
-def thumbfilelist():
-    print("Generating " + THUMBFILELIST)
 
-    thumbpaths = glob(MAP_DIR + "/**/single/*.thumb.*", recursive=True)
+def gallery_entry(path):
+    """
+    Return (parent dir, thumbnail, map) for thumbnail path
+    or None if it shouldn't be shown
+    """
+    parentdir = os.path.dirname(os.path.dirname(path))
 
-    result = []
+    tilemappath = MAP_DIR + "/" + os.path.sep.join(
+        os.path.basename(path).split(".", 1)[0].split("_", 2))
 
-    for path in sorted(thumbpaths,
-                       key=lambda path: os.path.getmtime(path),
-                       reverse=True)[:GALLERY_IMAGES]:
-        parentdir = os.path.dirname(os.path.dirname(path))
+    if not os.path.isdir(tilemappath):
+        print("WARNING: tilemap %s doesn't exist for thumb %s" %
+              (tilemappath, path))
+        return None
 
-        tilemappath = MAP_DIR + "/" + os.path.sep.join(
-            os.path.basename(path).split(".", 1)[0].split("_", 2))
+    if tilemappath:
+        linkpath = tilemappath
+    else:
+        linkpath = path
+    return relative(parentdir), relative(path), relative(linkpath)
 
-        if not os.path.isdir(tilemappath):
-            print("WARNING: tilemap %s doesn't exist for thumb %s" %
-                  (tilemappath, path))
-            continue
 
-        bigpath = path.replace(".thumb", "")
+def relative(path):
+    return path.replace("/var/www/", "")
 
-        def relative(path):
-            return path.replace("/var/www/", "")
 
-        line = relative(parentdir) + "\t" + relative(path) + "\t"
-        if tilemappath:
-            line += relative(tilemappath)
-        else:
-            line += relative(path)
+def gallery_variants(path):
+    """
+    Variants that exist for thumbnail path, smallest first
+    """
+    ret = []
+    source = thumb_source_stem(path) + "." + path.rsplit(".", 1)[1]
+    for size, ext, fn in variant_names(source):
+        if os.path.exists(fn):
+            ret.append({
+                "size": size,
+                "format": ext,
+                "url": relative(fn),
+            })
+    return ret
+
 
-        result.append(line)
+def thumbfilelist(gallery):
+    print("Generating " + THUMBFILELIST)
+
+    result = []
+    feed = []
+    for path in gallery.newest():
+        # Deleted since it was added
+        if not os.path.exists(path):
+            continue
+        entry = gallery_entry(path)
+        if entry is None:
+            continue
+        result.append("\t".join(entry))
+        parentdir, thumbpath, linkpath = entry
+        feed.append({
+            "dir": parentdir,
+            "thumb": thumbpath,
+            "map": linkpath,
+            # Leftover variants from an earlier --variants run may be stale
+            "variants": gallery_variants(path) if THUMB_VARIANTS else [],
+        })
 
     print("Generated %u thumbnails" % len(result))
     tmp_fn = THUMBFILELIST + ".tmp"
@@ -97,43 +327,562 @@ def thumbfilelist():
     print("Shifting tmp into final file")
     shutil.move(tmp_fn, THUMBFILELIST)
 
+    # Always written: index.html prefers it over gallery.txt
+    print("Generating " + THUMBFEED)
+    tmp_fn = THUMBFEED + ".tmp"
+    with open(tmp_fn, "w") as f:
+        json.dump(feed, f, indent=4, separators=(',', ': '))
+    shutil.move(tmp_fn, THUMBFEED)
+
 
 class event_handler:
-    @staticmethod
-    def dispatch(event):
-        if event.event_type == "created" and not event.is_directory:
+    """
+    Only single/ images are interesting, but a recursive watch over MAP_DIR
+    also sees every tile prawnmap writes (and runs into the inotify limit)
+    Instead watch non-recursively:
+    -MAP_DIR, vendor and chipid dirs: to notice new single/ dirs
+    -single/ dirs: new images
+    Events are collected and processed as one batch once things go quiet
+    """
+    def __init__(self, observer, gallery):
+        self.observer = observer
+        self.gallery = gallery
+        # dir to watchdog handle
+        self.watches = {}
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.first_event = None
+        self.last_event = None
+
+    def relparts(self, path):
+        return os.path.relpath(path, MAP_DIR).split(os.path.sep)
+
+    def watch(self, path):
+        path = os.path.normpath(path)
+        if path in self.watches:
+            return
+        try:
+            self.watches[path] = self.observer.schedule(self,
+                                                        path,
+                                                        recursive=False)
+        except OSError as e:
+            print("WARNING: failed to watch %s: %s" % (path, e))
+
+    def unwatch(self, path):
+        watch = self.watches.pop(os.path.normpath(path), None)
+        if watch is None:
+            return
+        try:
+            self.observer.unschedule(watch)
+        except KeyError:
+            pass
+
+    def watch_dir(self, path, catchup=True):
+        """
+        Watch path if its a level we care about
+        catchup: queue images created before the watch was in place
+        """
+        parts = self.relparts(path)
+        if parts == ["."] or len(parts) in (1, 2):
+            self.watch(path)
+            for entry in os.scandir(path):
+                if entry.is_dir():
+                    self.watch_dir(entry.path, catchup=catchup)
+        elif len(parts) == 3 and parts[2] == "single":
+            self.watch(path)
+            if catchup:
+                for entry in os.scandir(path):
+                    if entry.is_file():
+                        self.queue(entry.path)
+
+    def queue(self, path):
+        parts = self.relparts(path)
+        if len(parts) != 4 or parts[2] != "single":
+            return
+        now = monotonic()
+        with self.lock:
+            self.pending.add(path)
+            if self.first_event is None:
+                self.first_event = now
+            self.last_event = now
+
+    def dispatch(self, event):
+        if event.event_type == "created":
+            path = event.src_path
+        elif event.event_type == "moved":
+            path = event.dest_path
+        elif event.event_type == "deleted" and event.is_directory:
+            self.unwatch(event.src_path)
+            return
+        else:
+            return
+
+        try:
+            if event.is_directory:
+                self.watch_dir(path)
+            else:
+                self.queue(path)
+        except FileNotFoundError:
+            # Already gone
+            pass
+
+    def ready(self):
+        now = monotonic()
+        with self.lock:
+            if not self.pending:
+                return False
+            return (now - self.last_event >= DEBOUNCE_S
+                    or now - self.first_event >= DEBOUNCE_MAX_S)
+
+    def flush(self):
+        with self.lock:
+            paths = self.pending
+            self.pending = set()
+            self.first_event = None
+            self.last_event = None
+
+        changed = False
+        for path in sorted(paths):
             try:
-                thumb(event.src_path)
-                thumbfilelist()
+                if not is_thumb(path):
+                    path = thumb(path)
+                if path and self.gallery.add(path):
+                    changed = True
             except PIL.UnidentifiedImageError as e:
                 print(e)
+            except FileNotFoundError as e:
+                # Moved / deleted before we got to it
+                print(e)
+        if changed:
+            thumbfilelist(self.gallery)
 
 
 def mode_observe():
+    gallery = Gallery()
+    gallery.seed()
+    thumbfilelist(gallery)
+
     observer = Observer()
-    observer.schedule(event_handler, MAP_DIR, recursive=True)
+    handler = event_handler(observer, gallery)
+    # Existing images are manual mode's job
+    handler.watch_dir(MAP_DIR, catchup=False)
+    print("Watching %u directories" % len(handler.watches))
     observer.start()
 
     try:
         while True:
             sleep(1)
+            if handler.ready():
+                handler.flush()
     finally:
         observer.stop()
         observer.join()
 
 
-def mode_manual():
-    print("Manual mode: scanning")
-    paths = []
-    for ending in ALLOWED_ENDINGS:
-        paths += glob(MAP_DIR + "/**/single/*." + ending, recursive=True)
-
-    print("Manual mode: generating thumbnails from %u files" % len(paths))
+def default_mem_budget():
+    """
+    Half of MemAvailable, or something conservative if we can't tell
+    """
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for l in f:
+                if l.startswith("MemAvailable:"):
+                    return int(l.split()[1]) * 1024 // 2
+    except OSError:
+        pass
+    return 2 * 1024 * 1024 * 1024
+
+
+def estimate_decode_mem(path):
+    """
+    Approximate bytes needed to decode path for thumbnailing
+    Only reads the image header
+    """
+    with Image.open(path) as img:
+        width, height = img.size
+        bands = len(img.getbands())
+        # ex: I;16
+        depth = 2 if "16" in img.mode else 1
+        box = SMALL_MAX_WIDTH
+        if THUMB_VARIANTS:
+            box = max(VARIANT_SIZES + (box, ))
+        scale = 1
+        # thumbnail() lets the JPEG decoder downscale up to 1/8 for us
+        if img.format == "JPEG":
+            while (scale < 8 and width // (scale * 2) >= box * 2
+                   and height // (scale * 2) >= box * 2):
+                scale *= 2
+    return (width // scale) * (height // scale) * bands * depth
+
+
+def thumb_worker(path, force, variants):
+    """
+    Process pool entry point
+    Return (path, thumb path or None, error string or None)
+    """
+    try:
+        return path, thumb(path, force=force, variants=variants), None
+    except Exception as e:
+        return path, None, "%s: %s" % (type(e).__name__, e)
+
+
+def load_backfill_journal():
+    if not os.path.exists(BACKFILL_JOURNAL):
+        return set()
+    with open(BACKFILL_JOURNAL, "r") as f:
+        return set(l.rstrip("\n") for l in f if l.strip())
+
+
+class Progress:
+    def __init__(self, total, interval=5.0):
+        self.total = total
+        self.done = 0
+        self.interval = interval
+        self.start = monotonic()
+        self.last_print = self.start
+
+    def update(self):
+        self.done += 1
+        now = monotonic()
+        if now - self.last_print < self.interval and self.done != self.total:
+            return
+        self.last_print = now
+        dt = now - self.start
+        rate = self.done / dt if dt else 0.0
+        if rate:
+            eta = datetime.timedelta(seconds=int(
+                (self.total - self.done) / rate))
+        else:
+            eta = "?"
+        print("Manual mode: %u / %u (%0.1f%%), %0.2f img/s, ETA %s" %
+              (self.done, self.total, 100.0 * self.done / self.total, rate,
+               eta))
+
+
+def backfill(paths, force=False, stale=(), jobs=None, mem_budget=None):
+    """
+    Thumbnail paths across a process pool
+    Concurrency is also limited by estimated decode memory so a handful of
+    30k x 30k images don't get decoded at once
+    force: regenerate all existing thumbnails
+    stale: regenerate existing thumbnails for just these paths
+    --force passes are journaled so they can be resumed after interruption
+
+    Return dict of source path to thumbnail path
+    """
+    if jobs is None:
+        jobs = JOBS
+    if mem_budget is None:
+        mem_budget = MEM_BUDGET or default_mem_budget()
+
+    thumbpaths = {}
+    todo = []
+    journal = load_backfill_journal() if force else set()
+    if journal:
+        print("Manual mode: resuming, %u already done" % len(journal))
     for path in paths:
-        thumb(path)
+        path_force = force or path in stale
+        if force and path in journal:
+            thumbpaths[path] = thumb_name(path)
+            continue
+        if not path_force and not thumbs_missing(path):
+            thumbpaths[path] = thumb_name(path)
+            continue
+        try:
+            todo.append((path, path_force, estimate_decode_mem(path)))
+        except (PIL.UnidentifiedImageError, OSError) as e:
+            print("WARNING: %s: %s" % (path, e))
+    print("Manual mode: %u to generate, %u workers, %0.1f MiB memory budget" %
+          (len(todo), jobs, mem_budget / 1024 / 1024))
+    if not todo:
+        return thumbpaths
+
+    progress = Progress(len(todo))
+    errors = {}
+    journal_f = None
+    if force:
+        os.makedirs(os.path.dirname(os.path.abspath(BACKFILL_JOURNAL)),
+                    exist_ok=True)
+        journal_f = open(BACKFILL_JOURNAL, "a")
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            pending = {}
+            mem_used = 0
+            todo.reverse()
+            while todo or pending:
+                # Always allow one job even if it alone exceeds the budget
+                while todo and len(pending) < jobs and (
+                        not pending or mem_used + todo[-1][2] <= mem_budget):
+                    path, path_force, mem = todo.pop()
+                    pending[pool.submit(thumb_worker, path, path_force,
+                                          THUMB_VARIANTS)] = mem
+                    mem_used += mem
+
+                finished, _not_done = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    mem_used -= pending.pop(future)
+                    path, thumbpath, error = future.result()
+                    if error:
+                        print("WARNING: %s: %s" % (path, error))
+                        errors[path] = error
+                    elif thumbpath:
+                        thumbpaths[path] = thumbpath
+                        if journal_f:
+                            journal_f.write(path + "\n")
+                            journal_f.flush()
+                    progress.update()
+    finally:
+        if journal_f:
+            journal_f.close()
+
+    print("Manual mode: %u errors" % len(errors))
+    # Full pass completed, next --force starts from scratch
+    if force and os.path.exists(BACKFILL_JOURNAL):
+        os.unlink(BACKFILL_JOURNAL)
+    return thumbpaths
+
+
+class StateDB:
+    """
+    What manual mode has already processed so it only has to look at changes
+
+    sources: each thumbnailed image as of when it was thumbnailed
+    dirs: single/ dir mtimes. Unchanged => nothing added / removed / renamed
+    config: settings the recorded state depends on
+    """
+    def __init__(self, fn):
+        os.makedirs(os.path.dirname(os.path.abspath(fn)), exist_ok=True)
+        self.conn = sqlite3.connect(fn)
+        with self.conn:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS sources (
+                path TEXT PRIMARY KEY,
+                dir TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                thumb TEXT NOT NULL,
+                thumb_mtime REAL NOT NULL)""")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS sources_dir ON sources (dir)")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS dirs (
+                path TEXT PRIMARY KEY,
+                mtime REAL NOT NULL)""")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS config (
+                k TEXT PRIMARY KEY,
+                v TEXT NOT NULL)""")
+
+    def close(self):
+        self.conn.close()
+
+    def get_config(self, k):
+        row = self.conn.execute("SELECT v FROM config WHERE k = ?",
+                                (k, )).fetchone()
+        return row[0] if row else None
+
+    def set_config(self, k, v):
+        self.conn.execute("INSERT OR REPLACE INTO config VALUES (?, ?)",
+                          (k, v))
+
+    def dir_mtimes(self):
+        return dict(self.conn.execute("SELECT path, mtime FROM dirs"))
+
+    def set_dir_mtime(self, path, mtime):
+        self.conn.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?)",
+                          (path, mtime))
+
+    def sources_in(self, dir_):
+        """
+        Return dict of path to (size, mtime)
+        """
+        ret = {}
+        for path, size, mtime in self.conn.execute(
+                "SELECT path, size, mtime FROM sources WHERE dir = ?",
+            (dir_, )):
+            ret[path] = (size, mtime)
+        return ret
+
+    def set_source(self, path, size, mtime, thumb, thumb_mtime):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?, ?)",
+            (path, os.path.dirname(path), size, mtime, thumb, thumb_mtime))
+
+    def drop_source(self, path):
+        self.conn.execute("DELETE FROM sources WHERE path = ?", (path, ))
+
+    def drop_dir(self, dir_):
+        self.conn.execute("DELETE FROM sources WHERE dir = ?", (dir_, ))
+        self.conn.execute("DELETE FROM dirs WHERE path = ?", (dir_, ))
+
+    def thumbs(self):
+        """
+        Yield (thumb path, thumb mtime)
+        """
+        yield from self.conn.execute("SELECT thumb, thumb_mtime FROM sources")
+
+
+def scan_single_dirs():
+    """
+    Yield (single dir, mtime)
+    """
+    for _vendor, _chipid, chip_dir in walk.chip_dirs(MAP_DIR):
+        single_dir = os.path.join(chip_dir, "single")
+        try:
+            yield single_dir, os.stat(single_dir).st_mtime
+        except FileNotFoundError:
+            pass
+
+
+def scan_single_dir(state, single_dir):
+    """
+    Compare single_dir against what was recorded
+    Prune thumbnails whose source is gone
+
+    Return (sources to thumbnail, stale subset of those, up to date sources)
+    Up to date is dict of path to (size, mtime, thumb path, thumb mtime)
+    """
+    files = {}
+    for entry in os.scandir(single_dir):
+        if entry.is_file():
+            files[entry.name] = entry
+    known = state.sources_in(single_dir)
+
+    def is_source(name):
+        return ".thumb" not in name and name.rsplit(
+            ".", 1)[-1].lower() in ALLOWED_ENDINGS
+
+    source_stems = set(
+        name.rsplit(".", 1)[0] for name in files if is_source(name))
+
+    todo = []
+    stale = set()
+    current = {}
+    sources = set()
+    for name, entry in files.items():
+        if ".thumb." in name:
+            if thumb_source_stem(name) not in source_stems:
+                print("Pruning orphaned thumbnail", entry.path)
+                os.unlink(entry.path)
+            continue
+        if not is_source(name):
+            continue
+        path = entry.path
+        sources.add(path)
+        st = entry.stat()
+        thumb_entry = files.get(thumb_name(name))
+        if thumb_entry is None:
+            todo.append(path)
+            continue
+        if THUMB_VARIANTS and any(
+                os.path.basename(fn) not in files
+                for _size, _ext, fn in variant_names(path)):
+            todo.append(path)
+            continue
+        thumb_mtime = thumb_entry.stat().st_mtime
+        old = known.get(path)
+        if old is None:
+            # Never recorded, trust the thumbnail unless its older
+            is_stale = thumb_mtime < st.st_mtime
+        else:
+            # Source replaced since it was thumbnailed
+            is_stale = old != (st.st_size, st.st_mtime)
+        if is_stale or FORCE_REGEN:
+            todo.append(path)
+            stale.add(path)
+        else:
+            current[path] = (st.st_size, st.st_mtime, thumb_entry.path,
+                             thumb_mtime)
 
-    print("Manual mode: generating gallery.txt")
-    thumbfilelist()
+    for path in known:
+        if path not in sources:
+            print("Source removed", path)
+            state.drop_source(path)
+    return todo, stale, current
+
+
+def mode_manual():
+    state = StateDB(STATE_DB)
+    try:
+        print("Manual mode: scanning")
+        old_dir_mtimes = state.dir_mtimes()
+        # Thumbnails wanted per image changed => every dir needs a look
+        variants = None
+        if THUMB_VARIANTS:
+            variants = [list(VARIANT_SIZES), [x[0] for x in VARIANT_FORMATS]]
+        variants = json.dumps(variants)
+        full_scan = FULL_SCAN or FORCE_REGEN
+        if state.get_config("variants") != variants:
+            print("Manual mode: thumbnail variants changed, checking all dirs")
+            full_scan = True
+        todo = []
+        stale = set()
+        current = {}
+        changed_dirs = []
+        ndirs = 0
+        with state.conn:
+            for single_dir, mtime in scan_single_dirs():
+                ndirs += 1
+                old_mtime = old_dir_mtimes.pop(single_dir, None)
+                if not full_scan and old_mtime == mtime:
+                    continue
+                changed_dirs.append(single_dir)
+                dir_todo, dir_stale, dir_current = scan_single_dir(
+                    state, single_dir)
+                todo += dir_todo
+                stale |= dir_stale
+                current.update(dir_current)
+            # Whatever is left wasn't found this time
+            for single_dir in old_dir_mtimes:
+                print("Single dir removed", single_dir)
+                state.drop_dir(single_dir)
+        print("Manual mode: %u / %u single dirs changed" %
+              (len(changed_dirs), ndirs))
+
+        print("Manual mode: generating thumbnails from %u files" % len(todo))
+        thumbpaths = backfill(todo, force=FORCE_REGEN, stale=stale)
+
+        with state.conn:
+            for path, (size, mtime, thumbpath, thumb_mtime) in current.items():
+                state.set_source(path, size, mtime, thumbpath, thumb_mtime)
+            for path, thumbpath in thumbpaths.items():
+                try:
+                    st = os.stat(path)
+                    thumb_mtime = os.path.getmtime(thumbpath)
+                except FileNotFoundError as e:
+                    # Moved / deleted during the backfill (ex: asset_rename)
+                    # The next scan of its dir catches up
+                    print(e)
+                    continue
+                state.set_source(path, st.st_size, st.st_mtime, thumbpath,
+                                 thumb_mtime)
+            state.set_config("variants", variants)
+            # Writing thumbnails bumped dir mtimes
+            # Only accept the new mtime if nothing else showed up meanwhile
+            # Failed images also keep the dir from being marked up to date
+            for single_dir in changed_dirs:
+                try:
+                    mtime = os.stat(single_dir).st_mtime
+                    entries = list(os.scandir(single_dir))
+                except FileNotFoundError as e:
+                    # Whole chip moved meanwhile, dropped on the next scan
+                    print(e)
+                    continue
+                known = state.sources_in(single_dir)
+                for entry in entries:
+                    if (entry.is_file() and ".thumb" not in entry.name
+                            and entry.name.rsplit(".", 1)[-1].lower()
+                            in ALLOWED_ENDINGS and entry.path not in known):
+                        break
+                else:
+                    state.set_dir_mtime(single_dir, mtime)
+
+        print("Manual mode: generating gallery.txt")
+        # Every thumbnail and its mtime is already known, no need to rescan
+        gallery = Gallery()
+        for thumbpath, thumb_mtime in state.thumbs():
+            gallery.add(thumbpath, thumb_mtime)
+        thumbfilelist(gallery)
+    finally:
+        state.close()
 
 
 if __name__ == "__main__":
@@ -153,8 +902,42 @@ if __name__ == "__main__":
     parser.add_argument("--gallery-txt",
                         default="/var/www/gallery.txt",
                         help="Output gallery file name")
+    parser.add_argument("--gallery-json",
+                        default="/var/www/gallery.json",
+                        help="Output gallery feed, with variants if --variants")
+    parser.add_argument("--variants",
+                        action="store_true",
+                        help="Also generate sized AVIF / WebP / JPEG thumbnails")
+    parser.add_argument("--jobs",
+                        type=int,
+                        default=JOBS,
+                        help="Manual mode worker processes")
+    parser.add_argument(
+        "--mem-budget",
+        type=int,
+        default=None,
+        help="Manual mode decode memory budget in MiB (default: half available)")
+    parser.add_argument("--journal",
+                        default=BACKFILL_JOURNAL,
+                        help="Resume journal for --force passes")
+    parser.add_argument("--state-db",
+                        default=STATE_DB,
+                        help="Manual mode state database")
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Check every image, not just those in changed directories")
 
     args = parser.parse_args()
     THUMBFILELIST = args.gallery_txt
+    THUMBFEED = args.gallery_json
+    THUMB_VARIANTS = args.variants
     FORCE_REGEN = args.force
+    JOBS = args.jobs
+    if args.mem_budget:
+        MEM_BUDGET = args.mem_budget * 1024 * 1024
+    BACKFILL_JOURNAL = args.journal
+    STATE_DB = args.state_db
+    FULL_SCAN = args.full
+    assert os.path.exists(MAP_DIR), MAP_DIR
     args.mode()
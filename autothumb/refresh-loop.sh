@@ -1,5 +1,8 @@
 #!/usr/bin/env bash
 
+# main.py uses the siprawn package from the parent checkout
+export PYTHONPATH="$(dirname "$(pwd)")${PYTHONPATH:+:$PYTHONPATH}"
+
 # OSError: inotify watch limit reached
 # python3 main.py --watch
 # exit 1
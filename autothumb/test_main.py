@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+autothumb unit tests
+Run from the repo root so siprawn is importable
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from time import monotonic
+from unittest import mock
+from PIL import Image
+import main
+
+# Module settings tests override
+SETTINGS = ("MAP_DIR", "THUMBFILELIST", "THUMBFEED", "THUMB_VARIANTS",
+            "VARIANT_FORMATS", "FORCE_REGEN", "FULL_SCAN", "STATE_DB",
+            "BACKFILL_JOURNAL", "JOBS")
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="autothumb_test_")
+        self.settings = dict((k, getattr(main, k)) for k in SETTINGS)
+        main.MAP_DIR = os.path.join(self.tmp_dir, "map")
+        main.THUMBFILELIST = os.path.join(self.tmp_dir, "gallery.txt")
+        main.THUMBFEED = os.path.join(self.tmp_dir, "gallery.json")
+        main.STATE_DB = os.path.join(self.tmp_dir, "lib/state.db")
+        main.BACKFILL_JOURNAL = os.path.join(self.tmp_dir, "lib/backfill.txt")
+        main.JOBS = 2
+        self.single_dir = os.path.join(main.MAP_DIR, "intel/i8080/single")
+        os.makedirs(self.single_dir)
+
+    def tearDown(self):
+        for k, v in self.settings.items():
+            setattr(main, k, v)
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def image(self, flavor, size=(400, 200)):
+        """
+        Source image with its map dir
+        """
+        fn = os.path.join(self.single_dir,
+                          "intel_i8080_mcmaster_%s.jpg" % flavor)
+        Image.new("RGB", size).save(fn)
+        os.makedirs(os.path.join(main.MAP_DIR, "intel/i8080",
+                                 "mcmaster_" + flavor),
+                    exist_ok=True)
+        return fn
+
+    def test_default_paths(self):
+        """
+        State isn't relative to wherever the process was started
+        """
+        self.assertTrue(os.path.isabs(self.settings["STATE_DB"]))
+        self.assertTrue(os.path.isabs(self.settings["BACKFILL_JOURNAL"]))
+
+    def test_gallery_heap(self):
+        """
+        Only the newest thumbnails are kept, regenerated ones move up
+        """
+        gallery = main.Gallery(size=3)
+        for i in range(5):
+            self.assertTrue(gallery.add("t%u" % i, mtime=i))
+        self.assertEqual(gallery.newest(), ["t4", "t3", "t2"])
+        self.assertFalse(gallery.add("old", mtime=0))
+        self.assertFalse(gallery.add("t3", mtime=3))
+        self.assertTrue(gallery.add("t2", mtime=10))
+        self.assertEqual(gallery.newest(), ["t2", "t4", "t3"])
+        self.assertEqual(len(gallery.heap), 3)
+        self.assertEqual(sorted(gallery.mtimes), ["t2", "t3", "t4"])
+
+    def test_debounce(self):
+        """
+        A burst is processed once it goes quiet, or after DEBOUNCE_MAX_S
+        """
+        handler = main.event_handler(None, main.Gallery())
+        self.assertFalse(handler.ready())
+        # Only single/ images are queued
+        handler.queue(os.path.join(main.MAP_DIR, "intel/i8080/mz/l1/0/0_0.jpg"))
+        self.assertFalse(handler.ready())
+        handler.queue(os.path.join(self.single_dir, "intel_i8080_mz.jpg"))
+        self.assertFalse(handler.ready())
+        handler.last_event = monotonic() - main.DEBOUNCE_S
+        self.assertTrue(handler.ready())
+
+        # Events keep trickling in
+        handler.last_event = monotonic()
+        handler.first_event = monotonic() - main.DEBOUNCE_MAX_S
+        self.assertTrue(handler.ready())
+
+        fn = self.image("mz")
+        handler.pending = set([fn])
+        handler.flush()
+        self.assertFalse(handler.ready())
+        self.assertEqual(handler.gallery.newest(), [main.thumb_name(fn)])
+        self.assertTrue(os.path.exists(main.THUMBFILELIST))
+
+    def test_backfill_budget_journal(self):
+        """
+        Everything gets done even over budget, --force passes resume
+        """
+        fns = [self.image(flavor) for flavor in ("mz", "mit20x", "top")]
+        # Smaller than any one image: one at a time
+        got = main.backfill(fns, jobs=2, mem_budget=1)
+        self.assertEqual(got, dict((fn, main.thumb_name(fn)) for fn in fns))
+        for fn in fns:
+            self.assertTrue(os.path.exists(main.thumb_name(fn)))
+
+        # Interrupted --force pass already redid the first one
+        os.makedirs(os.path.dirname(main.BACKFILL_JOURNAL))
+        with open(main.BACKFILL_JOURNAL, "w") as f:
+            f.write(fns[0] + "\n")
+        for fn in fns:
+            os.unlink(main.thumb_name(fn))
+        got = main.backfill(fns, force=True, jobs=2)
+        self.assertEqual(sorted(got), sorted(fns))
+        self.assertFalse(os.path.exists(main.thumb_name(fns[0])))
+        self.assertTrue(os.path.exists(main.thumb_name(fns[1])))
+        # Pass finished, next one starts over
+        self.assertFalse(os.path.exists(main.BACKFILL_JOURNAL))
+
+    def test_state_db_prune(self):
+        """
+        Only changed sources are redone, orphaned thumbnails removed
+        """
+        a_fn = self.image("mz")
+        main.thumb(a_fn)
+        orphan_fn = os.path.join(self.single_dir,
+                                 "intel_i8080_mcmaster_gone.thumb.jpg")
+        Image.new("RGB", (10, 10)).save(orphan_fn)
+        b_fn = self.image("top")
+
+        state = main.StateDB(main.STATE_DB)
+        todo, stale, current = main.scan_single_dir(state, self.single_dir)
+        self.assertEqual(todo, [b_fn])
+        self.assertEqual(stale, set())
+        self.assertEqual(list(current), [a_fn])
+        self.assertFalse(os.path.exists(orphan_fn))
+        size, mtime, thumbpath, thumb_mtime = current[a_fn]
+        state.set_source(a_fn, size, mtime, thumbpath, thumb_mtime)
+
+        # Replaced in place
+        Image.new("RGB", (500, 100)).save(a_fn)
+        main.thumb(b_fn)
+        todo, stale, current = main.scan_single_dir(state, self.single_dir)
+        self.assertEqual(todo, [a_fn])
+        self.assertEqual(stale, set([a_fn]))
+
+        os.unlink(a_fn)
+        main.scan_single_dir(state, self.single_dir)
+        self.assertEqual(state.sources_in(self.single_dir), {})
+        self.assertFalse(os.path.exists(main.thumb_name(a_fn)))
+        state.close()
+
+    def test_manual_mode(self):
+        """
+        Second run finds nothing to do, gallery lists every thumbnail
+        """
+        fns = [self.image(flavor) for flavor in ("mz", "top")]
+        main.mode_manual()
+        for fn in fns:
+            self.assertTrue(os.path.exists(main.thumb_name(fn)))
+        with open(main.THUMBFILELIST) as f:
+            lines = f.read().split("\n")
+        self.assertEqual(len(lines), 2)
+
+        state = main.StateDB(main.STATE_DB)
+        self.assertEqual(sorted(state.sources_in(self.single_dir)), fns)
+        self.assertEqual(list(state.dir_mtimes()), [self.single_dir])
+        state.close()
+        mtime = os.path.getmtime(main.thumb_name(fns[0]))
+        main.mode_manual()
+        self.assertEqual(os.path.getmtime(main.thumb_name(fns[0])), mtime)
+
+    def test_manual_mode_source_removed(self):
+        """
+        A source renamed away during the backfill doesn't stop the refresh
+        """
+        fns = [self.image(flavor) for flavor in ("mz", "top")]
+        backfill = main.backfill
+
+        def backfill_rename(*args, **kwargs):
+            ret = backfill(*args, **kwargs)
+            os.unlink(fns[0])
+            os.unlink(main.thumb_name(fns[0]))
+            return ret
+
+        with mock.patch.object(main, "backfill", backfill_rename):
+            main.mode_manual()
+        state = main.StateDB(main.STATE_DB)
+        self.assertEqual(list(state.sources_in(self.single_dir)), [fns[1]])
+        state.close()
+        with open(main.THUMBFILELIST) as f:
+            self.assertEqual(len(f.read().split("\n")), 1)
+
+    def test_variants_feed(self):
+        """
+        Sized variants are generated and listed in gallery.json
+        """
+        main.THUMB_VARIANTS = True
+        main.VARIANT_FORMATS = [x for x in main.VARIANT_FORMATS
+                                if x[0] == "jpg"]
+        fn = self.image("mz", size=(1000, 500))
+        thumbpath = main.thumb(fn)
+        self.assertFalse(main.thumbs_missing(fn))
+        for size, _ext, variant_fn in main.variant_names(fn):
+            with Image.open(variant_fn) as im:
+                self.assertEqual(im.size, (size, size // 2))
+
+        gallery = main.Gallery()
+        gallery.add(thumbpath)
+        main.thumbfilelist(gallery)
+        with open(main.THUMBFEED) as f:
+            feed = json.load(f)
+        self.assertEqual(len(feed), 1)
+        self.assertEqual([x["size"] for x in feed[0]["variants"]],
+                         list(main.VARIANT_SIZES))
+
+        # Later refreshes without --variants must not leave it stale
+        main.THUMB_VARIANTS = False
+        os.unlink(thumbpath)
+        gallery = main.Gallery()
+        gallery.add(main.thumb(self.image("top")))
+        main.thumbfilelist(gallery)
+        with open(main.THUMBFEED) as f:
+            feed = json.load(f)
+        self.assertEqual(len(feed), 1)
+        self.assertEqual(feed[0]["variants"], [])
+
+
+if __name__ == "__main__":
+    unittest.main()  # run all tests
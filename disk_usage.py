@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Disk usage by collection / vendor / chip from the usage index
+(see siprawn.usage) instead of a du over everything
+
+disk_usage.py
+disk_usage.py --by chip --limit 20
+disk_usage.py --reconcile --jobs 8
+disk_usage.py --quota
+"""
+
+import sys
+from siprawn import usage
+
+
+def format_size(nbytes):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if nbytes < 1024:
+            return "%0.1f %s" % (nbytes, unit)
+        nbytes /= 1024
+    return "%0.1f TiB" % nbytes
+
+
+def run(by="collection",
+        limit=None,
+        reconcile=False,
+        quota=False,
+        usage_fn=None,
+        quotas_fn=None,
+        jobs=1):
+    """
+    Return number of collections over quota
+    """
+    if reconcile:
+        print("Reconciling...")
+        drift = usage.reconcile(fn=usage_fn, jobs=jobs)
+        print("Drifted entries: %u" % drift)
+        print("")
+
+    rows = usage.summary(by, fn=usage_fn)
+    if limit:
+        rows = rows[:limit]
+    for row in rows:
+        key = "/".join(row[:-2])
+        print("%-40s %12s %10u files" % (key, format_size(row[-2]), row[-1]))
+
+    if not quota:
+        return 0
+    over = usage.over_quota(usage.load_quotas(quotas_fn), fn=usage_fn)
+    print("")
+    for collection, nbytes, limit_ in over:
+        print("OVER QUOTA: %s: %s / %s" %
+              (collection, format_size(nbytes), format_size(limit_)))
+    print("Collections over quota: %u" % len(over))
+    return len(over)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Disk usage by collection, vendor or chip")
+    parser.add_argument("--by",
+                        choices=sorted(usage.BY_COLUMNS),
+                        default="collection")
+    parser.add_argument("--limit", type=int, help="Only show the largest N")
+    parser.add_argument("--reconcile",
+                        action="store_true",
+                        help="Rescan /map and wiki media to fix drift first")
+    parser.add_argument("--quota",
+                        action="store_true",
+                        help="Check collection quotas, exit 1 if any over")
+    parser.add_argument("--usage", help="Usage DB (default: lib/usage.db)")
+    parser.add_argument("--quotas",
+                        help="Quota JSON (default: lib/quotas.json)")
+    parser.add_argument("--jobs",
+                        type=int,
+                        default=1,
+                        help="Chip dirs to scan in parallel on --reconcile")
+    args = parser.parse_args()
+    over = run(by=args.by,
+               limit=args.limit,
+               reconcile=args.reconcile,
+               quota=args.quota,
+               usage_fn=args.usage,
+               quotas_fn=args.quotas,
+               jobs=args.jobs)
+    if over:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,63 +15,145 @@ to do this:
 -if replace:
     wriew .new
     move previous to .orig
+
+Whole archive:
+fixmap.py --all --report fixmap.json [--jobs N] [--apply]
+--apply keeps the old metadata in fixmap.json.journal as it goes
 """
 
 import subprocess
 import re
 import os
-import glob
 import json
-import prawnmap
-from prawnmap.groupxiv import GroupXIV
+import math
+from PIL import Image
 from prawnmap.groupxiv import write_js_meta
-from prawnmap.map import ImageMapSource
 from siprawn import env
+from siprawn import viewer
+from siprawn import walk
 import shutil
 import copy
-import img2doku
+import functools
+
+# Default GroupXIV tile size
+TILE_SIZE = 250
+
+# Maps are huge, don't trip decompression bomb checks
+Image.MAX_IMAGE_PIXELS = None
 
 
-def extract_html_meta(fn):
+def image_size(img_fn):
     """
-    initViewer({"tilesAlignedTopLeft": true, "scale": null, "layers": [{"imageSize": 4096, "tileExt": ".jpg", "width": 31000, "height": 31000, "URL": "l1", "tileSize": 250, "name": "???", "copyright": "2018 John McMaster, CC BY"}], "name": "out, &copy;2018 John McMaster, CC BY", "name_raw": "out"});
+    Return (width, height) reading only the image header
     """
-    for l in open(fn, "r"):
-        if "initViewer" in l:
-            break
-    else:
-        raise Exception("Failed to find initViewer")
-    l = l.strip()
-    l = l.replace("initViewer(", "")
-    # remove );
-    l = l[:-2]
-    j = json.loads(l)
-    return j
+    with Image.open(img_fn) as im:
+        return im.size
 
 
-def img2j(img_fn):
-    tmp_dir = "/tmp/img2j"
-    if os.path.exists(tmp_dir):
-        shutil.rmtree(tmp_dir)
+def groupxiv_image_size(width, height, tile_size=TILE_SIZE):
+    """
+    GroupXIV zooms by powers of 2 from one tile
+    so the virtual image is the smallest such square covering the image
+    ex: 30811 x 30989 w/ 250 tiles => 250 * 2**7 = 32000
+    """
+    tiles = max(width, height) / tile_size
+    zoom = math.ceil(math.log2(tiles)) if tiles > 1 else 0
+    return tile_size * 2**zoom
 
-    try:
-        # Scraped from prawnmap.main
-        source = ImageMapSource(img_fn, threads=1)
-        m = GroupXIV(source, copyright_="copyright")
-        m.set_title("title")
-        m.set_js_only(True)
-        m.set_skip_missing(True)
-        m.set_out_dir(tmp_dir)
-        m.set_im_ext(None)
-
-        m.run()
-
-        j = extract_html_meta(tmp_dir + "/index.html")
-    finally:
-        if os.path.exists(tmp_dir):
-            shutil.rmtree(tmp_dir)
 
-    return j
+def img2j(img_fn, tile_size=TILE_SIZE):
+    """
+    Viewer metadata GroupXIV would generate for img_fn
+    Only the fields fixmap compares
+    """
+    width, height = image_size(img_fn)
+    return {
+        "layers": [{
+            "imageSize": groupxiv_image_size(width, height, tile_size),
+            "width": width,
+            "height": height,
+            "tileSize": tile_size,
+            "name": os.path.splitext(os.path.basename(img_fn))[0],
+        }],
+    }
+
+
+def fix_meta(j_html, j_img, verbose=True):
+    """
+    Return corrected viewer metadata
+    j_html: current page metadata, must have a single layer
+    j_img: img2j() of the source image
+    """
+    l1i = j_img["layers"][0]
+    # Base it on the existing data, but tweak as needed
+    j_new = copy.deepcopy(j_html)
+    l1n = j_new["layers"][0]
+
+    # Fix image pan parameters
+    # This is the most visible problem
+    l1n["imageSize"] = l1i["imageSize"]
+    l1n["width"] = l1i["width"]
+    l1n["height"] = l1i["height"]
+
+    # Some old metadata not needed anymore
+    if "name_raw" in j_new:
+        verbose and print("Deleteing name_raw: %s" % j_new["name_raw"])
+        del j_new["name_raw"]
+    """
+    Move copyright from top to layer
+    initViewer({"tilesAlignedTopLeft": true, "scale": null, "layers":
+        [{"imageSize": 32000, "tileExt": ".jpg", "width": 18393, "height": 13492, "URL": "l1", "tileSize": 250, "name": "ti_tms9918an_mz_mit20x, &copy; 2020 John McMaster, CC-BY"}],
+        "name": "???", "name_raw": "None", "copyright": "&copy; 2020 John McMaster, CC-BY"});
+    """
+    if "copyright" in j_new:
+        if "copyright" in l1n:
+            raise Exception("FIXME: might be overwriting copyright info")
+        # "copyright": "&copy; 2020 John McMaster, CC-BY"
+        copyright_ = j_new["copyright"]
+        copyright_ = copyright_.replace("&copy; ", "")
+        l1n["copyright"] = copyright_
+        del j_new["copyright"]
+
+    if j_new["name"] == "???":
+        new_name = l1i["name"]
+        verbose and print("New layer name: %s" % new_name)
+        j_new["name"] = new_name
+        l1n["name"] = new_name
+
+    # Fix copyright string in name
+    # I believe this was transitional hack before GroupXIV added this natively
+    # It seems these also have "copyright" set, so just need to trim out extra
+    # 'name': 'out, &copy;2018 John McMaster, CC BY'
+    if "&copy;" in j_new["name"]:
+        if "copyright" not in l1n:
+            raise Exception("FIXME: might be losing copyright info")
+        # A lot of the names here are just "out"
+        new_name = l1i["name"]
+        verbose and print("New layer name: %s" % new_name)
+        j_new["name"] = new_name
+        l1n["name"] = new_name
+
+    return j_new
+
+
+def meta_diff(j_old, j_new):
+    """
+    Return dict of changed field to [old, new]
+    ex: {"layers[0].imageSize": [4096, 32000]}
+    """
+    ret = {}
+
+    def diff(prefix, old, new):
+        for k in sorted(set(old) | set(new)):
+            if k == "layers":
+                continue
+            if old.get(k) != new.get(k):
+                ret[prefix + k] = [old.get(k), new.get(k)]
+
+    diff("", j_old, j_new)
+    for i, (old, new) in enumerate(zip(j_old["layers"], j_new["layers"])):
+        diff("layers[%u]." % i, old, new)
+    return ret
 
 
 def shift_existing_fn(fn):
@@ -87,10 +169,11 @@ def shift_existing_fn(fn):
         i += 1
 
 
-def run(map_dir, dry=False, verbose=False):
+def run(map_dir, dry=False, verbose=False, index=None):
     """
     It's better to look at images to dirs
     Doesn't always go the other way
+    index: viewer.ViewerIndex to reuse previous parses
     """
     print("")
     print("")
@@ -98,26 +181,58 @@ def run(map_dir, dry=False, verbose=False):
     print("")
     print("")
     print("")
-    for img_fn in glob.glob(map_dir + "/single/*.jpg"):
-        if ".thumb.jpg" in img_fn:
-            continue
+    vendor = os.path.basename(os.path.dirname(os.path.abspath(map_dir)))
+    chipid = os.path.basename(os.path.abspath(map_dir))
+    records = walk.scan_chip(vendor, chipid, map_dir)
+    for img_record, map_record in map_pairs(records):
+        img_fn = img_record.path
         print("")
         print("")
         print("")
         print("Checking %s" % img_fn)
-        _fnbase, _vendor, _chipid, flavor = img2doku.parse_image_name(img_fn)
-        html_fn = map_dir + "/" + flavor + "/index.html"
-        if not os.path.isfile(html_fn):
-            print("WARNING: could not find HTML: %s" % html_fn)
+        if not map_record:
+            print("WARNING: could not find HTML for %s" % img_fn)
+            continue
+        run_pair(img_fn=img_fn,
+                 html_fn=os.path.join(map_record.path, "index.html"),
+                 dry=dry,
+                 verbose=verbose,
+                 index=index)
+
+
+def map_pairs(records):
+    """
+    Match a chip's single/ images to the maps generated from them
+    Yield (image record, map dir record or None)
+
+    single/<vendor>_<chipid>_<collection>_<flavor>.jpg => <collection>_<flavor>/
+    Older unattributed names work the same way
+    single/<vendor>_<chipid>_<flavor>.jpg => <flavor>/
+    """
+    maps = dict((record.name, record) for record in records
+                if record.type == walk.MAP_DIR)
+    for record in records:
+        if record.type != walk.SINGLE_IMAGE:
+            continue
+        # Any thumbnail variant
+        if ".thumb." in record.name or not record.name.endswith(".jpg"):
             continue
-        run_pair(img_fn=img_fn, html_fn=html_fn, dry=dry, verbose=verbose)
+        prefix = "%s_%s_" % (record.vendor, record.chipid)
+        stem = record.name[:-len(".jpg")]
+        if not stem.startswith(prefix):
+            continue
+        yield record, maps.get(stem[len(prefix):])
 
 
-def run_pair(img_fn, html_fn, dry=False, verbose=False):
+def run_pair(img_fn, html_fn, dry=False, verbose=False, index=None):
     print("Extracting old HTML")
-    j_html = extract_html_meta(html_fn)
-    print("Generating new HTML")
-    j_img = img2j(img_fn)
+    if index:
+        j_html = index.get(html_fn)
+    else:
+        j_html = viewer.read_viewer_meta(html_fn)
+    print("Probing image")
+    j_img = img2j(img_fn,
+                  tile_size=j_html["layers"][0].get("tileSize", TILE_SIZE))
 
     print("")
 
@@ -177,54 +292,7 @@ def run_pair(img_fn, html_fn, dry=False, verbose=False):
         return
     """
 
-    # Base it on the existing data, but tweak as needed
-    j_new = copy.deepcopy(j_html)
-    l1n = j_new["layers"][0]
-
-    # Fix image pan parameters
-    # This is the most visible problem
-    l1n["imageSize"] = l1i["imageSize"]
-    l1n["width"] = l1i["width"]
-    l1n["height"] = l1i["height"]
-
-    # Some old metadata not needed anymore
-    if "name_raw" in j_new:
-        print("Deleteing name_raw: %s" % j_new["name_raw"])
-        del j_new["name_raw"]
-    """
-    Move copyright from top to layer
-    initViewer({"tilesAlignedTopLeft": true, "scale": null, "layers":
-        [{"imageSize": 32000, "tileExt": ".jpg", "width": 18393, "height": 13492, "URL": "l1", "tileSize": 250, "name": "ti_tms9918an_mz_mit20x, &copy; 2020 John McMaster, CC-BY"}],
-        "name": "???", "name_raw": "None", "copyright": "&copy; 2020 John McMaster, CC-BY"});
-    """
-    if "copyright" in j_new:
-        if "copyright" in l1n:
-            raise Exception("FIXME: might be overwriting copyright info")
-        # "copyright": "&copy; 2020 John McMaster, CC-BY"
-        copyright_ = j_new["copyright"]
-        copyright_ = copyright.replace("&copy; ", "")
-        l1n["copyright"] = copyright_
-        del j_new["copyright"]
-
-    if j_new["name"] == "???":
-        new_name = l1i["name"]
-        print("New layer name: %s" % new_name)
-        j_new["name"] = new_name
-        l1n["name"] = new_name
-
-    # Fix copyright string in name
-    # I believe this was transitional hack before GroupXIV added this natively
-    # It seems these also have "copyright" set, so just need to trim out extra
-    # 'name': 'out, &copy;2018 John McMaster, CC BY'
-    if "&copy;" in j_new["name"]:
-        if "copyright" not in l1n:
-            raise Exception("FIXME: might be losing copyright info")
-        # A lot of the names here are just "out"
-        new_name = l1i["name"]
-        print("New layer name: %s" % new_name)
-        j_new["name"] = new_name
-        l1n["name"] = new_name
-
+    j_new = fix_meta(j_html, j_img)
     print("")
     print("final")
     print(j_new)
@@ -236,6 +304,147 @@ def run_pair(img_fn, html_fn, dry=False, verbose=False):
         write_js_meta(html_fn, j_new, url_base=env.MAP_URL_BASE)
 
 
+def check_pair(img_fn, html_fn, index):
+    """
+    Return (old metadata, fixed metadata, changed fields)
+    """
+    j_html = index.get(html_fn)
+    if len(j_html["layers"]) != 1:
+        raise Exception("non-standard layer stackup")
+    j_img = img2j(img_fn,
+                  tile_size=j_html["layers"][0].get("tileSize", TILE_SIZE))
+    j_new = fix_meta(j_html, j_img, verbose=False)
+    return j_html, j_new, meta_diff(j_html, j_new)
+
+
+# Set by load_viewer_index() in each worker
+g_viewer_index = None
+
+
+def load_viewer_index(fn):
+    global g_viewer_index
+    g_viewer_index = viewer.ViewerIndex(fn)
+
+
+def check_chip(records):
+    """
+    Compare every map in a chip dir against its source image
+    Return (report entries, new viewer index entries)
+
+    Only maps that need a change or failed are reported
+    """
+    ret = []
+    for img_record, map_record in map_pairs(records):
+        if not map_record:
+            continue
+        entry = {
+            "vendor": img_record.vendor,
+            "chipid": img_record.chipid,
+            "map": map_record.name,
+            "image": img_record.name,
+            "path": map_record.path,
+        }
+        html_fn = os.path.join(map_record.path, "index.html")
+        try:
+            j_old, j_new, diffs = check_pair(img_record.path, html_fn,
+                                             g_viewer_index)
+        except Exception as e:
+            entry["error"] = "%s: %s" % (type(e).__name__, e)
+            print("%s: ERROR %s" % (map_record.path, entry["error"]))
+            ret.append(entry)
+            continue
+        if not diffs:
+            continue
+        entry["diffs"] = diffs
+        entry["old"] = j_old
+        entry["new"] = j_new
+        print("%s: %s" % (map_record.path, ", ".join(sorted(diffs))))
+        ret.append(entry)
+    return ret, g_viewer_index.take_new()
+
+
+def journal_fn(report_fn):
+    return report_fn + ".journal"
+
+
+def apply_entries(entries, journal):
+    """
+    Fix the mismatched maps of one chip
+    Their old metadata is appended to the journal (and synced) before any
+    index.html is touched so an interrupted run loses nothing
+    """
+    todo = [entry for entry in entries if "diffs" in entry]
+    if not todo:
+        return
+    for entry in todo:
+        journal.write(json.dumps(entry, sort_keys=True) + "\n")
+    journal.flush()
+    os.fsync(journal.fileno())
+    for entry in todo:
+        html_fn = os.path.join(entry["path"], "index.html")
+        try:
+            write_js_meta(html_fn, entry["new"], url_base=env.MAP_URL_BASE)
+        except Exception as e:
+            entry["error"] = "%s: %s" % (type(e).__name__, e)
+            print("%s: ERROR %s" % (entry["path"], entry["error"]))
+            continue
+        entry["applied"] = True
+
+
+def run_all(report_fn,
+            apply=False,
+            map_dir=None,
+            vendor=None,
+            chipid=None,
+            jobs=1,
+            viewer_index_fn=viewer.VIEWER_INDEX_FN):
+    """
+    Check (and optionally fix) every map under map_dir (default env.MAP_DIR)
+    Write a JSON report of mismatches and errors to report_fn
+
+    Fixing keeps the old metadata in the report, and as it goes in
+    <report>.journal (appended to, never truncated), instead of
+    index.html.N backups
+    """
+    index = viewer.ViewerIndex(viewer_index_fn)
+    entries = []
+    journal = open(journal_fn(report_fn), "a") if apply else None
+    try:
+        for chip_entries, new in walk.map_chips(
+                check_chip,
+                map_dir=map_dir,
+                vendor=vendor,
+                chipid=chipid,
+                jobs=jobs,
+                initializer=load_viewer_index,
+                initargs=(viewer_index_fn, )):
+            if apply:
+                apply_entries(chip_entries, journal)
+            entries += chip_entries
+            index.merge(new)
+    finally:
+        if journal:
+            journal.close()
+        index.save()
+
+    mismatches = [entry for entry in entries if "diffs" in entry]
+    errors = [entry for entry in entries if "error" in entry]
+    j = {
+        "applied": apply,
+        "mismatches": mismatches,
+        "errors": errors,
+    }
+    with open(report_fn + ".tmp", "w") as f:
+        json.dump(j, f, sort_keys=True, indent=4, separators=(',', ': '))
+    os.replace(report_fn + ".tmp", report_fn)
+    print("")
+    print("Mismatched maps: %u%s" % (len(mismatches),
+                                     " (fixed)" if apply else ""))
+    print("Errors: %u" % len(errors))
+    print("Wrote %s" % report_fn)
+    return j
+
+
 def add_bool_arg(parser, yes_arg, default=False, **kwargs):
     dashed = yes_arg.replace('--', '')
     dest = dashed.replace('-', '_')
@@ -258,10 +467,37 @@ def main():
                         action="store_true",
                         help="Verbose output")
     parser.add_argument("--dry", action="store_true", help="Don't write")
-    parser.add_argument("map_dir")
+    parser.add_argument("--viewer-index",
+                        default=viewer.VIEWER_INDEX_FN,
+                        help="Cache of parsed index.html metadata")
+    parser.add_argument("--all",
+                        action="store_true",
+                        help="Check every map under the map dir")
+    parser.add_argument("--report",
+                        default="fixmap.json",
+                        help="--all: mismatch report")
+    parser.add_argument("--apply",
+                        action="store_true",
+                        help="--all: fix mismatched maps")
+    walk.add_walk_args(parser)
+    parser.add_argument("map_dir", nargs="?", help="Single chip dir")
     args = parser.parse_args()
-    run(map_dir=args.map_dir, dry=args.dry, verbose=args.verbose)
-
+    if args.all:
+        run_all(report_fn=args.report,
+                apply=args.apply,
+                viewer_index_fn=args.viewer_index,
+                **walk.walk_kwargs(args))
+        return
+    if not args.map_dir:
+        parser.error("map_dir required without --all")
+    index = viewer.ViewerIndex(args.viewer_index)
+    try:
+        run(map_dir=args.map_dir,
+            dry=args.dry,
+            verbose=args.verbose,
+            index=index)
+    finally:
+        index.save()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Backfill: hardlink identical tiles in existing maps (see siprawn.dedup)
+
+map_dedup.py --no-dry
+map_dedup.py --scope collection --no-dry
+"""
+
+import functools
+import traceback
+from siprawn import util
+from siprawn import walk
+from siprawn import dedup
+
+
+def run_chip(records, dry=True):
+    stats = dedup.new_stats()
+    for record in records:
+        if record.type != walk.MAP_DIR:
+            continue
+        try:
+            map_stats = dedup.dedup_map(record.path, dry=dry)
+        except Exception:
+            print("%s: ERROR" % record.path)
+            traceback.print_exc()
+            stats["errors"] += 1
+            continue
+        if map_stats["duplicates"] or map_stats["errors"]:
+            print("%s: %s" % (record.path, dedup.format_stats(map_stats)))
+        dedup.add_stats(stats, map_stats)
+    return stats
+
+
+def run_collection(item, dry=True):
+    collection, map_dirs = item
+    try:
+        stats = dedup.dedup_maps(map_dirs, dry=dry)
+    except Exception:
+        print("%s: ERROR" % collection)
+        traceback.print_exc()
+        stats = dedup.new_stats()
+        stats["errors"] += 1
+        return stats
+    print("%s: %u maps, %s" %
+          (collection, len(map_dirs), dedup.format_stats(stats)))
+    return stats
+
+
+def run(scope="map", dry=True, vendor=None, chipid=None, jobs=1):
+    stats = dedup.new_stats()
+    if scope == "map":
+        results = walk.map_chips(functools.partial(run_chip, dry=dry),
+                                 vendor=vendor,
+                                 chipid=chipid,
+                                 jobs=jobs)
+    else:
+        collections = {}
+        for record in walk.walk(vendor=vendor, chipid=chipid):
+            if record.type == walk.MAP_DIR:
+                collections.setdefault(walk.map_collection(record.name),
+                                       []).append(record.path)
+        results = walk.ordered_map(functools.partial(run_collection, dry=dry),
+                                   sorted(collections.items()),
+                                   jobs=jobs)
+    for result in results:
+        dedup.add_stats(stats, result)
+    print("")
+    print("Total: " + dedup.format_stats(stats))
+    if dry:
+        print("dry: nothing linked")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Hardlink byte identical map tiles")
+    util.add_bool_arg(parser, "--dry", default=True)
+    parser.add_argument("--scope",
+                        choices=["map", "collection"],
+                        default="map",
+                        help="Look for duplicates within each map or "
+                        "across each collection's maps")
+    walk.add_walk_args(parser)
+    args = parser.parse_args()
+    run(scope=args.scope, dry=args.dry, **walk.walk_kwargs(args))
+
+
+if __name__ == "__main__":
+    main()
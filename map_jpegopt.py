@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Losslessly re-optimize existing map tiles (see siprawn.jpegopt)
+
+Finished maps are appended to a state file so an interrupted run picks
+up where it left off:
+{"map": "/var/www/map/intel/80502/mcmaster_mz", "collection": "mcmaster", ...}
+
+map_jpegopt.py --jobs 8 --no-dry
+map_jpegopt.py --report
+"""
+
+import fcntl
+import functools
+import json
+import os
+from siprawn import util
+from siprawn import walk
+from siprawn import jpegopt
+
+STATE_FN = os.path.expanduser("~/.cache/siprawn/jpegopt.jsonl")
+
+
+def load_state(fn):
+    """
+    Return map dir => state record
+    """
+    ret = {}
+    if not os.path.exists(fn):
+        return ret
+    with open(fn, "r") as f:
+        for l in f:
+            # Partial line from an interrupted run, that map is redone
+            try:
+                j = json.loads(l)
+            except ValueError:
+                continue
+            ret[j["map"]] = j
+    return ret
+
+
+# Set per worker by load_done()
+g_done = None
+
+
+def load_done(state_fn):
+    global g_done
+    g_done = set(load_state(state_fn))
+
+
+def append_state(state_fn, j):
+    """
+    Workers append as each map finishes, locked so lines don't interleave
+    """
+    with open(state_fn, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(json.dumps(j, sort_keys=True) + "\n")
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def run_maps(map_dirs, dry=True, state_fn=None):
+    """
+    Return [state record] for maps not done yet
+    Each is saved to state_fn as soon as its map is finished
+    """
+    map_dirs = [x for x in map_dirs if x not in g_done]
+    ret = []
+    for map_dir, stats in jpegopt.iter_optimize_maps(map_dirs, dry=dry):
+        print("%s: %s" % (map_dir, jpegopt.format_stats(stats)))
+        j = dict(stats)
+        j["map"] = map_dir
+        j["collection"] = walk.map_collection(os.path.basename(map_dir))
+        # Maps with errors are retried next run
+        if not dry and state_fn and not j["errors"]:
+            append_state(state_fn, j)
+        ret.append(j)
+    return ret
+
+
+def run_chip(records, dry=True, state_fn=None):
+    return run_maps(
+        [record.path for record in records if record.type == walk.MAP_DIR],
+        dry=dry,
+        state_fn=state_fn)
+
+
+def report(records):
+    """
+    Print savings per collection
+    """
+    collections = {}
+    for j in records:
+        stats = collections.setdefault(j["collection"], {})
+        jpegopt.add_stats(
+            stats,
+            dict((k, v) for k, v in j.items()
+                 if k not in ("map", "collection")))
+    total = {}
+    for collection, stats in sorted(collections.items()):
+        print("%s: %s, %0.1f MiB less served" %
+              (collection, jpegopt.format_stats(stats),
+               stats["served_saved"] / 1024 / 1024))
+        jpegopt.add_stats(total, stats)
+    if total:
+        print("Total: %s, %0.1f MiB less served" %
+              (jpegopt.format_stats(total),
+               total["served_saved"] / 1024 / 1024))
+
+
+def run(dry=True,
+        scope="map",
+        state_fn=STATE_FN,
+        vendor=None,
+        chipid=None,
+        jobs=1):
+    jpegopt.check_jpegtran()
+    if not dry:
+        os.makedirs(os.path.dirname(state_fn), exist_ok=True)
+    if scope == "map":
+        results = walk.map_chips(functools.partial(run_chip,
+                                                   dry=dry,
+                                                   state_fn=state_fn),
+                                 vendor=vendor,
+                                 chipid=chipid,
+                                 jobs=jobs,
+                                 initializer=load_done,
+                                 initargs=(state_fn, ))
+    else:
+        collections = {}
+        for record in walk.walk(vendor=vendor, chipid=chipid):
+            if record.type == walk.MAP_DIR:
+                collections.setdefault(walk.map_collection(record.name),
+                                       []).append(record.path)
+        results = walk.ordered_map(functools.partial(run_maps,
+                                                     dry=dry,
+                                                     state_fn=state_fn),
+                                   [x[1] for x in sorted(collections.items())],
+                                   jobs=jobs,
+                                   initializer=load_done,
+                                   initargs=(state_fn, ))
+
+    records = []
+    for result in results:
+        records += result
+    print("")
+    print("This run")
+    report(records)
+    if dry:
+        print("dry: nothing replaced")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Losslessly re-optimize map tile JPEGs")
+    util.add_bool_arg(parser, "--dry", default=True)
+    parser.add_argument("--scope",
+                        choices=["map", "collection"],
+                        default="map",
+                        help="Process maps per chip, or each collection "
+                        "together to keep hardlinks made across its maps")
+    parser.add_argument("--state",
+                        default=STATE_FN,
+                        help="Finished maps, to resume and for --report")
+    parser.add_argument("--report",
+                        action="store_true",
+                        help="Only print savings so far per collection")
+    walk.add_walk_args(parser)
+    args = parser.parse_args()
+    if args.report:
+        report(load_state(args.state).values())
+        return
+    run(dry=args.dry,
+        scope=args.scope,
+        state_fn=args.state,
+        **walk.walk_kwargs(args))
+
+
+if __name__ == "__main__":
+    main()
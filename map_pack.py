@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Convert existing maps to packed tiles (one file per zoom level)
+Packed maps need tile_server.py to be viewed
+
+map_pack.py --no-dry
+map_pack.py --vendor intel --chipid 80502 --no-dry
+map_pack.py --unpack --no-dry
+"""
+
+import functools
+import traceback
+from siprawn import util
+from siprawn import walk
+from siprawn import tilepack
+
+
+def run_chip(records, dry=True, unpack=False):
+    """
+    Return (maps, tiles, bytes, errors)
+    """
+    nmaps = 0
+    ntiles = 0
+    nbytes = 0
+    errors = 0
+    for record in records:
+        if record.type != walk.MAP_DIR:
+            continue
+        try:
+            if unpack:
+                tiles = tilepack.unpack_map(record.path, dry=dry)
+                size = 0
+            else:
+                tiles, size = tilepack.pack_map(record.path, dry=dry)
+        except Exception:
+            print("%s: ERROR" % record.path)
+            traceback.print_exc()
+            errors += 1
+            continue
+        if not tiles:
+            continue
+        print("%s: %u tiles" % (record.path, tiles))
+        nmaps += 1
+        ntiles += tiles
+        nbytes += size
+    return nmaps, ntiles, nbytes, errors
+
+
+def run(dry=True, unpack=False, vendor=None, chipid=None, jobs=1):
+    nmaps = 0
+    ntiles = 0
+    nbytes = 0
+    errors = 0
+    fn = functools.partial(run_chip, dry=dry, unpack=unpack)
+    for maps, tiles, size, chip_errors in walk.map_chips(fn,
+                                                         vendor=vendor,
+                                                         chipid=chipid,
+                                                         jobs=jobs):
+        nmaps += maps
+        ntiles += tiles
+        nbytes += size
+        errors += chip_errors
+    print("")
+    print("Maps: %u" % nmaps)
+    print("Tiles: %u" % ntiles)
+    if not unpack:
+        print("Tile data: %0.1f MiB" % (nbytes / 1024 / 1024))
+    print("Errors: %u" % errors)
+    if dry:
+        print("dry: nothing changed")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Pack map tiles into one file per zoom level")
+    util.add_bool_arg(parser, "--dry", default=True)
+    parser.add_argument("--unpack",
+                        action="store_true",
+                        help="Convert packed maps back to tile files")
+    walk.add_walk_args(parser)
+    args = parser.parse_args()
+    run(dry=args.dry, unpack=args.unpack, **walk.walk_kwargs(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,155 @@
 #!/usr/bin/env python3
 
 import argparse
-from pathlib import Path
 import glob
 import os
 import datetime
 import json
 from collections import OrderedDict
 import requests
+from siprawn import env
 from siprawn import util
 import subprocess
 import hashlib
+import concurrent.futures
+import requests.adapters
+import shutil
+import time
+from PIL import Image
+
+# Shared between runs so unchanged images aren't rehashed
+HASH_CACHE_FN = "travis/hash_cache.json"
+# Big reads: these are multi GB TIFFs
+HASH_CHUNK = 16 * 1024 * 1024
+HASH_ALGORITHMS = ("sha1", "sha256")
+# Everything from this archive is credited to
+COLLECTION = "goodspeed"
+# Images already imported, see load_completed_db()
+COMPLETED_DB_FN = "travis/completed.json"
+# Input tree listings by dir mtime
+FIND_CACHE_FN = "travis/find_cache.json"
+CONVERT_QUALITY = 90
+# Scanlines vips keeps buffered when streaming a TIFF sequentially
+VIPS_WINDOW_LINES = 256
+VIPS_OVERHEAD = 64 * 1024 * 1024
+
+# Source TIFFs are huge stitches, don't trip decompression bomb checks
+Image.MAX_IMAGE_PIXELS = None
+
+
+def load_completed_db(dir_out="travis", fn=COMPLETED_DB_FN):
+    """
+    Images already imported, as
+    {src_image_rel: {"sha1": "...", "sha256": "...", "single_fn": "...",
+                     "run": "travis/2022-04-25_18-25-35"}}
 
+    Fed from run dirs: once a converted image is moved into a run's
+    uploaded/ dir, that run's parsed.json says what it came from
+    Persisted so cleaning up old run dirs doesn't forget anything
+    """
+    db = {}
+    if os.path.exists(fn):
+        db = json.load(open(fn, "r"))
+    added = 0
+    if os.path.exists(dir_out):
+        for run_dir in sorted(glob.glob(dir_out + "/*/")):
+            run_dir = run_dir.rstrip("/")
+            parsed_fn = run_dir + "/parsed.json"
+            uploaded_dir = run_dir + "/uploaded"
+            if not os.path.exists(parsed_fn) or not os.path.isdir(
+                    uploaded_dir):
+                continue
+            uploaded = set(os.listdir(uploaded_dir))
+            if not uploaded:
+                continue
+            for src_image_rel, entry in json.load(open(parsed_fn,
+                                                       "r")).items():
+                if entry["single_fn"] not in uploaded:
+                    continue
+                # Predates hashing, can't tell if it changed since
+                if "sha1sum" not in entry:
+                    continue
+                new = {
+                    "sha1": entry["sha1sum"],
+                    "sha256": entry.get("sha256sum"),
+                    "single_fn": entry["single_fn"],
+                    "run": run_dir,
+                }
+                if db.get(src_image_rel) != new:
+                    db[src_image_rel] = new
+                    added += 1
+    if added:
+        save_json(db, fn)
+    print("Completed DB: %u images (%u new)" % (len(db), added))
+    return db
+
+
+def is_completed(dir_in,
+                 src_image_rel,
+                 completed_images,
+                 hash_cache,
+                 hash_cache_fn=None):
+    """
+    Only counts if the image is still the one that was uploaded
+    ex: restitched since => import it again
+    A hash computed here goes into hash_cache (saved to hash_cache_fn)
+    so no later run or stage hashes it again
+    """
+    completed = completed_images.get(src_image_rel)
+    if not completed:
+        return False
+    src_image = os.path.realpath(dir_in + "/" + src_image_rel)
+    st = os.stat(src_image)
+    cached = hash_cache_get(hash_cache, src_image, st, algorithms=("sha1", ))
+    if not cached:
+        cached = hash_cache_add(hash_cache, src_image, st,
+                                hash_file(src_image))
+        if hash_cache_fn:
+            save_hash_cache(hash_cache, hash_cache_fn)
+    return cached["sha1"] == completed["sha1"]
+
+
+def scan_pto_dirs(dir_in, cache_fn=FIND_CACHE_FN):
+    """
+    Return dict of dir path to {"ptos": [...], "tifs": [...]}
+    for every dir with a .pto
 
-def load_completed_db():
-    return set()
+    Listings are cached by dir mtime so an unchanged dir costs a stat()
+    instead of a listdir() of all of its snap images
+    """
+    cache = {}
+    if os.path.exists(cache_fn):
+        cache = json.load(open(cache_fn, "r"))
+    new_cache = {}
+    ret = {}
+    listed = 0
+    todo = [dir_in]
+    while todo:
+        dir_path = todo.pop()
+        mtime = os.stat(dir_path).st_mtime
+        entry = cache.get(dir_path)
+        if not entry or entry["mtime"] != mtime:
+            listed += 1
+            entry = {"mtime": mtime, "subdirs": [], "ptos": [], "tifs": []}
+            with os.scandir(dir_path) as it:
+                for dirent in it:
+                    if dirent.is_dir():
+                        entry["subdirs"].append(dirent.name)
+                    elif dirent.name.endswith(".pto"):
+                        entry["ptos"].append(dirent.name)
+                    elif dirent.name.endswith(".tif"):
+                        entry["tifs"].append(dirent.name)
+        new_cache[dir_path] = entry
+        if entry["ptos"]:
+            ret[dir_path] = {
+                "ptos": [dir_path + "/" + x for x in sorted(entry["ptos"])],
+                "tifs": [dir_path + "/" + x for x in sorted(entry["tifs"])],
+            }
+        for subdir in entry["subdirs"]:
+            todo.append(dir_path + "/" + subdir)
+    print("Scanned %u dirs, %u changed" % (len(new_cache), listed))
+    save_json(new_cache, cache_fn)
+    return ret
 
 
 def load_patches():
@@ -47,7 +182,10 @@ def load_patches():
     }
 
 
-def find_images(dir_in, patches, verbose=False):
+def find_images(dir_in,
+                patches,
+                verbose=False,
+                find_cache_fn=FIND_CACHE_FN):
     """
     Find high resolution images in directories with .pto
     filter out the snap files and return the resulting remaining .tif
@@ -102,9 +240,14 @@ def find_images(dir_in, patches, verbose=False):
     def fail(msg):
         noks[mkrel(str(pto_path))] = msg
 
+    pto_dirs = scan_pto_dirs(dir_in, cache_fn=find_cache_fn)
+    pto_paths = []
+    for pto_dir in pto_dirs.values():
+        pto_paths.extend(pto_dir["ptos"])
+
     # scream if two .ptos in the same dir
     found_dirs = set()
-    for pto_path in sorted(Path(dir_in).rglob('*.pto')):
+    for pto_path in sorted(pto_paths):
         if 0 and str(
                 pto_path
         ) != "/home/mcmaster/buffer/ic/travis/goodchips2/microchip/pic18f452/top5x/top5x.pto":
@@ -133,7 +276,7 @@ def find_images(dir_in, patches, verbose=False):
         if use_image:
             hi_tif = dir_path + "/" + use_image
         else:
-            dir_tifs = glob.glob(dir_path + "/*.tif")
+            dir_tifs = list(pto_dirs[dir_path]["tifs"])
             dir_tifs = [
                 x for x in dir_tifs
                 if not os.path.basename(x).find("snap") == 0
@@ -241,12 +384,18 @@ def parse_image(image_path):
     return vendor, chipid, flavor, flagged
 
 
-def parse_images(dir_in, all_images, completed_images):
+def parse_images(dir_in,
+                 all_images,
+                 completed_images,
+                 hash_cache_fn=HASH_CACHE_FN):
+    hash_cache = load_hash_cache(hash_cache_fn)
+
     def mkrel(fn):
         return fn.replace(dir_in + "/", "")
 
     ret = OrderedDict()
     ok = 0
+    skipped = 0
     noks = {}
 
     def fail(msg):
@@ -254,7 +403,12 @@ def parse_images(dir_in, all_images, completed_images):
 
     for src_image in all_images:
         src_image_rel = mkrel(src_image)
-        if src_image_rel in completed_images:
+        if is_completed(dir_in,
+                        src_image_rel,
+                        completed_images,
+                        hash_cache,
+                        hash_cache_fn=hash_cache_fn):
+            skipped += 1
             continue
 
         print("")
@@ -285,20 +439,112 @@ def parse_images(dir_in, all_images, completed_images):
     print("")
     print("Finished name parse loop")
     print("ok: %s" % ok)
+    print("already imported: %s" % skipped)
     print("nok: %s" % len(noks))
     for pto_fn, msg in noks.items():
         print("  %s: %s" % (pto_fn, msg))
     return ret, noks
 
 
-def is_collision(entry):
+def map_asset_paths(entry, collection):
     """
-    Check if URL is valid or not
+    /map relative paths this entry would occupy once imported
+    """
+    vendor = entry["vendor"]
+    chipid = entry["chipid"]
+    flavor = entry["flavor"]
+    single_fn = util.map_image_uvcfe_to_basename(vendor, chipid, collection,
+                                                 flavor, "jpg")
+    return [
+        f"{vendor}/{chipid}/{collection}_{flavor}",
+        f"{vendor}/{chipid}/single/{single_fn}",
+    ]
+
+
+def build_map_catalog(map_dir):
+    """
+    Snapshot of what's in /map as a set of relative paths:
+    vendor/chipid/collection_flavor
+    vendor/chipid/single/vendor_chipid_collection_flavor.jpg
+    """
+    ret = set()
+    for vendor in os.scandir(map_dir):
+        if not vendor.is_dir():
+            continue
+        for chipid in os.scandir(vendor.path):
+            if not chipid.is_dir():
+                continue
+            prefix = vendor.name + "/" + chipid.name + "/"
+            for entry in os.scandir(chipid.path):
+                if entry.name == "single" and entry.is_dir():
+                    for single in os.scandir(entry.path):
+                        ret.add(prefix + "single/" + single.name)
+                else:
+                    ret.add(prefix + entry.name)
+    return ret
+
+
+def load_map_catalog(fn):
+    """
+    fn: a /map dir to scan or a JSON list written by --write-map-catalog
+    """
+    if os.path.isdir(fn):
+        print(f"Scanning {fn} for map catalog...")
+        ret = build_map_catalog(fn)
+    else:
+        ret = set(json.load(open(fn, "r")))
+    print("Map catalog: %u entries" % len(ret))
+    return ret
+
+
+def default_map_catalog():
+    """
+    Local /map (env.MAP_DIR) when running on the server
+    None if there isn't one => check the live site instead
     """
-    url = f"https://siliconprawn.org/map/{entry['vendor']}/{entry['chipid']}/{entry['flavor']}/"
-    print(f"Checking {url}...")
     try:
-        get = requests.get(url)
+        env.setup_env_default()
+    except AssertionError as e:
+        print("No local /map (%s), checking collisions over HTTP" % (e, ))
+        return None
+    return env.MAP_DIR
+
+
+def catalog_collisions(entries, collection, catalog):
+    """
+    Return dict of src_image to colliding /map path
+    """
+    ret = {}
+    for src_image, entry in entries.items():
+        for path in map_asset_paths(entry, collection):
+            if path in catalog:
+                ret[src_image] = path
+                break
+    return ret
+
+
+def http_collisions(entries,
+                    collection,
+                    threads=8,
+                    url_base="https://siliconprawn.org/map/"):
+    """
+    Like catalog_collisions() but ask the live site
+    Concurrent requests over a shared keep-alive connection pool
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=threads)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    def is_collision(path):
+        url = url_base + path
+        if "/single/" not in path:
+            url += "/"
+        try:
+            get = session.head(url, allow_redirects=True, timeout=30)
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"{url}: is Not reachable \nErr: {e}")
         if get.status_code == 404:
             return False
         elif get.status_code == 200:
@@ -306,31 +552,134 @@ def is_collision(entry):
         else:
             raise Exception(
                 f"{url}: is Not reachable, status_code: {get.status_code}")
-    except requests.exceptions.RequestException as e:
-        raise Exception(f"{url}: is Not reachable \nErr: {e}")
 
+    ret = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        futures = {}
+        for src_image, entry in entries.items():
+            for path in map_asset_paths(entry, collection):
+                futures[pool.submit(is_collision, path)] = (src_image, path)
+        for future in concurrent.futures.as_completed(futures):
+            src_image, path = futures[future]
+            if future.result():
+                ret[src_image] = path
+    return ret
 
-def sig_images(parsed, dir_in):
+
+def hash_file(fn, algorithms=HASH_ALGORITHMS):
     """
-    Calculate signatures so if git changes later can detect
+    Return dict of algorithm to hex digest
+    hashlib releases the GIL on large updates so this threads well
     """
-    for src_image_rel, entry in parsed.items():
-        print(f"Calculating {src_image_rel}...")
-        src_image = dir_in + "/" + src_image_rel
-        s = subprocess.check_output(f"sha1sum {src_image}", shell=True)
-        s = s.strip().split()[0]
-        s = util.tostr(s)
-        entry["sha1sum"] = s
+    hashes = [hashlib.new(algorithm) for algorithm in algorithms]
+    buf = bytearray(HASH_CHUNK)
+    view = memoryview(buf)
+    with open(fn, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            for h in hashes:
+                h.update(view[:n])
+    return dict((algorithm, h.hexdigest())
+                for algorithm, h in zip(algorithms, hashes))
+
+
+def load_hash_cache(fn=HASH_CACHE_FN):
+    """
+    dict of absolute path to
+    {"size": 123, "mtime": 1650000000.0, "sha1": "...", "sha256": "..."}
+    """
+    if not os.path.exists(fn):
+        return {}
+    return json.load(open(fn, "r"))
+
+
+def save_json(j, fn):
+    dir_name = os.path.dirname(fn)
+    if dir_name and not os.path.exists(dir_name):
+        os.mkdir(dir_name)
+    open(fn + ".tmp", "w").write(
+        json.dumps(j, sort_keys=True, indent=4, separators=(',', ': ')))
+    os.replace(fn + ".tmp", fn)
+
+
+def save_hash_cache(cache, fn=HASH_CACHE_FN):
+    save_json(cache, fn)
 
 
-def validate_images(parsed):
+def hash_cache_get(cache, src_image, st, algorithms=HASH_ALGORITHMS):
+    """
+    Return cache entry if src_image is unchanged and has all of algorithms
+    """
+    entry = cache.get(src_image)
+    if not entry or (entry["size"], entry["mtime"]) != (st.st_size,
+                                                        st.st_mtime):
+        return None
+    if any(algorithm not in entry for algorithm in algorithms):
+        return None
+    return entry
+
+
+def hash_cache_add(cache, src_image, st, digests):
+    entry = {
+        "size": st.st_size,
+        "mtime": st.st_mtime,
+    }
+    entry.update(digests)
+    cache[src_image] = entry
+    return entry
+
+
+def sig_images(parsed, dir_in, threads=None, cache_fn=HASH_CACHE_FN):
+    """
+    Calculate signatures so if git changes later can detect
+    """
+    if threads is None:
+        threads = min(8, os.cpu_count() or 1)
+    cache = load_hash_cache(cache_fn)
+
+    todo = {}
+    for src_image_rel, entry in parsed.items():
+        src_image = os.path.realpath(dir_in + "/" + src_image_rel)
+        st = os.stat(src_image)
+        hit = hash_cache_get(cache, src_image, st)
+        if hit:
+            entry["sha1sum"] = hit["sha1"]
+            entry["sha256sum"] = hit["sha256"]
+        else:
+            todo[src_image_rel] = (src_image, st)
+    print("Hashing %u images (%u cached) w/ %u threads" %
+          (len(todo), len(parsed) - len(todo), threads))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        futures = {}
+        for src_image_rel, (src_image, _st) in todo.items():
+            futures[pool.submit(hash_file, src_image)] = src_image_rel
+        for future in concurrent.futures.as_completed(futures):
+            src_image_rel = futures[future]
+            src_image, st = todo[src_image_rel]
+            digests = future.result()
+            print(f"Calculated {src_image_rel}: {digests['sha1']}")
+            entry = parsed[src_image_rel]
+            entry["sha1sum"] = digests["sha1"]
+            entry["sha256sum"] = digests["sha256"]
+            hash_cache_add(cache, src_image, st, digests)
+
+    if todo:
+        save_hash_cache(cache, cache_fn)
+
+
+def validate_images(parsed, collection, catalog=None, http_threads=8):
     """
     Ensure images conform before uploading
-    Should ideally also check for collisions
+    Also check for collisions against /map
+    catalog: set from load_map_catalog(). None => check the live site
     """
     ok = 0
     noks = {}
     new_singles = set()
+    candidates = OrderedDict()
     for src_image, entry in parsed.items():
 
         def fail(msg):
@@ -345,15 +694,27 @@ def validate_images(parsed):
             continue
         new_singles.add(entry["single_fn"])
         try:
-            util.parse_image_name(entry["single_fn"])
+            util.parse_map_image_vcfe(entry["single_fn"])
         except util.ParseError:
             fail("parse error")
-        # these all validated
-        if is_collision(entry):
-            fail("collision")
             continue
-        ok += 1
-        print("ok")
+        candidates[src_image] = entry
+
+    # these all validated
+    print("")
+    print("Checking %u images for /map collisions..." % len(candidates))
+    if catalog is None:
+        collisions = http_collisions(candidates,
+                                     collection,
+                                     threads=http_threads)
+    else:
+        collisions = catalog_collisions(candidates, collection, catalog)
+    for src_image in candidates:
+        if src_image in collisions:
+            print(f"{src_image}: collision w/ {collisions[src_image]}")
+            noks[src_image] = "collision"
+        else:
+            ok += 1
 
     print("")
     print("Finished image find loop")
@@ -364,70 +725,300 @@ def validate_images(parsed):
     return noks
 
 
-def copy_images(parsed, dir_in, single_dir):
-    for src_image, entry in parsed.items():
-        print("")
-        print(f"Converting {src_image}...")
+def default_mem_budget():
+    """
+    Half of MemAvailable, or something conservative if we can't tell
+    """
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for l in f:
+                if l.startswith("MemAvailable:"):
+                    return int(l.split()[1]) * 1024 // 2
+    except OSError:
+        pass
+    return 2 * 1024 * 1024 * 1024
+
+
+def convert_tool():
+    """
+    vips streams the TIFF through in strips
+    convert decodes the whole image into its pixel cache
+    """
+    if shutil.which("vips"):
+        return "vips"
+    return "convert"
+
+
+def estimate_convert_mem(fn, tool, mem_budget):
+    """
+    Approximate bytes needed to convert fn to JPEG
+    Only reads the TIFF header
+    """
+    with Image.open(fn) as img:
+        width, height = img.size
+        bands = len(img.getbands())
+    if tool == "vips":
+        # A window of scanlines in flight plus the library itself
+        return width * bands * 2 * VIPS_WINDOW_LINES + VIPS_OVERHEAD
+    # 16 bit RGBA pixel cache
+    # Capped: convert is told to page anything beyond this to disk
+    return min(width * height * 4 * 2, mem_budget)
+
+
+def convert_cmd(src_fn, dst_fn, tool, mem):
+    if tool == "vips":
+        return [
+            "vips", "copy", src_fn + "[access=sequential]",
+            dst_fn + "[Q=%u,optimize_coding]" % CONVERT_QUALITY
+        ]
+    mem_mib = max(1, mem // (1024 * 1024))
+    return [
+        "convert", "-limit", "memory",
+        "%uMiB" % mem_mib, "-limit", "map",
+        "%uMiB" % (2 * mem_mib), src_fn, "-quality",
+        str(CONVERT_QUALITY), dst_fn
+    ]
+
+
+def convert_image(src_fn, dst_fn, tool, mem):
+    """
+    Convert to a temp file so an interrupted run never leaves a truncated
+    .jpg that looks finished
+    Return seconds taken
+    """
+    tmp_fn = dst_fn + ".tmp.jpg"
+    tstart = time.time()
+    try:
+        subprocess.check_call(convert_cmd(src_fn, tmp_fn, tool, mem))
+        os.replace(tmp_fn, dst_fn)
+    finally:
+        if os.path.exists(tmp_fn):
+            os.unlink(tmp_fn)
+    return time.time() - tstart
+
+
+def copy_images(parsed, dir_in, single_dir, jobs=None, mem_budget=None):
+    """
+    Convert source TIFFs to single/ JPEGs across a worker pool
+    Concurrency is also limited by estimated memory so several huge
+    TIFFs don't get decoded at once
+    Return src image => error for images that failed to convert
+    A bad image doesn't stop the rest, it's tried again next run
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if mem_budget is None:
+        mem_budget = default_mem_budget()
+    tool = convert_tool()
+
+    todo = []
+    converted = 0
+    noks = OrderedDict()
+    for src_image, entry in sorted(parsed.items()):
         src_fn = dir_in + "/" + src_image
-        assert os.path.exists(src_fn)
         dst_fn = os.path.join(single_dir, entry["single_fn"])
-        cmd = f"convert -quality 90 {src_fn} {dst_fn}"
-        print(cmd)
-        subprocess.check_call(cmd, shell=True)
+        # Resumed run
+        if os.path.exists(dst_fn):
+            converted += 1
+            continue
+        try:
+            mem = estimate_convert_mem(src_fn, tool, mem_budget)
+        except Exception as e:
+            # ex: truncated / corrupt TIFF header
+            print("Failed %s: %s" % (src_image, e))
+            noks[src_image] = "unreadable: %s" % e
+            continue
+        todo.append((src_image, src_fn, dst_fn, mem))
+    print("Converting %u images (%u already done) w/ %s, %u workers, "
+          "%0.1f MiB memory budget" %
+          (len(todo), converted, tool, jobs, mem_budget / 1024 / 1024))
+
+    in_total = 0
+    out_total = 0
+    tstart = time.time()
+    # Workers just wait on the subprocess
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = {}
+        mem_used = 0
+        todo.reverse()
+        while todo or pending:
+            # Always allow one job even if it alone exceeds the budget
+            while todo and len(pending) < jobs and (
+                    not pending or mem_used + todo[-1][3] <= mem_budget):
+                src_image, src_fn, dst_fn, mem = todo.pop()
+                future = pool.submit(convert_image, src_fn, dst_fn, tool, mem)
+                pending[future] = (src_image, src_fn, dst_fn, mem)
+                mem_used += mem
+
+            finished, _not_done = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                src_image, src_fn, dst_fn, mem = pending.pop(future)
+                mem_used -= mem
+                try:
+                    dt = future.result()
+                except Exception as e:
+                    print("Failed %s: %s" % (src_image, e))
+                    noks[src_image] = "convert failed: %s" % e
+                    continue
+                in_size = os.path.getsize(src_fn)
+                out_size = os.path.getsize(dst_fn)
+                in_total += in_size
+                out_total += out_size
+                print("Converted %s: %0.1f s, %0.1f => %0.1f MiB (%0.3f)" %
+                      (src_image, dt, in_size / 1024 / 1024,
+                       out_size / 1024 / 1024, out_size / max(1, in_size)))
+    if in_total:
+        print("Converted %0.1f => %0.1f MiB (%0.3f) in %0.1f s" %
+              (in_total / 1024 / 1024, out_total / 1024 / 1024,
+               out_total / in_total, time.time() - tstart))
+    return noks
 
 
-def run(dir_in, verbose=False):
+def run_timestamp():
+    # ex: 2022-04-25_18-25-35
+    return datetime.datetime.utcnow().isoformat().replace("T", "_").replace(
+        ":", "-").split(".")[0]
+
+
+def load_stages(run_dir):
+    """
+    Pipeline stages completed in run_dir, in order
+    Each stage's results are saved into run_dir before it's marked done
+    """
+    fn = run_dir + "/stages.json"
+    if not os.path.exists(fn):
+        return []
+    return json.load(open(fn, "r"))
+
+
+def mark_stage(run_dir, stages, stage):
+    stages.append(stage)
+    save_json(stages, run_dir + "/stages.json")
+
+
+def check_run_input(run_dir, dir_in):
+    """
+    Record the input tree a run dir was made from
+    Refuse to resume it against a different one: stages would mix sources
+    """
+    fn = run_dir + "/run.json"
+    dir_in = os.path.realpath(dir_in)
+    if os.path.exists(fn):
+        was = json.load(open(fn, "r"))["dir_in"]
+        if was != dir_in:
+            raise Exception("%s was run on %s, not %s" % (run_dir, was, dir_in))
+        return
+    if load_stages(run_dir):
+        print("WARNING: %s predates run.json, assuming input %s" %
+              (run_dir, dir_in))
+    save_json({"dir_in": dir_in}, fn)
+
+
+def load_stage_json(run_dir, name, object_pairs_hook=None):
+    return json.load(open(run_dir + "/" + name + ".json", "r"),
+                     object_pairs_hook=object_pairs_hook)
+
+
+def run(dir_in,
+        verbose=False,
+        hash_threads=None,
+        collection=COLLECTION,
+        map_catalog=None,
+        http=False,
+        http_threads=8,
+        convert_jobs=None,
+        mem_budget=None,
+        resume=None):
+    """
+    map_catalog: /map dir or catalog .json (default: env.MAP_DIR)
+    http: check collisions against the live site instead of a catalog
+    resume: run dir to pick back up from
+    """
     dir_out = "travis"
     if not os.path.exists(dir_out):
         os.mkdir(dir_out)
-    # Writing to travis/2022-04-25_18-25-35
-    subdir = datetime.datetime.utcnow().isoformat().replace("T", "_").replace(
-        ":", "-").split(".")[0]
-    this_dir = dir_out + "/" + subdir
-    os.mkdir(this_dir)
-    _logger = util.make_iolog(this_dir + '/out.log')
+    if resume:
+        this_dir = resume.rstrip("/")
+        if os.path.exists(this_dir + "/done.txt"):
+            print("%s already finished" % this_dir)
+            return
+        # Keep the original run's log
+        _logger = util.make_iolog(this_dir + '/out_resume_%s.log' %
+                                  run_timestamp())
+    else:
+        # Writing to travis/2022-04-25_18-25-35
+        this_dir = dir_out + "/" + run_timestamp()
+        os.mkdir(this_dir)
+        _logger = util.make_iolog(this_dir + '/out.log')
 
     print("Writing to %s" % this_dir)
+    check_run_input(this_dir, dir_in)
     single_dir = this_dir + "/single"
     # user to move here once uploaded
     uploaded_dir = this_dir + "/uploaded"
-    os.mkdir(single_dir)
-    os.mkdir(uploaded_dir)
-
-    completed_images = load_completed_db()
-    patches = load_patches()
-    all_images, all_images_noks = find_images(dir_in, patches, verbose=verbose)
+    if not os.path.exists(single_dir):
+        os.mkdir(single_dir)
+    if not os.path.exists(uploaded_dir):
+        os.mkdir(uploaded_dir)
+    stages = load_stages(this_dir)
+    if stages:
+        print("Resuming after: %s" % ", ".join(stages))
+
+    if "find" in stages:
+        all_images = load_stage_json(this_dir, "all_images")
+        all_images_noks = load_stage_json(this_dir, "all_images_noks")
+    else:
+        patches = load_patches()
+        all_images, all_images_noks = find_images(dir_in,
+                                                  patches,
+                                                  verbose=verbose)
+        save_json(all_images, this_dir + "/all_images.json")
+        save_json(all_images_noks, this_dir + "/all_images_noks.json")
+        mark_stage(this_dir, stages, "find")
     print("")
-    parsed, parsed_noks = parse_images(dir_in, all_images, completed_images)
+
+    if "parse" in stages:
+        parsed = load_stage_json(this_dir, "parsed", OrderedDict)
+        parsed_noks = load_stage_json(this_dir, "parsed_noks")
+    else:
+        completed_images = load_completed_db(dir_out)
+        parsed, parsed_noks = parse_images(dir_in, all_images,
+                                           completed_images)
+        save_json(parsed, this_dir + "/parsed.json")
+        save_json(parsed_noks, this_dir + "/parsed_noks.json")
+        mark_stage(this_dir, stages, "parse")
     print("")
-    sig_images(parsed, dir_in)
+
+    if "hash" not in stages:
+        sig_images(parsed, dir_in, threads=hash_threads)
+        save_json(parsed, this_dir + "/parsed.json")
+        mark_stage(this_dir, stages, "hash")
     print("")
-    validate_noks = validate_images(parsed)
-
-    open(this_dir + "/all_images.json", "w").write(
-        json.dumps(all_images,
-                   sort_keys=True,
-                   indent=4,
-                   separators=(',', ': ')))
-    open(this_dir + "/all_images_noks.json", "w").write(
-        json.dumps(all_images_noks,
-                   sort_keys=True,
-                   indent=4,
-                   separators=(',', ': ')))
-    open(this_dir + "/parsed.json", "w").write(
-        json.dumps(parsed, sort_keys=True, indent=4, separators=(',', ': ')))
-    open(this_dir + "/parsed_noks.json", "w").write(
-        json.dumps(parsed_noks,
-                   sort_keys=True,
-                   indent=4,
-                   separators=(',', ': ')))
-    open(this_dir + "/validate_noks.json", "w").write(
-        json.dumps(validate_noks,
-                   sort_keys=True,
-                   indent=4,
-                   separators=(',', ': ')))
-
-    copy_images(parsed, dir_in, single_dir)
+
+    if "validate" in stages:
+        validate_noks = load_stage_json(this_dir, "validate_noks")
+    else:
+        catalog = None
+        if not http and not map_catalog:
+            map_catalog = default_map_catalog()
+        if not http and map_catalog:
+            catalog = load_map_catalog(map_catalog)
+        validate_noks = validate_images(parsed,
+                                        collection=collection,
+                                        catalog=catalog,
+                                        http_threads=http_threads)
+        save_json(validate_noks, this_dir + "/validate_noks.json")
+        mark_stage(this_dir, stages, "validate")
+
+    # Per image checkpoints: converted files only appear once complete
+    convert_noks = copy_images(parsed,
+                               dir_in,
+                               single_dir,
+                               jobs=convert_jobs,
+                               mem_budget=mem_budget)
+    save_json(convert_noks, this_dir + "/convert_noks.json")
+    mark_stage(this_dir, stages, "convert")
 
     with open(this_dir + "/done.txt", "w") as f:
         f.write("huzzah!")
@@ -446,19 +1037,76 @@ def run(dir_in, verbose=False):
     for im_fn, msg in validate_noks.items():
         print("  %s: %s" % (im_fn, msg))
     print("")
-    print("Images ready: %s" % len(parsed))
+    print("Convert failed images: %s" % len(convert_noks))
+    for im_fn, msg in convert_noks.items():
+        print("  %s: %s" % (im_fn, msg))
+    print("")
+    print("Images ready: %s" % (len(parsed) - len(convert_noks)))
 
 
 def main():
     parser = argparse.ArgumentParser(description='Import travis archive')
     parser.add_argument('--verbose', '-v', action='store_true', help='verbose')
+    parser.add_argument('--hash-threads',
+                        type=int,
+                        default=None,
+                        help='Image hashing threads')
+    parser.add_argument('--collection',
+                        default=COLLECTION,
+                        help='Collection images will be imported under')
+    parser.add_argument(
+        '--map-catalog',
+        help='Check collisions against this /map dir or catalog .json '
+        '(default: local /map if there is one, else siliconprawn.org)')
+    parser.add_argument('--http',
+                        action='store_true',
+                        help='Check collisions against siliconprawn.org '
+                        'even if there is a local /map')
+    parser.add_argument('--write-map-catalog',
+                        metavar='FN',
+                        help='Snapshot --map-dir into catalog .json and exit')
+    parser.add_argument('--map-dir',
+                        default="/var/www/map",
+                        help='/map to snapshot for --write-map-catalog')
+    parser.add_argument('--http-threads',
+                        type=int,
+                        default=8,
+                        help='Concurrent siliconprawn.org collision checks')
+    parser.add_argument('--convert-jobs',
+                        type=int,
+                        default=None,
+                        help='Concurrent TIFF => JPEG conversions')
+    parser.add_argument(
+        '--mem-budget',
+        type=int,
+        default=None,
+        help='Conversion memory budget in MiB (default: half available)')
+    parser.add_argument('--resume',
+                        metavar='RUN_DIR',
+                        help='Continue an interrupted run ex: '
+                        'travis/2022-04-25_18-25-35')
     parser.add_argument('dir_in',
                         default="/home/mcmaster/buffer/ic/travis/goodchips2",
                         nargs="?",
                         help='File name in')
     args = parser.parse_args()
 
-    run(dir_in=args.dir_in)
+    if args.write_map_catalog:
+        catalog = build_map_catalog(args.map_dir)
+        open(args.write_map_catalog, "w").write(
+            json.dumps(sorted(catalog), indent=4, separators=(',', ': ')))
+        print("Wrote %u entries to %s" % (len(catalog), args.write_map_catalog))
+        return
+
+    run(dir_in=args.dir_in,
+        hash_threads=args.hash_threads,
+        collection=args.collection,
+        map_catalog=args.map_catalog,
+        http=args.http,
+        http_threads=args.http_threads,
+        convert_jobs=args.convert_jobs,
+        mem_budget=args.mem_budget * 1024 * 1024 if args.mem_budget else None,
+        resume=args.resume)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+scrape_travis helper unit tests
+Run from the repo root so siprawn is importable
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from PIL import Image
+import scrape_travis
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="scrape_travis_test_")
+        self.hash_chunk = scrape_travis.HASH_CHUNK
+
+    def tearDown(self):
+        scrape_travis.HASH_CHUNK = self.hash_chunk
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def write(self, rel, buf=b""):
+        fn = os.path.join(self.tmp_dir, rel)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with open(fn, "wb") as f:
+            f.write(buf)
+        return fn
+
+    def test_hash_file_chunks(self):
+        """
+        Same digests however the file splits into chunks
+        """
+        buf = bytes(range(256)) * 5
+        fn = self.write("a.tif", buf)
+        want = {
+            "sha1": hashlib.sha1(buf).hexdigest(),
+            "sha256": hashlib.sha256(buf).hexdigest(),
+        }
+        for chunk in (7, 256, len(buf), len(buf) + 1):
+            scrape_travis.HASH_CHUNK = chunk
+            self.assertEqual(scrape_travis.hash_file(fn), want)
+        self.assertEqual(scrape_travis.hash_file(fn, algorithms=("sha1", )),
+                         {"sha1": want["sha1"]})
+
+    def test_sig_images_cache(self):
+        """
+        Unchanged images come from the cache, changed ones are rehashed
+        """
+        dir_in = os.path.join(self.tmp_dir, "in")
+        fn = self.write("in/intel/i8080/top.tif", b"die")
+        cache_fn = os.path.join(self.tmp_dir, "hash_cache.json")
+        parsed = {"intel/i8080/top.tif": {}}
+        scrape_travis.sig_images(parsed, dir_in, threads=2, cache_fn=cache_fn)
+        sha1 = hashlib.sha1(b"die").hexdigest()
+        self.assertEqual(parsed["intel/i8080/top.tif"]["sha1sum"], sha1)
+        cache = scrape_travis.load_hash_cache(cache_fn)
+        self.assertEqual(cache[os.path.realpath(fn)]["sha1"], sha1)
+
+        # Only trusted while size / mtime match
+        cache[os.path.realpath(fn)]["sha1"] = "cached"
+        scrape_travis.save_hash_cache(cache, cache_fn)
+        scrape_travis.sig_images(parsed, dir_in, cache_fn=cache_fn)
+        self.assertEqual(parsed["intel/i8080/top.tif"]["sha1sum"], "cached")
+        self.write("in/intel/i8080/top.tif", b"restitched")
+        scrape_travis.sig_images(parsed, dir_in, cache_fn=cache_fn)
+        self.assertEqual(parsed["intel/i8080/top.tif"]["sha1sum"],
+                         hashlib.sha1(b"restitched").hexdigest())
+
+    def test_catalog_collisions(self):
+        """
+        Collection prefixed map dir or single image already in /map
+        """
+        map_dir = os.path.join(self.tmp_dir, "map")
+        self.write("map/intel/i8080/goodspeed_mz/index.html")
+        self.write("map/atmel/at89c51/single/atmel_at89c51_goodspeed_top.jpg")
+        self.write("map/ti/tms9918/mz/index.html")
+        catalog = scrape_travis.build_map_catalog(map_dir)
+        self.assertIn("intel/i8080/goodspeed_mz", catalog)
+        self.assertIn(
+            "atmel/at89c51/single/atmel_at89c51_goodspeed_top.jpg", catalog)
+
+        catalog_fn = os.path.join(self.tmp_dir, "catalog.json")
+        with open(catalog_fn, "w") as f:
+            json.dump(sorted(catalog), f)
+        self.assertEqual(scrape_travis.load_map_catalog(catalog_fn), catalog)
+
+        def entry(vendor, chipid, flavor):
+            return {
+                "vendor": vendor,
+                "chipid": chipid,
+                "flavor": flavor,
+                "single_fn": "%s_%s_%s.jpg" % (vendor, chipid, flavor),
+            }
+
+        entries = {
+            "intel/i8080/mz.tif": entry("intel", "i8080", "mz"),
+            "atmel/at89c51/top.tif": entry("atmel", "at89c51", "top"),
+            # Unattributed map there, goodspeed_mz free
+            "ti/tms9918/mz.tif": entry("ti", "tms9918", "mz"),
+            "ti/tms9918/mz2.tif": entry("ti", "tms9918", "mz"),
+        }
+        self.assertEqual(
+            scrape_travis.catalog_collisions(entries, "goodspeed", catalog), {
+                "intel/i8080/mz.tif":
+                "intel/i8080/goodspeed_mz",
+                "atmel/at89c51/top.tif":
+                "atmel/at89c51/single/atmel_at89c51_goodspeed_top.jpg",
+            })
+        noks = scrape_travis.validate_images(entries,
+                                             "goodspeed",
+                                             catalog=catalog)
+        self.assertEqual(
+            noks, {
+                "intel/i8080/mz.tif": "collision",
+                "atmel/at89c51/top.tif": "collision",
+                "ti/tms9918/mz2.tif": "collision",
+            })
+
+    def test_completed_db(self):
+        """
+        Uploaded images are remembered and skipped until they change
+        """
+        dir_in = os.path.join(self.tmp_dir, "in")
+        dir_out = os.path.join(self.tmp_dir, "travis")
+        db_fn = os.path.join(dir_out, "completed.json")
+        cache_fn = os.path.join(self.tmp_dir, "hash_cache.json")
+        self.write("in/intel/i8080/mz.tif", b"die")
+        run_dir = os.path.join(dir_out, "2022-04-25_18-25-35")
+        parsed = {
+            "intel/i8080/mz.tif": {
+                "single_fn": "intel_i8080_mz.jpg",
+                "sha1sum": hashlib.sha1(b"die").hexdigest(),
+            },
+            # Converted but never uploaded
+            "intel/i8086/mz.tif": {
+                "single_fn": "intel_i8086_mz.jpg",
+                "sha1sum": "x",
+            },
+        }
+        self.write(os.path.join(run_dir, "parsed.json"),
+                   json.dumps(parsed).encode("ascii"))
+        self.write(os.path.join(run_dir, "uploaded/intel_i8080_mz.jpg"))
+
+        db = scrape_travis.load_completed_db(dir_out, fn=db_fn)
+        self.assertEqual(list(db), ["intel/i8080/mz.tif"])
+        # Still there once the run dir is cleaned up
+        shutil.rmtree(run_dir)
+        self.assertEqual(scrape_travis.load_completed_db(dir_out, fn=db_fn),
+                         db)
+
+        cache = {}
+        self.assertTrue(
+            scrape_travis.is_completed(dir_in,
+                                       "intel/i8080/mz.tif",
+                                       db,
+                                       cache,
+                                       hash_cache_fn=cache_fn))
+        self.assertFalse(
+            scrape_travis.is_completed(dir_in, "intel/i8086/mz.tif", db,
+                                       cache))
+        # Hashed once, reused by the hash stage and later runs
+        cache = scrape_travis.load_hash_cache(cache_fn)
+        self.assertEqual(list(cache.values())[0]["sha256"],
+                         hashlib.sha256(b"die").hexdigest())
+
+        self.write("in/intel/i8080/mz.tif", b"restitched")
+        self.assertFalse(
+            scrape_travis.is_completed(dir_in, "intel/i8080/mz.tif", db,
+                                       cache))
+
+    def test_scan_pto_dirs_cache(self):
+        """
+        Unchanged dirs come from the cache, changed ones are listed again
+        """
+        dir_in = os.path.join(self.tmp_dir, "in")
+        cache_fn = os.path.join(self.tmp_dir, "find_cache.json")
+        self.write("in/intel/i8080/top/top.pto")
+        self.write("in/intel/i8080/top/top.tif")
+        self.write("in/intel/i8080/top/snap0001.tif")
+        self.write("in/intel/i8080/notes.txt")
+        top_dir = dir_in + "/intel/i8080/top"
+        got = scrape_travis.scan_pto_dirs(dir_in, cache_fn=cache_fn)
+        self.assertEqual(
+            got, {
+                top_dir: {
+                    "ptos": [top_dir + "/top.pto"],
+                    "tifs": [top_dir + "/snap0001.tif", top_dir + "/top.tif"],
+                }
+            })
+
+        # Cache is trusted while the dir mtime matches
+        cache = json.load(open(cache_fn))
+        cache[top_dir]["tifs"].append("cached.tif")
+        with open(cache_fn, "w") as f:
+            json.dump(cache, f)
+        got = scrape_travis.scan_pto_dirs(dir_in, cache_fn=cache_fn)
+        self.assertIn(top_dir + "/cached.tif", got[top_dir]["tifs"])
+
+        self.write("in/intel/i8080/top/top_blended_fused.tif")
+        st = os.stat(top_dir)
+        os.utime(top_dir, (st.st_atime, st.st_mtime + 1))
+        got = scrape_travis.scan_pto_dirs(dir_in, cache_fn=cache_fn)
+        self.assertEqual(got[top_dir]["tifs"], [
+            top_dir + "/snap0001.tif", top_dir + "/top.tif",
+            top_dir + "/top_blended_fused.tif"
+        ])
+
+    def test_copy_images_errors(self):
+        """
+        Bad images are reported, the rest still get converted
+        """
+        dir_in = os.path.join(self.tmp_dir, "in")
+        single_dir = os.path.join(self.tmp_dir, "single")
+        os.makedirs(single_dir)
+        os.makedirs(dir_in + "/intel/i8080")
+        Image.new("RGB", (16, 16)).save(dir_in + "/intel/i8080/mz.tif")
+        self.write("in/intel/i8080/top.tif", b"II*\x00truncated")
+        parsed = {
+            "intel/i8080/mz.tif": {
+                "single_fn": "intel_i8080_mz.jpg"
+            },
+            "intel/i8080/top.tif": {
+                "single_fn": "intel_i8080_top.jpg"
+            },
+        }
+        noks = scrape_travis.copy_images(parsed, dir_in, single_dir, jobs=2)
+        self.assertIn("unreadable", noks.pop("intel/i8080/top.tif"))
+        if shutil.which(scrape_travis.convert_tool()):
+            self.assertEqual(noks, {})
+            self.assertEqual(os.listdir(single_dir), ["intel_i8080_mz.jpg"])
+        else:
+            self.assertIn("convert failed", noks["intel/i8080/mz.tif"])
+            self.assertEqual(os.listdir(single_dir), [])
+
+    def test_stage_resume(self):
+        """
+        Completed stages are remembered, the input tree must match
+        """
+        run_dir = os.path.join(self.tmp_dir, "run")
+        os.makedirs(run_dir)
+        dir_in = os.path.join(self.tmp_dir, "in")
+        os.makedirs(dir_in)
+        scrape_travis.check_run_input(run_dir, dir_in)
+        self.assertEqual(scrape_travis.load_stages(run_dir), [])
+        stages = []
+        scrape_travis.mark_stage(run_dir, stages, "find")
+        scrape_travis.mark_stage(run_dir, stages, "parse")
+        self.assertEqual(scrape_travis.load_stages(run_dir), ["find", "parse"])
+
+        scrape_travis.check_run_input(run_dir, dir_in + "/")
+        with self.assertRaises(Exception):
+            scrape_travis.check_run_input(run_dir, self.tmp_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()  # run all tests
@@ -10,6 +10,10 @@ from siprawn import env
 from siprawn.util import FnRetry
 from siprawn.util import parse_wiki_image_user_vcufe, ParseError
 from siprawn import simap
+from siprawn import events
+from siprawn import tilepack
+from siprawn import dedup
+from siprawn import usage
 import json
 import tarfile
 
@@ -98,6 +102,35 @@ def shift_done(entry):
         shutil.move(entry["local_fn"], dst_fn)
 
 
+def pack_tiles(map_fn):
+    """
+    Best effort: an unpacked map is still a good map
+    A partially packed map is put back to one file per tile
+    """
+    try:
+        ntiles, _nbytes = tilepack.pack_map(map_fn)
+        print("Packed %u tiles" % ntiles)
+    except Exception:
+        print("WARNING: failed to pack tiles, leaving map unpacked")
+        traceback.print_exc()
+        try:
+            tilepack.unpack_map(map_fn)
+        except Exception:
+            print("WARNING: failed to unpack partially packed map")
+            traceback.print_exc()
+
+
+def dedup_tiles(map_fn):
+    """
+    Best effort like pack_tiles()
+    """
+    try:
+        print("Dedup: " + dedup.format_stats(dedup.dedup_map(map_fn)))
+    except Exception:
+        print("WARNING: failed to dedup tiles")
+        traceback.print_exc()
+
+
 def process(entry):
     print("")
     print(entry)
@@ -183,6 +216,10 @@ def process(entry):
             traceback.print_exc()
             entry["status"] = STATUS_ERROR
             return
+        if env.PACK_TILES:
+            pack_tiles(map_fn)
+        else:
+            dedup_tiles(map_fn)
 
         _out_txt, wiki_page, wiki_url, map_chipid_url, wrote, exists = img2doku.run(
             hi_fns=[single_fn],
@@ -205,6 +242,25 @@ def process(entry):
                                     collection=user,
                                     type_="map")
 
+        usage.record_map_asset(single_fn,
+                               collection=user,
+                               vendor=vendor,
+                               chipid=chipid)
+        usage.record_map_asset(map_fn,
+                               collection=user,
+                               vendor=vendor,
+                               chipid=chipid)
+        usage.check_quota(user)
+
+        events.publish(events.MAP_COMPLETED,
+                       vendor=vendor,
+                       chipid=chipid,
+                       collection=user,
+                       map=map_chipid_url + "/" + user + "_" + flavor + "/",
+                       wiki=wiki_url,
+                       # No thumb: autothumb hasn't made it yet
+                       single=os.path.relpath(single_fn, env.WWW_DIR))
+
         if "local_fn" in entry:
             shift_done(entry)
         entry["status"] = STATUS_DONE
@@ -57,6 +57,8 @@ from siprawn.util import validate_username
 import simapper
 from simapper import print_log_break
 from siprawn import env
+from siprawn import events
+from siprawn import usage
 from siprawn.util import FnRetry, archive_page_last_change_user
 
 DEL_ON_DONE = True
@@ -133,6 +135,8 @@ def process(page):
     print("Generating %s" % (page["page"], ))
 
     import_images(page)
+    usage.record_media(page["user"], page["vendor"], page["chipid"])
+    usage.check_quota(page["user"])
     """
     convert canonical.jpg: wiki.jpg to just wiki.jpg
 
@@ -171,6 +175,19 @@ def process(page):
     print("exists: " + str(exists))
     log_sipager_update(wiki_url, page["user"])
 
+    # Die shot makes the best preview, otherwise whatever else we got
+    media_dir = "archive/data/media/%s/%s/%s" % (page["user"], page["vendor"],
+                                                 page["chipid"])
+    images = force_fns["die"] + force_fns["header"] + force_fns["package"]
+    events.publish(events.PAGE_WRITTEN,
+                   vendor=page["vendor"],
+                   chipid=page["chipid"],
+                   collection=page["user"],
+                   wiki=wiki_url,
+                   created=not exists,
+                   images=[media_dir + "/" + fn for fn in images],
+                   thumb=media_dir + "/" + images[0] if images else None)
+
     shift_done(page)
 
 
@@ -0,0 +1,167 @@
+"""
+Hardlink byte identical tiles
+
+Die scans have large uniform areas (background outside the die, metal
+fill) so many tiles in a pyramid are the exact same JPEG
+Identical tiles within a map, or across a collection's maps, are
+replaced by hardlinks to one copy
+
+Hardlinked tiles share their data: anything updating a tile must write a
+new file and rename it over the old one rather than rewriting in place
+Packed maps (see siprawn.tilepack) are skipped
+"""
+
+import errno
+import hashlib
+import os
+from siprawn import tilepack
+
+# Left behind by an interrupted link_over() / jpegopt, not tiles
+TMP_EXTS = (".dedup", ".jpegopt")
+
+
+def new_stats():
+    """
+    tiles: tiles looked at
+    duplicates: tiles linked to another copy
+    bytes / inodes: freed by dropping the last link to a duplicate
+    link_limit: copies kept because the file had hit the hardlink limit
+    errors: maps skipped, ex: custom index.html without a viewer
+    """
+    return {
+        "tiles": 0,
+        "duplicates": 0,
+        "bytes": 0,
+        "inodes": 0,
+        "link_limit": 0,
+        "errors": 0
+    }
+
+
+def add_stats(stats, other):
+    for k, v in other.items():
+        stats[k] += v
+    return stats
+
+
+def map_tiles(map_dir):
+    """
+    Return tile file names of an unpacked map
+    """
+    ret = []
+    for layer_dir in tilepack.layer_dirs(map_dir):
+        for _zoom, level_dir in tilepack.level_dirs(layer_dir):
+            for entry in os.scandir(level_dir):
+                if entry.is_file() and not entry.name.endswith(TMP_EXTS):
+                    ret.append(entry.path)
+    return sorted(ret)
+
+
+def file_hash(fn):
+    with open(fn, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def link_over(src, dst):
+    """
+    Atomically replace dst with a hardlink to src
+    """
+    tmp = dst + ".dedup"
+    os.link(src, tmp)
+    os.replace(tmp, dst)
+
+
+def dedup_files(fns, dry=False):
+    """
+    Hardlink identical files together
+    Only files sharing a size are hashed
+    Return stats, see new_stats()
+    """
+    stats = new_stats()
+    by_size = {}
+    for fn in fns:
+        st = os.stat(fn)
+        stats["tiles"] += 1
+        by_size.setdefault(st.st_size, []).append((fn, st))
+
+    for size, candidates in by_size.items():
+        if len(candidates) < 2:
+            continue
+        by_hash = {}
+        for fn, st in candidates:
+            by_hash.setdefault(file_hash(fn), []).append((fn, st))
+        for group in by_hash.values():
+            # Keep the copy with the most links, ex: from a previous run
+            group.sort(key=lambda x: (-x[1].st_nlink, x[0]))
+            keep_fn, keep_st = group[0]
+            keep = (keep_st.st_dev, keep_st.st_ino)
+            inodes = set([keep])
+            freed = set()
+            for fn, st in group[1:]:
+                inode = (st.st_dev, st.st_ino)
+                if inode == keep:
+                    continue
+                if st.st_dev != keep_st.st_dev:
+                    continue
+                if not dry:
+                    try:
+                        link_over(keep_fn, fn)
+                    except OSError as e:
+                        if e.errno != errno.EMLINK:
+                            raise
+                        # keep_fn is out of links (65000 on ext4)
+                        # Link the rest of the group to this copy instead
+                        stats["link_limit"] += 1
+                        keep_fn, keep_st, keep = fn, st, inode
+                        if inode in freed:
+                            freed.remove(inode)
+                            stats["bytes"] -= size
+                            stats["inodes"] -= 1
+                        continue
+                stats["duplicates"] += 1
+                # Freed once every path to this inode points at keep_fn
+                if inode not in inodes:
+                    inodes.add(inode)
+                    linked = sum(1 for _fn, x in group
+                                 if (x.st_dev, x.st_ino) == inode)
+                    if linked == st.st_nlink:
+                        freed.add(inode)
+                        stats["bytes"] += size
+                        stats["inodes"] += 1
+    return stats
+
+
+def dedup_maps(map_dirs, dry=False):
+    """
+    Dedup across all of map_dirs
+    Return stats, see new_stats()
+    """
+    fns = []
+    errors = 0
+    for map_dir in map_dirs:
+        # One odd map shouldn't stop the rest of the collection
+        try:
+            if tilepack.is_packed(map_dir):
+                continue
+            fns += map_tiles(map_dir)
+        except Exception as e:
+            print("%s: skipped: %s" % (map_dir, e))
+            errors += 1
+    stats = dedup_files(fns, dry=dry)
+    stats["errors"] += errors
+    return stats
+
+
+def dedup_map(map_dir, dry=False):
+    return dedup_maps([map_dir], dry=dry)
+
+
+def format_stats(stats):
+    ret = "%u tiles, %u duplicates, %0.1f MiB and %u inodes reclaimed" % (
+        stats["tiles"], stats["duplicates"], stats["bytes"] / 1024 / 1024,
+        stats["inodes"])
+    if stats["link_limit"]:
+        ret += ", %u link limit hits" % stats["link_limit"]
+    if stats["errors"]:
+        ret += ", %u errors" % stats["errors"]
+    return ret
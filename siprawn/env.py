@@ -19,6 +19,15 @@ SIMAPPER_TMP_DIR = "/tmp/simapper"
 # works no matter which of our domains served it (ex: siliconpr0n.org vs
 # siliconprawn.org), instead of pulling scripts cross origin.
 MAP_URL_BASE = "/lib/groupXIV/stable"
+# Pack new maps' tiles into one file per zoom level (see siprawn.tilepack)
+# Packed maps must be served through tile_server.py
+PACK_TILES = os.getenv("SIPRAWN_PACK_TILES", "") == "1"
+# Local feed of completed maps / pages
+# See siprawn.events
+EVENTS_FN = None
+# Disk usage per asset + per collection quotas, see siprawn.usage
+USAGE_FN = None
+QUOTAS_FN = None
 
 
 def setup_env_default():
@@ -36,6 +45,9 @@ def setup_env(dev=False, remote=False):
     global WIKI_TOOL_DIR
     global SIMAPPER_USER_DIR
     global SIPAGER_USER_DIR
+    global EVENTS_FN
+    global USAGE_FN
+    global QUOTAS_FN
 
     # XXX: consider removing this now that have unit test
     assert not remote
@@ -70,9 +82,13 @@ def setup_env(dev=False, remote=False):
     assert os.path.exists(SIPAGER_USER_DIR), SIPAGER_USER_DIR
     # but good enough right now
     COPYRIGHT_TXT = WWW_DIR + "/archive/data/pages/tool/copyright.txt"
+    EVENTS_FN = WWW_DIR + "/lib/events.jsonl"
+    USAGE_FN = WWW_DIR + "/lib/usage.db"
+    QUOTAS_FN = WWW_DIR + "/lib/quotas.json"
 
     print("Environment:")
     print("  WWW_DIR: ", WWW_DIR)
     print("  MAP_DIR: ", MAP_DIR)
     print("  SIMAPPER_DIR: ", SIMAPPER_DIR)
     print("  SIPAGER_DIR: ", SIPAGER_DIR)
+    print("  EVENTS_FN: ", EVENTS_FN)
@@ -0,0 +1,138 @@
+"""
+Local event feed so consumers hear about new assets without polling HTTP
+
+Append-only JSONL file, one event per line:
+{"type": "map_completed", "time": 1700000000.0, "vendor": "intel", ...}
+
+A consumer's position is a byte offset ("cursor") into the file
+Events are only ever appended so a cursor stays valid forever
+"""
+
+import json
+import os
+import time
+import fcntl
+from siprawn import env
+
+# Event types
+MAP_COMPLETED = "map_completed"
+PAGE_WRITTEN = "page_written"
+
+
+def events_fn():
+    env.setup_env_default()
+    return env.EVENTS_FN
+
+
+def publish(type_, fn=None, **kwargs):
+    """
+    Append an event
+    Best effort: a broken feed shouldn't fail an import
+    """
+    if fn is None:
+        fn = events_fn()
+    j = dict(kwargs)
+    j["type"] = type_
+    j["time"] = time.time()
+    line = json.dumps(j, sort_keys=True) + "\n"
+    try:
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with open(fn, "a") as f:
+            # Keep concurrent writers (simapper + sipager) from interleaving
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(line)
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+    except OSError as e:
+        print("WARNING: failed to publish %s event: %s" % (type_, e))
+        return None
+    print("Published %s event" % (type_, ))
+    return j
+
+
+def read(cursor=0, fn=None):
+    """
+    Yield (event, next cursor) for every complete event after cursor
+    Unparsable lines are logged and skipped
+    """
+    if fn is None:
+        fn = events_fn()
+    try:
+        f = open(fn, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        f.seek(cursor)
+        for l in f:
+            # Writer is mid line, pick it up next time
+            if not l.endswith(b"\n"):
+                break
+            cursor += len(l)
+            # Corrupt line: skip it rather than stall every consumer on it
+            try:
+                event = json.loads(l)
+            except ValueError as e:
+                print("WARNING: bad event at %u: %s" % (cursor - len(l), e))
+                continue
+            if not isinstance(event, dict):
+                print("WARNING: bad event at %u: not an object" %
+                      (cursor - len(l), ))
+                continue
+            yield event, cursor
+
+
+def end_cursor(fn=None):
+    """
+    Cursor that skips all existing events
+    """
+    if fn is None:
+        fn = events_fn()
+    try:
+        return os.path.getsize(fn)
+    except FileNotFoundError:
+        return 0
+
+
+def follow(cursor=None, fn=None, poll=0.2):
+    """
+    Yield (event, next cursor) forever, waiting for new events
+    cursor None => only new events
+    Polls a local stat(), not the network
+    """
+    if fn is None:
+        fn = events_fn()
+    if cursor is None:
+        cursor = end_cursor(fn)
+    last_size = None
+    while True:
+        try:
+            size = os.path.getsize(fn)
+        except FileNotFoundError:
+            size = 0
+        if size != last_size:
+            last_size = size
+            for event, cursor in read(cursor, fn=fn):
+                yield event, cursor
+        time.sleep(poll)
+
+
+class Cursor:
+    """
+    Consumer position persisted to a file
+    """
+    def __init__(self, fn):
+        self.fn = fn
+
+    def load(self, default=None):
+        try:
+            with open(self.fn, "r") as f:
+                return int(f.read().strip())
+        except (FileNotFoundError, ValueError):
+            return default
+
+    def save(self, cursor):
+        with open(self.fn + ".tmp", "w") as f:
+            f.write("%u\n" % cursor)
+        os.replace(self.fn + ".tmp", self.fn)
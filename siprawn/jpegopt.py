@@ -0,0 +1,172 @@
+"""
+Lossless re-optimization of map tile JPEGs with jpegtran
+(optimized Huffman tables, progressive scans, no metadata)
+
+Tiles are replaced atomically (write tmp, rename over) and only if
+smaller. Hardlinked tiles (see siprawn.dedup) are optimized once and all
+of their paths relinked to the new file. A tile with links outside the
+maps being processed is left alone ("shared") rather than splitting it
+from its other copies
+Packed maps (see siprawn.tilepack) are skipped
+"""
+
+import os
+import shutil
+import subprocess
+from siprawn import dedup
+from siprawn import tilepack
+
+JPEGTRAN = "jpegtran"
+
+
+def check_jpegtran():
+    if not shutil.which(JPEGTRAN):
+        raise Exception("%s not found (libjpeg-turbo-progs)" % JPEGTRAN)
+
+
+def jpegtran_cmd(src, dst):
+    return [
+        JPEGTRAN, "-copy", "none", "-optimize", "-progressive", "-outfile",
+        dst, src
+    ]
+
+
+def new_stats():
+    """
+    files: tile paths
+    optimized: tiles replaced by a smaller version
+    shared: tiles skipped for having links elsewhere
+    errors: tiles that failed, or 1 for a map that couldn't be read
+    before / after: bytes on disk, each inode counted once
+    served_saved: bytes saved over every path, ie serving each tile once
+    """
+    return {
+        "files": 0,
+        "optimized": 0,
+        "shared": 0,
+        "errors": 0,
+        "before": 0,
+        "after": 0,
+        "served_saved": 0,
+    }
+
+
+def optimize_inode(fns, dry=False):
+    """
+    fns: every path to one tile
+    Return new size (unchanged if not smaller)
+    """
+    fn = fns[0]
+    tmp = fn + ".jpegopt"
+    try:
+        subprocess.run(jpegtran_cmd(fn, tmp),
+                       check=True,
+                       stdout=subprocess.DEVNULL,
+                       stderr=subprocess.PIPE)
+        before = os.path.getsize(fn)
+        after = os.path.getsize(tmp)
+        if after >= before:
+            return before
+        if dry:
+            return after
+        shutil.copymode(fn, tmp)
+        # Other paths first, fn last: if interrupted every path still holds
+        # a valid tile
+        for other in fns[1:]:
+            dedup.link_over(tmp, other)
+        os.replace(tmp, fn)
+        return after
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+def iter_optimize_maps(map_dirs, dry=False):
+    """
+    Optimize the tiles of map_dirs together so hardlinks between them
+    are kept
+    Yield (map dir, stats) as each map is finished, see new_stats()
+    """
+    ret = {}
+    # (dev, inode) => [(map dir index, fn, stat)]
+    inodes = {}
+    for i, map_dir in enumerate(map_dirs):
+        ret[map_dir] = new_stats()
+        # ex: custom index.html without a viewer
+        # Counted as an error so the map isn't recorded as done
+        try:
+            if tilepack.is_packed(map_dir):
+                continue
+            fns = dedup.map_tiles(map_dir)
+        except Exception as e:
+            print("%s: skipped: %s" % (map_dir, e))
+            ret[map_dir]["errors"] += 1
+            continue
+        for fn in fns:
+            st = os.stat(fn)
+            ret[map_dir]["files"] += 1
+            inodes.setdefault((st.st_dev, st.st_ino), []).append((i, fn, st))
+
+    # Inodes in order of the first map using them: once those of map i are
+    # done nothing touches map i again
+    todo = {}
+    for paths in inodes.values():
+        todo.setdefault(paths[0][0], []).append(paths)
+    for i, map_dir in enumerate(map_dirs):
+        for paths in todo.get(i, []):
+            optimize_paths(paths, map_dirs, ret, dry=dry)
+        yield map_dir, ret[map_dir]
+
+
+def optimize_paths(paths, map_dirs, ret, dry=False):
+    """
+    Optimize one inode, updating the stats of the maps using it
+    paths: [(map dir index, fn, stat)] sharing the inode
+    """
+    i, fn, st = paths[0]
+    stats = ret[map_dirs[i]]
+    stats["before"] += st.st_size
+    if st.st_nlink > len(paths):
+        stats["shared"] += 1
+        stats["after"] += st.st_size
+        return
+    try:
+        size = optimize_inode([x[1] for x in paths], dry=dry)
+    except subprocess.CalledProcessError as e:
+        print("%s: jpegtran failed: %s" % (fn, e.stderr.decode(
+            "ascii", errors="replace").strip()))
+        stats["errors"] += 1
+        stats["after"] += st.st_size
+        return
+    except OSError as e:
+        # ex: disk full, hardlink limit
+        print("%s: failed: %s" % (fn, e))
+        stats["errors"] += 1
+        stats["after"] += st.st_size
+        return
+    stats["after"] += size
+    if size < st.st_size:
+        stats["optimized"] += 1
+        for path_i, _fn, _st in paths:
+            ret[map_dirs[path_i]]["served_saved"] += st.st_size - size
+
+
+def optimize_maps(map_dirs, dry=False):
+    """
+    Return map dir => stats, see iter_optimize_maps()
+    """
+    return dict(iter_optimize_maps(map_dirs, dry=dry))
+
+
+def add_stats(stats, other):
+    for k, v in other.items():
+        stats[k] = stats.get(k, 0) + v
+    return stats
+
+
+def format_stats(stats):
+    saved = stats["before"] - stats["after"]
+    return "%u tiles, %u optimized, %0.1f MiB => %0.1f MiB (%0.1f%% saved)" % (
+        stats["files"], stats["optimized"], stats["before"] / 1024 / 1024,
+        stats["after"] / 1024 / 1024,
+        100.0 * saved / stats["before"] if stats["before"] else 0.0)
@@ -1,4 +1,7 @@
 from siprawn import env
+import json
+import os
+import sqlite3
 """
 Think this format should be shuffle agnostic
 NOTE: there may be collisions for a (vendor, chipid, basename)
@@ -31,6 +34,157 @@ class CollectionNotFound(Exception):
     pass
 
 
+class DuplicateEntry(Exception):
+    pass
+
+
+def meta_key(entry):
+    return (entry["vendor"], entry["chipid"], entry["type"],
+            entry["basename"])
+
+
+def iter_meta(meta):
+    """
+    Yield every entry in a nested vendor => chipid => [entries] dict
+    """
+    for chipids in meta.values():
+        for entries in chipids.values():
+            for entry in entries:
+                yield entry
+
+
+class MetaIndex:
+    """
+    Metadata entries keyed by (vendor, chipid, type, basename)
+    Collisions are found while building instead of on each lookup
+    """
+    def __init__(self, entries=()):
+        self.entries = {}
+        # key => all entries sharing it
+        self.duplicates = {}
+        for entry in entries:
+            self.add(entry)
+
+    def add(self, entry):
+        key = meta_key(entry)
+        if key in self.duplicates:
+            self.duplicates[key].append(entry)
+        elif key in self.entries:
+            self.duplicates[key] = [self.entries.pop(key), entry]
+        else:
+            self.entries[key] = entry
+
+    def get(self, vendor, chipid, type_, basename):
+        key = (vendor, chipid, type_, basename)
+        if key in self.duplicates:
+            print(self.duplicates[key])
+            raise DuplicateEntry("too many matches")
+        return self.entries.get(key)
+
+    def __len__(self):
+        return len(self.entries) + sum(
+            len(x) for x in self.duplicates.values())
+
+
+class SqliteMetaIndex:
+    """
+    MetaIndex over a database written by write_meta()
+    Lookups are queries so nothing is loaded up front
+    """
+    def __init__(self, fn):
+        self.conn = sqlite3.connect(fn)
+        self.duplicates = {}
+        for row in self.conn.execute("""SELECT vendor, chipid, type, basename
+                FROM meta GROUP BY vendor, chipid, type, basename
+                HAVING COUNT(*) > 1"""):
+            self.duplicates[tuple(row)] = self._select(*row)
+
+    def _select(self, vendor, chipid, type_, basename):
+        return [
+            json.loads(row[0]) for row in self.conn.execute(
+                """SELECT json FROM meta WHERE vendor = ? AND chipid = ?
+                AND type = ? AND basename = ?""", (vendor, chipid, type_,
+                                                   basename))
+        ]
+
+    def get(self, vendor, chipid, type_, basename):
+        key = (vendor, chipid, type_, basename)
+        if key in self.duplicates:
+            print(self.duplicates[key])
+            raise DuplicateEntry("too many matches")
+        ret = self._select(*key)
+        if not ret:
+            return None
+        return ret[0]
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM meta").fetchone()[0]
+
+
+def is_sqlite_fn(fn):
+    return os.path.splitext(fn)[1] in (".db", ".sqlite", ".sqlite3")
+
+
+def is_ndjson_fn(fn):
+    return os.path.splitext(fn)[1] in (".ndjson", ".jsonl")
+
+
+def load_meta_index(fn):
+    """
+    Load a metadata DB as written by the auser_copyright_* scripts
+    .json: nested vendor => chipid => [entries]
+    .ndjson / .jsonl: one entry per line
+    .db / .sqlite: see write_meta()
+    """
+    if is_sqlite_fn(fn):
+        index = SqliteMetaIndex(fn)
+    elif is_ndjson_fn(fn):
+        with open(fn, "r") as f:
+            index = MetaIndex(json.loads(l) for l in f if l.strip())
+    else:
+        with open(fn, "r") as f:
+            index = MetaIndex(iter_meta(json.load(f)))
+    print("Loaded %u entries from %s" % (len(index), fn))
+    if index.duplicates:
+        print("WARNING: %u duplicate keys in %s" %
+              (len(index.duplicates), fn))
+        for key in sorted(index.duplicates):
+            print("  %s" % (key, ))
+    return index
+
+
+def write_meta(meta, fn):
+    """
+    Save a nested metadata dict in the format implied by fn's extension
+    """
+    if is_sqlite_fn(fn):
+        if os.path.exists(fn):
+            os.unlink(fn)
+        conn = sqlite3.connect(fn)
+        with conn:
+            conn.execute("""CREATE TABLE meta (
+                vendor TEXT NOT NULL,
+                chipid TEXT NOT NULL,
+                type TEXT NOT NULL,
+                basename TEXT NOT NULL,
+                json TEXT NOT NULL)""")
+            conn.execute("""CREATE INDEX meta_key
+                ON meta (vendor, chipid, type, basename)""")
+            conn.executemany(
+                "INSERT INTO meta VALUES (?, ?, ?, ?, ?)",
+                ((entry["vendor"], entry["chipid"], entry["type"],
+                  entry["basename"], json.dumps(entry, sort_keys=True))
+                 for entry in iter_meta(meta)))
+        conn.close()
+    elif is_ndjson_fn(fn):
+        with open(fn, "w") as f:
+            for entry in iter_meta(meta):
+                f.write(json.dumps(entry, sort_keys=True) + "\n")
+    else:
+        js = json.dumps(meta, sort_keys=True, indent=4, separators=(',', ': '))
+        open(fn, "w").write(js)
+
+
 def add_meta_image(meta, vendor, chipid, collection, dirname, basename):
     assert vendor
     assert chipid
@@ -74,6 +228,16 @@ def add_meta_map(meta, vendor, chipid, collection, basename):
     return j
 
 
+def merge_meta(meta, other):
+    """
+    Add entries from another nested metadata dict
+    ex: one built by a worker process
+    """
+    for vendor, chipids in other.items():
+        for chipid, entries in chipids.items():
+            meta.setdefault(vendor, {}).setdefault(chipid, []).extend(entries)
+
+
 def load_copyright_db():
     """
     dict of
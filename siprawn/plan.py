@@ -0,0 +1,294 @@
+"""
+Plan / apply for bulk /map migrations
+
+A tool first records everything it would do to each chip dir (renames,
+deletes, manifest entries) into a plan file that can be reviewed
+Applying a plan then works per chip dir, in parallel, rewriting each
+.manifest once
+Every applied chip gets an undo journal:
+
+<journal>/<vendor>_<chipid>.jsonl
+    {"op": "begin", "chip_dir": "...", "manifest": <old .manifest or null>}
+    {"op": "move", "src": "single/a.jpg", "dst": "single/b.jpg"}
+    {"op": "remove", "fn": "single/a.thumb.jpg", "trash": "..."}
+    {"op": "manifest"}
+    {"op": "done"}
+
+Steps are journaled right after they happen so undo only reverts what
+was actually done, even after an interrupted apply
+"""
+
+import datetime
+import functools
+import json
+import os
+import shutil
+from siprawn import simap
+from siprawn import walk
+
+
+class ChipPlan:
+    """
+    Everything to do to one chip dir
+    Paths are relative to chip_dir
+    """
+    def __init__(self, vendor, chipid, chip_dir):
+        self.vendor = vendor
+        self.chipid = chipid
+        self.chip_dir = chip_dir
+        # [(src, dst)]
+        self.moves = []
+        self.removes = []
+        # fn => simap.map_manifest_entry()
+        self.manifest = {}
+
+    def move(self, src, dst):
+        # Already named right (ex: a rerun)
+        if src == dst:
+            return
+        print(f"  mv {src} => {dst}")
+        self.moves.append((src, dst))
+
+    def remove(self, fn):
+        print(f"  rm {fn}")
+        self.removes.append(fn)
+
+    def manifest_add(self, fn, collection, type_, copyright_year=None):
+        print(f"  manifest {type_}: {fn}, collection={collection}")
+        self.manifest[fn] = simap.map_manifest_entry(
+            collection=collection, type_=type_, copyright_year=copyright_year)
+
+    def empty(self):
+        return not (self.moves or self.removes or self.manifest)
+
+    def to_j(self):
+        return {
+            "vendor": self.vendor,
+            "chipid": self.chipid,
+            "chip_dir": self.chip_dir,
+            "moves": self.moves,
+            "removes": self.removes,
+            "manifest": self.manifest,
+        }
+
+    @staticmethod
+    def from_j(j):
+        ret = ChipPlan(j["vendor"], j["chipid"], j["chip_dir"])
+        ret.moves = [tuple(x) for x in j["moves"]]
+        ret.removes = list(j["removes"])
+        ret.manifest = dict(j["manifest"])
+        return ret
+
+
+def save_plan(fn, chips, tool):
+    j = {
+        "tool": tool,
+        "created": datetime.datetime.now().isoformat(),
+        "chips": [chip.to_j() for chip in chips if not chip.empty()],
+    }
+    with open(fn + ".tmp", "w") as f:
+        json.dump(j, f, sort_keys=True, indent=4, separators=(',', ': '))
+    os.replace(fn + ".tmp", fn)
+    print("Wrote plan for %u chip dirs to %s" % (len(j["chips"]), fn))
+
+
+def load_plan(fn):
+    with open(fn, "r") as f:
+        j = json.load(f)
+    return [ChipPlan.from_j(x) for x in j["chips"]]
+
+
+def journal_fn(journal_dir, chip):
+    return os.path.join(journal_dir, "%s_%s.jsonl" % (chip.vendor, chip.chipid))
+
+
+def apply_chip(chip, journal_dir):
+    """
+    Apply one chip's plan, journaling each step
+    """
+    print("Applying", chip.chip_dir)
+    jfn = journal_fn(journal_dir, chip)
+    if os.path.exists(jfn):
+        raise Exception("Already applied (see %s)" % jfn)
+    manifest_fn = os.path.join(chip.chip_dir, ".manifest")
+    old_manifest = None
+    if os.path.exists(manifest_fn):
+        old_manifest = json.load(open(manifest_fn, "r"))
+
+    with open(jfn, "w") as journal:
+
+        def log(op, **kwargs):
+            kwargs["op"] = op
+            journal.write(json.dumps(kwargs, sort_keys=True) + "\n")
+            journal.flush()
+
+        log("begin", chip_dir=chip.chip_dir, manifest=old_manifest)
+        for src, dst in chip.moves:
+            src_fn = os.path.join(chip.chip_dir, src)
+            dst_fn = os.path.join(chip.chip_dir, dst)
+            if src == dst:
+                continue
+            if os.path.exists(dst_fn):
+                if os.path.exists(src_fn) and os.path.samefile(
+                        src_fn, dst_fn):
+                    continue
+                raise Exception("Refusing to overwrite %s" % dst_fn)
+            print(f"  mv {src_fn} => {dst_fn}")
+            shutil.move(src_fn, dst_fn)
+            log("move", src=src, dst=dst)
+        for fn in chip.removes:
+            # Keep a copy so it can be undone
+            trash_fn = os.path.join(journal_dir, "trash", chip.vendor,
+                                    chip.chipid, fn)
+            os.makedirs(os.path.dirname(trash_fn), exist_ok=True)
+            print(f"  rm {os.path.join(chip.chip_dir, fn)}")
+            shutil.move(os.path.join(chip.chip_dir, fn), trash_fn)
+            log("remove", fn=fn, trash=trash_fn)
+        if chip.manifest:
+            print(f"  manifest: {len(chip.manifest)} entries")
+            simap.map_manifest_add_files(chip.chip_dir, chip.manifest)
+            log("manifest")
+        log("done")
+
+
+def undo_chip(jfn):
+    """
+    Revert whatever a (possibly interrupted) apply_chip() did
+    """
+    with open(jfn, "r") as f:
+        steps = [json.loads(l) for l in f if l.endswith("\n")]
+    begin = steps[0]
+    chip_dir = begin["chip_dir"]
+    print("Undoing", chip_dir)
+    manifest_fn = os.path.join(chip_dir, ".manifest")
+    for step in reversed(steps):
+        if step["op"] == "manifest":
+            if begin["manifest"] is None:
+                print(f"  rm {manifest_fn}")
+                os.unlink(manifest_fn)
+            else:
+                print(f"  restore {manifest_fn}")
+                with open(manifest_fn + ".tmp", "w") as f:
+                    json.dump(begin["manifest"],
+                              f,
+                              sort_keys=True,
+                              indent=4,
+                              separators=(',', ': '))
+                os.replace(manifest_fn + ".tmp", manifest_fn)
+        elif step["op"] == "remove":
+            fn = os.path.join(chip_dir, step["fn"])
+            print(f"  restore {fn}")
+            shutil.move(step["trash"], fn)
+        elif step["op"] == "move":
+            src_fn = os.path.join(chip_dir, step["src"])
+            dst_fn = os.path.join(chip_dir, step["dst"])
+            print(f"  mv {dst_fn} => {src_fn}")
+            shutil.move(dst_fn, src_fn)
+    os.rename(jfn, jfn + ".undone")
+
+
+def _try(fn, args):
+    """
+    Return error string or None
+    """
+    try:
+        fn(*args)
+    except Exception as e:
+        error = "%s: %s" % (type(e).__name__, e)
+        print("  ERROR: %s" % error)
+        return error
+    return None
+
+
+def _run_all(fn, argss, jobs):
+    """
+    Return number of failed calls
+    """
+    errors = 0
+    for error in walk.ordered_map(functools.partial(_try, fn), argss,
+                                  jobs=jobs):
+        if error:
+            errors += 1
+    return errors
+
+
+def default_journal_dir(plan_fn):
+    return plan_fn + ".journal"
+
+
+def default_plan_fn(tool):
+    # ex: auser_map2unk_2023-06-23_12-00-00.plan.json
+    return "%s_%s.plan.json" % (
+        tool, datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S"))
+
+
+def save_apply(chips, tool, plan_fn=None, dry=True, jobs=1):
+    """
+    Common end of a planning tool's run
+    Always keep the plan next to the journal of what was applied
+    """
+    if not dry and not plan_fn:
+        plan_fn = default_plan_fn(tool)
+    if plan_fn:
+        save_plan(plan_fn, chips, tool)
+    if dry:
+        print("dry: not applying")
+        return 0
+    return apply_plan([chip for chip in chips if not chip.empty()],
+                      default_journal_dir(plan_fn),
+                      jobs=jobs)
+
+
+def apply_plan(chips, journal_dir, jobs=1):
+    """
+    Apply chip plans in parallel
+    A failed chip doesn't stop the others. Undo it with its journal
+    Return number of failed chips
+    """
+    os.makedirs(journal_dir, exist_ok=True)
+    print("Applying %u chip dirs, journal %s" % (len(chips), journal_dir))
+    errors = _run_all(apply_chip, [(chip, journal_dir) for chip in chips],
+                      jobs)
+    print("Applied %u chip dirs, %u failed" % (len(chips) - errors, errors))
+    return errors
+
+
+def undo_plan(journal_dir, jobs=1):
+    jfns = sorted(
+        os.path.join(journal_dir, x) for x in os.listdir(journal_dir)
+        if x.endswith(".jsonl"))
+    print("Undoing %u chip dirs" % len(jfns))
+    errors = _run_all(undo_chip, [(jfn, ) for jfn in jfns], jobs)
+    print("Undid %u chip dirs, %u failed" % (len(jfns) - errors, errors))
+    return errors
+
+
+def add_plan_args(parser):
+    parser.add_argument("--plan",
+                        metavar="FN",
+                        help="Write the plan here for review")
+    parser.add_argument("--apply",
+                        metavar="PLAN",
+                        help="Apply a previously written plan")
+    parser.add_argument("--undo",
+                        metavar="JOURNAL",
+                        help="Revert an applied plan using its journal dir")
+    parser.add_argument("--journal",
+                        metavar="DIR",
+                        help="Undo journal dir (default: <plan>.journal)")
+
+
+def run_plan_args(args, jobs=1):
+    """
+    Handle --apply / --undo
+    Return True if one was given (nothing left to do)
+    """
+    if args.apply:
+        apply_plan(load_plan(args.apply),
+                   args.journal or default_journal_dir(args.apply),
+                   jobs=jobs)
+        return True
+    if args.undo:
+        undo_plan(args.undo, jobs=jobs)
+        return True
+    return False
@@ -0,0 +1,123 @@
+"""
+Bulk find / replace over wiki pages
+
+A whole rename mapping is compiled into one regex alternation so each
+page is scanned once no matter how many patterns there are:
+{"/intel/i8080/": "/intel/i8080a/", "/intel_i8080_": "/intel_i8080a_"}
+
+Where patterns overlap at the same position the longest one wins
+Replacements aren't rescanned, so a -> b, b -> c maps a to b not c
+Patterns given as whole only match a complete name:
+vendor_foo doesn't match inside vendor_foobar or vendor_foo-bar
+"""
+
+import difflib
+import functools
+import os
+import re
+import shutil
+from siprawn import wiki
+
+# Can continue a vendor / chipid / tag, see util.validate_vendor()
+NAME_END = r"(?![a-z0-9_\-])"
+
+
+class Rewriter:
+    def __init__(self, mapping, whole=()):
+        # Old => new, dropping no-ops
+        self.mapping = dict((k, v) for k, v in mapping.items() if k != v)
+        self.whole = set(whole)
+        self.regex = None
+        if self.mapping:
+            self.regex = re.compile("|".join(
+                re.escape(k) + (NAME_END if k in self.whole else "")
+                for k in sorted(self.mapping, key=len, reverse=True)))
+
+    def apply(self, txt):
+        """
+        Return (new text, pattern => number of replacements)
+        """
+        counts = {}
+        if not self.regex:
+            return txt, counts
+
+        def replace(m):
+            old = m.group(0)
+            counts[old] = counts.get(old, 0) + 1
+            return self.mapping[old]
+
+        return self.regex.sub(replace, txt), counts
+
+    def missing(self, counts):
+        """
+        Patterns that weren't found
+        """
+        return sorted(k for k in self.mapping if k not in counts)
+
+
+def unified_diff(old, new, fn=""):
+    return "".join(
+        difflib.unified_diff(old.splitlines(keepends=True),
+                             new.splitlines(keepends=True),
+                             fromfile=fn,
+                             tofile=fn))
+
+
+def write_page(fn, txt):
+    """
+    Replace a page without leaving it half written
+    """
+    with open(fn + ".tmp", "w") as f:
+        f.write(txt)
+    shutil.copymode(fn, fn + ".tmp")
+    os.replace(fn + ".tmp", fn)
+
+
+def rewrite_page(fn, rewriter, dry=True):
+    """
+    Return number of replacements
+    Dry runs print a unified diff instead of writing
+    """
+    with open(fn, "r") as f:
+        txt = f.read()
+    new, counts = rewriter.apply(txt)
+    if new == txt:
+        return 0
+    n = sum(counts.values())
+    print("%s: %u replacements" % (fn, n))
+    if dry:
+        print(unified_diff(txt, new, fn), end="")
+    else:
+        write_page(fn, new)
+    return n
+
+
+# Set per worker by load_rewriter()
+g_rewriter = None
+
+
+def load_rewriter(mapping):
+    global g_rewriter
+    g_rewriter = Rewriter(mapping)
+
+
+def _rewrite_page(fn, dry):
+    return rewrite_page(fn, g_rewriter, dry=dry)
+
+
+def rewrite_pages(pages, mapping, dry=True, jobs=1):
+    """
+    Apply mapping to every page over a process pool
+    Return (pages changed, total replacements)
+    """
+    npages = 0
+    nreplacements = 0
+    for n in wiki.map_pages(functools.partial(_rewrite_page, dry=dry),
+                            pages,
+                            jobs=jobs,
+                            initializer=load_rewriter,
+                            initargs=(mapping, )):
+        if n:
+            npages += 1
+            nreplacements += n
+    return npages, nreplacements
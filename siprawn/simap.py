@@ -8,11 +8,35 @@ import subprocess
 import img2doku
 
 
+def map_manifest_entry(collection, type_, copyright_year=None):
+    assert type_ in ("image", "map")
+    if not copyright_year:
+        copyright_year = datetime.datetime.now().year
+    return {
+        "collection": collection,
+        "type": type_,
+        "copyright_year": copyright_year,
+    }
+
+
 def map_manifest_add_file(basedir, fn, collection, type_, copyright_year=None):
     """
     JSON with explicit copyright information
     """
-    assert type_ in ("image", "map")
+    map_manifest_add_files(
+        basedir, {
+            fn:
+            map_manifest_entry(collection=collection,
+                               type_=type_,
+                               copyright_year=copyright_year)
+        })
+
+
+def map_manifest_add_files(basedir, files):
+    """
+    Add / replace several entries with a single manifest rewrite
+    files: dict of relative file name to map_manifest_entry()
+    """
     jfn = os.path.join(basedir, ".manifest")
     if os.path.exists(jfn):
         j = json.load(open(jfn))
@@ -21,16 +45,10 @@ def map_manifest_add_file(basedir, fn, collection, type_, copyright_year=None):
             "files": {},
         }
 
-    if not copyright_year:
-        copyright_year = datetime.datetime.now().year
-
-    if fn[0] == "/":
-        raise ValueError("Require relative path")
-    j["files"][fn] = {
-        "collection": collection,
-        "type": type_,
-        "copyright_year": copyright_year,
-    }
+    for fn, entry in files.items():
+        if fn[0] == "/":
+            raise ValueError("Require relative path")
+        j["files"][fn] = entry
 
     # Be really careful not to corrupt records
     json.dump(j,
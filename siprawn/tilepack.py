@@ -0,0 +1,214 @@
+"""
+Packed GroupXIV tile storage
+
+A map normally has one file per tile:
+<map>/index.html
+<map>/l1/<zoom>/<x>_<y>.jpg
+
+Packed, each zoom level becomes a single file:
+<map>/l1/<zoom>.pack
+
+A .pack is the level's tiles back to back, then a JSON index of
+tile name => [offset, size], then a fixed size trailer:
+    8 bytes magic
+    8 bytes little endian offset of the JSON index
+so a reader only needs the trailer + index to find any tile
+
+The viewer still requests l1/<zoom>/<x>_<y>.jpg, see tile_server.py
+"""
+
+import json
+import os
+import shutil
+import struct
+from siprawn import viewer
+
+PACK_EXT = ".pack"
+MAGIC = b"SIPACK01"
+TRAILER = struct.Struct("<8sQ")
+
+
+class BadPack(Exception):
+    pass
+
+
+def write_pack(fn, tiles):
+    """
+    tiles: iterable of (name, file name)
+    Return (tiles, bytes of tile data)
+    """
+    index = {}
+    offset = 0
+    with open(fn + ".tmp", "wb") as f:
+        for name, tile_fn in tiles:
+            with open(tile_fn, "rb") as tile_f:
+                buf = tile_f.read()
+            f.write(buf)
+            index[name] = [offset, len(buf)]
+            offset += len(buf)
+        f.write(json.dumps(index, sort_keys=True).encode("ascii"))
+        f.write(TRAILER.pack(MAGIC, offset))
+    os.replace(fn + ".tmp", fn)
+    return len(index), offset
+
+
+class Pack:
+    """
+    Read tiles from a .pack
+    """
+    def __init__(self, fn):
+        self.fn = fn
+        with open(fn, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size < TRAILER.size:
+                raise BadPack("Truncated: %s" % fn)
+            f.seek(size - TRAILER.size)
+            magic, index_offset = TRAILER.unpack(f.read(TRAILER.size))
+            if magic != MAGIC:
+                raise BadPack("Bad magic: %s" % fn)
+            f.seek(index_offset)
+            self.index = json.loads(f.read(size - TRAILER.size -
+                                           index_offset))
+
+    def names(self):
+        return sorted(self.index)
+
+    def get(self, name):
+        """
+        Return tile bytes or None if not in the pack
+        """
+        entry = self.index.get(name)
+        if entry is None:
+            return None
+        offset, size = entry
+        with open(self.fn, "rb") as f:
+            f.seek(offset)
+            return f.read(size)
+
+
+def layer_dirs(map_dir):
+    """
+    Tile dirs referenced by the map's viewer, usually just l1
+    """
+    j = viewer.read_viewer_meta(os.path.join(map_dir, "index.html"))
+    return [
+        os.path.join(map_dir, layer.get("URL", "l1"))
+        for layer in j["layers"]
+    ]
+
+
+def level_dirs(layer_dir):
+    """
+    Yield (zoom, dir) of unpacked levels
+    """
+    if not os.path.isdir(layer_dir):
+        return
+    for entry in sorted(os.scandir(layer_dir), key=lambda x: x.name):
+        if entry.is_dir():
+            yield entry.name, entry.path
+
+
+def is_packed(map_dir):
+    for layer_dir in layer_dirs(map_dir):
+        if os.path.isdir(layer_dir) and any(
+                fn.endswith(PACK_EXT) for fn in os.listdir(layer_dir)):
+            return True
+    return False
+
+
+def pack_level(level_dir, pack_fn, dry=False):
+    """
+    Pack one zoom level and remove its tile files
+    Return (tiles, bytes)
+    """
+    tiles = sorted(
+        (entry.name, entry.path) for entry in os.scandir(level_dir)
+        if entry.is_file())
+    if dry:
+        return len(tiles), sum(os.path.getsize(fn) for _name, fn in tiles)
+    ret = write_pack(pack_fn, tiles)
+    # Make sure it reads back before deleting anything
+    pack = Pack(pack_fn)
+    for name, tile_fn in tiles:
+        if pack.index[name][1] != os.path.getsize(tile_fn):
+            raise BadPack("Verify failed: %s %s" % (pack_fn, name))
+    shutil.rmtree(level_dir)
+    return ret
+
+
+def pack_map(map_dir, dry=False):
+    """
+    Return (tiles, bytes) packed
+    """
+    ntiles = 0
+    nbytes = 0
+    for layer_dir in layer_dirs(map_dir):
+        for zoom, level_dir in level_dirs(layer_dir):
+            tiles, size = pack_level(level_dir,
+                                     os.path.join(layer_dir,
+                                                  zoom + PACK_EXT),
+                                     dry=dry)
+            ntiles += tiles
+            nbytes += size
+    return ntiles, nbytes
+
+
+def unpack_map(map_dir, dry=False):
+    """
+    Back to one file per tile
+    Return tiles unpacked
+    """
+    ntiles = 0
+    for layer_dir in layer_dirs(map_dir):
+        if not os.path.isdir(layer_dir):
+            continue
+        for fn in sorted(os.listdir(layer_dir)):
+            if not fn.endswith(PACK_EXT):
+                continue
+            pack_fn = os.path.join(layer_dir, fn)
+            pack = Pack(pack_fn)
+            ntiles += len(pack.index)
+            if dry:
+                continue
+            level_dir = os.path.join(layer_dir, fn[:-len(PACK_EXT)])
+            os.makedirs(level_dir, exist_ok=True)
+            for name in pack.names():
+                with open(os.path.join(level_dir, name), "wb") as f:
+                    f.write(pack.get(name))
+            os.unlink(pack_fn)
+    return ntiles
+
+
+def split_tile_path(path):
+    """
+    l1/3/2_5.jpg => (l1/3.pack, 2_5.jpg)
+    """
+    level_path, name = os.path.split(path)
+    return level_path + PACK_EXT, name
+
+
+class PackCache:
+    """
+    Open packs for a long running server, reloaded if the file changes
+    """
+    def __init__(self):
+        self.packs = {}
+
+    def get(self, pack_fn):
+        st = os.stat(pack_fn)
+        key = (st.st_mtime, st.st_size)
+        entry = self.packs.get(pack_fn)
+        if not entry or entry[0] != key:
+            entry = (key, Pack(pack_fn))
+            self.packs[pack_fn] = entry
+        return entry[1]
+
+    def read_tile(self, tile_fn):
+        """
+        Return tile bytes for a would be tile file name, or None
+        """
+        pack_fn, name = split_tile_path(tile_fn)
+        if not os.path.exists(pack_fn):
+            return None
+        return self.get(pack_fn).get(name)
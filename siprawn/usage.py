@@ -0,0 +1,342 @@
+"""
+Disk usage per asset so totals by collection / vendor / chip don't need
+a du over all of /map and archive/data/media
+
+SQLite table, one row per asset:
+    area: "map" or "media"
+    asset: path relative to the area's root
+        map: intel/80502/mcmaster_mz or intel/80502/single/<fn>.jpg
+        media: mcmaster/intel/80502
+    bytes: disk usage (allocated blocks, like du) counting hardlinks once
+    files: files (inodes)
+    shared_bytes: part of bytes already counted by an earlier asset, ex:
+        tiles hardlinked across a collection's maps (see siprawn.dedup)
+
+simapper and sipager record what they add, reconcile() rescans
+everything to fix drift (deletes, renames, dedup, re-optimization, ...)
+Only reconcile() sees links between assets: until it runs a newly
+recorded asset has shared_bytes 0
+Totals (summary()) subtract shared_bytes so each inode counts once
+
+Quotas are JSON, collection => max bytes:
+{"mcmaster": 2000000000000}
+"""
+
+import json
+import os
+import sqlite3
+import time
+from siprawn import env
+from siprawn import walk
+
+MAP = "map"
+MEDIA = "media"
+
+# summary() grouping => columns
+BY_COLUMNS = {
+    "collection": ("collection", ),
+    "vendor": ("vendor", ),
+    "chip": ("vendor", "chipid"),
+}
+
+
+def usage_fn():
+    env.setup_env_default()
+    return env.USAGE_FN
+
+
+def quotas_fn():
+    env.setup_env_default()
+    return env.QUOTAS_FN
+
+
+def connect(fn=None):
+    if fn is None:
+        fn = usage_fn()
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    # simapper and sipager may write at the same time
+    conn = sqlite3.connect(fn, timeout=60)
+    conn.execute("""CREATE TABLE IF NOT EXISTS usage (
+        area TEXT, asset TEXT, collection TEXT, vendor TEXT, chipid TEXT,
+        bytes INTEGER, files INTEGER, updated REAL,
+        shared_bytes INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (area, asset))""")
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(usage)")]
+    # Made before shared_bytes
+    if "shared_bytes" not in columns:
+        with conn:
+            conn.execute("""ALTER TABLE usage
+                ADD COLUMN shared_bytes INTEGER NOT NULL DEFAULT 0""")
+    return conn
+
+
+def du_links(path):
+    """
+    Return (bytes, files, links) like du, hardlinked files counted once
+    links: (dev, inode) => bytes of files with more than one link
+    """
+    st = os.lstat(path)
+    if not os.path.isdir(path):
+        links = {}
+        if st.st_nlink > 1:
+            links[(st.st_dev, st.st_ino)] = st.st_blocks * 512
+        return st.st_blocks * 512, 1, links
+    nbytes = 0
+    files = 0
+    links = {}
+    for root, _dirs, fns in os.walk(path):
+        for fn in fns:
+            st = os.lstat(os.path.join(root, fn))
+            if st.st_nlink > 1:
+                inode = (st.st_dev, st.st_ino)
+                if inode in links:
+                    continue
+                links[inode] = st.st_blocks * 512
+            nbytes += st.st_blocks * 512
+            files += 1
+    return nbytes, files, links
+
+
+def du(path):
+    """
+    Return (bytes, files), see du_links()
+    """
+    nbytes, files, _links = du_links(path)
+    return nbytes, files
+
+
+def _upsert(conn,
+            area,
+            asset,
+            collection,
+            vendor,
+            chipid,
+            nbytes,
+            files,
+            shared_bytes=0):
+    conn.execute(
+        """INSERT OR REPLACE INTO usage
+        (area, asset, collection, vendor, chipid, bytes, files, updated,
+        shared_bytes)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        (area, asset, collection, vendor, chipid, nbytes, files, time.time(),
+         shared_bytes))
+
+
+def record(area, asset, path, collection, vendor, chipid, fn=None):
+    """
+    Measure path and store it as asset
+    Best effort: broken accounting shouldn't fail an import
+    """
+    try:
+        nbytes, files = du(path)
+        conn = connect(fn)
+        with conn:
+            _upsert(conn, area, asset, collection, vendor, chipid, nbytes,
+                    files)
+        conn.close()
+    except (OSError, sqlite3.Error) as e:
+        print("WARNING: failed to record usage of %s: %s" % (path, e))
+        return None
+    print("Usage: %s %s: %0.1f MiB, %u files" %
+          (area, asset, nbytes / 1024 / 1024, files))
+    return nbytes, files
+
+
+def record_map_asset(path, collection, vendor, chipid, fn=None):
+    """
+    Single image or map dir under env.MAP_DIR
+    """
+    return record(MAP,
+                  os.path.relpath(path, env.MAP_DIR),
+                  path,
+                  collection=collection,
+                  vendor=vendor,
+                  chipid=chipid,
+                  fn=fn)
+
+
+def media_dir():
+    env.setup_env_default()
+    return os.path.join(env.ARCHIVE_WIKI_DIR, "data/media")
+
+
+def record_media(user, vendor, chipid, fn=None):
+    """
+    A page's media dir, data/media/<user>/<vendor>/<chipid>
+    """
+    asset = "%s/%s/%s" % (user, vendor, chipid)
+    path = os.path.join(media_dir(), asset)
+    # Pages without images
+    if not os.path.exists(path):
+        return None
+    return record(MEDIA,
+                  asset,
+                  path,
+                  collection=user,
+                  vendor=vendor,
+                  chipid=chipid,
+                  fn=fn)
+
+
+def load_manifest(chip_dir):
+    fn = os.path.join(chip_dir, ".manifest")
+    if not os.path.exists(fn):
+        return {}
+    with open(fn, "r") as f:
+        return json.load(f)["files"]
+
+
+def scan_chip(records):
+    """
+    Return [(area, asset, collection, vendor, chipid, bytes, files, links)]
+    links: see du_links()
+    Collection comes from the manifest, else the file name
+    """
+    ret = []
+    manifest = None
+    for record_ in records:
+        if record_.type == walk.CHIP_DIR:
+            manifest = load_manifest(record_.path)
+            continue
+        if record_.type == walk.SINGLE_IMAGE:
+            rel = "single/" + record_.name
+            prefix = "%s_%s_" % (record_.vendor, record_.chipid)
+            guess = walk.map_collection(record_.name[len(prefix):])
+        elif record_.type == walk.MAP_DIR:
+            rel = record_.name
+            guess = walk.map_collection(record_.name)
+        else:
+            continue
+        collection = manifest.get(rel, {}).get("collection", guess)
+        nbytes, files, links = du_links(record_.path)
+        asset = "%s/%s/%s" % (record_.vendor, record_.chipid, rel)
+        ret.append((MAP, asset, collection, record_.vendor, record_.chipid,
+                    nbytes, files, links))
+    return ret
+
+
+def scan_media(root):
+    """
+    Yield (area, asset, collection, vendor, chipid, bytes, files, links)
+    """
+    if not os.path.isdir(root):
+        return
+    for user in sorted(os.listdir(root)):
+        user_dir = os.path.join(root, user)
+        if not os.path.isdir(user_dir):
+            continue
+        for vendor in sorted(os.listdir(user_dir)):
+            vendor_dir = os.path.join(user_dir, vendor)
+            if not os.path.isdir(vendor_dir):
+                continue
+            for chipid in sorted(os.listdir(vendor_dir)):
+                chip_dir = os.path.join(vendor_dir, chipid)
+                if not os.path.isdir(chip_dir):
+                    continue
+                nbytes, files, links = du_links(chip_dir)
+                yield (MEDIA, "%s/%s/%s" % (user, vendor, chipid), user,
+                       vendor, chipid, nbytes, files, links)
+
+
+def reconcile(fn=None, map_dir=None, media_root=None, jobs=1):
+    """
+    Rescan everything and make the table match
+    Return number of rows added, changed or removed
+    """
+    if map_dir is None:
+        map_dir = walk.default_map_dir()
+    if media_root is None:
+        media_root = media_dir()
+    rows = []
+    for chip_rows in walk.map_chips(scan_chip, map_dir=map_dir, jobs=jobs):
+        rows += chip_rows
+    rows += list(scan_media(media_root))
+
+    conn = connect(fn)
+    old = dict(((area, asset), (nbytes, files, shared_bytes))
+               for area, asset, nbytes, files, shared_bytes in conn.execute(
+                   "SELECT area, asset, bytes, files, shared_bytes FROM usage"))
+    drift = 0
+    # Hardlinked inodes: only the first asset using one is charged for it
+    counted = set()
+    with conn:
+        for row in rows:
+            area, asset = row[0:2]
+            links = row[7]
+            shared_bytes = sum(nbytes for inode, nbytes in links.items()
+                               if inode in counted)
+            counted.update(links)
+            row = row[0:7] + (shared_bytes, )
+            was = old.pop((area, asset), None)
+            if was != tuple(row[5:8]):
+                drift += 1
+                print("  %s %s: %s" %
+                      (area, asset, "changed" if was else "new"))
+            _upsert(conn, *row)
+        for area, asset in old:
+            drift += 1
+            print("  %s %s: gone" % (area, asset))
+            conn.execute("DELETE FROM usage WHERE area = ? AND asset = ?",
+                         (area, asset))
+    conn.close()
+    return drift
+
+
+def summary(by="collection", fn=None):
+    """
+    Return [(key..., bytes, files)] largest first
+    by: see BY_COLUMNS
+    Hardlinked files shared between assets count once in bytes, files
+    counts them in each asset
+    """
+    columns = ", ".join(BY_COLUMNS[by])
+    conn = connect(fn)
+    ret = [
+        tuple(row) for row in conn.execute(
+            """SELECT %s, SUM(bytes - shared_bytes) AS total, SUM(files)
+            FROM usage GROUP BY %s
+            ORDER BY total DESC""" % (columns, columns))
+    ]
+    conn.close()
+    return ret
+
+
+def load_quotas(fn=None):
+    if fn is None:
+        fn = quotas_fn()
+    if not os.path.exists(fn):
+        return {}
+    with open(fn, "r") as f:
+        return json.load(f)
+
+
+def over_quota(quotas, fn=None):
+    """
+    Return [(collection, bytes, quota)] for collections over their quota
+    """
+    ret = []
+    for collection, nbytes, _files in summary("collection", fn=fn):
+        quota = quotas.get(collection)
+        if quota is not None and nbytes > quota:
+            ret.append((collection, nbytes, quota))
+    return ret
+
+
+def check_quota(collection, fn=None, quotas_fn_=None):
+    """
+    Warn if collection is over its quota
+    Best effort like record()
+    """
+    try:
+        over = [
+            x for x in over_quota(load_quotas(quotas_fn_), fn=fn)
+            if x[0] == collection
+        ]
+    except (OSError, ValueError, sqlite3.Error) as e:
+        print("WARNING: failed to check quota: %s" % (e, ))
+        return False
+    for collection, nbytes, quota in over:
+        print("WARNING: collection %s over quota: %0.1f / %0.1f GiB" %
+              (collection, nbytes / 1024**3, quota / 1024**3))
+    return bool(over)
@@ -0,0 +1,97 @@
+"""
+GroupXIV viewer metadata embedded in map index.html files
+
+initViewer({"tilesAlignedTopLeft": true, "scale": null, "layers": [{"imageSize": 4096, "tileExt": ".jpg", "width": 31000, "height": 31000, "URL": "l1", "tileSize": 250, "name": "???", "copyright": "2018 John McMaster, CC BY"}], "name": "out, &copy;2018 John McMaster, CC BY", "name_raw": "out"});
+
+Parsing thousands of these is mostly I/O so ViewerIndex remembers the
+result per file until its mtime / size changes
+"""
+
+import json
+import os
+
+# Shared by auser_copyright_map, fixmap, etc
+VIEWER_INDEX_FN = os.path.expanduser("~/.cache/siprawn/viewer_index.json")
+
+
+class ViewerNotFound(Exception):
+    pass
+
+
+def parse_init_viewer(l):
+    l = l.strip()
+    l = l[l.find("initViewer(") + len("initViewer("):]
+    # remove );
+    l = l.rstrip(";").rstrip()
+    assert l[-1] == ")", l
+    return json.loads(l[:-1])
+
+
+def read_viewer_meta(fn):
+    """
+    Return the initViewer() argument
+    Stops reading at the initViewer line
+    """
+    with open(fn, "r") as f:
+        for l in f:
+            if "initViewer(" in l:
+                return parse_init_viewer(l)
+    raise ViewerNotFound("Failed to find initViewer: %s" % fn)
+
+
+class ViewerIndex:
+    """
+    index.html path => viewer metadata, reused while mtime / size match
+    Pages without a viewer are remembered too
+
+    Workers in another process can ship their new entries back with
+    take_new() / merge()
+    """
+    def __init__(self, fn=VIEWER_INDEX_FN):
+        self.fn = fn
+        self.entries = {}
+        # Looked up since load / take_new()
+        self.new = {}
+        if fn and os.path.exists(fn):
+            with open(fn, "r") as f:
+                self.entries = json.load(f)
+
+    def get(self, html_fn):
+        """
+        Like read_viewer_meta()
+        """
+        st = os.stat(html_fn)
+        entry = self.entries.get(html_fn)
+        if not entry or entry["mtime"] != st.st_mtime or entry[
+                "size"] != st.st_size:
+            entry = {
+                "mtime": st.st_mtime,
+                "size": st.st_size,
+            }
+            try:
+                entry["meta"] = read_viewer_meta(html_fn)
+            except ViewerNotFound:
+                entry["meta"] = None
+            self.entries[html_fn] = entry
+            self.new[html_fn] = entry
+        if entry["meta"] is None:
+            raise ViewerNotFound("Failed to find initViewer: %s" % html_fn)
+        return entry["meta"]
+
+    def take_new(self):
+        ret = self.new
+        self.new = {}
+        return ret
+
+    def merge(self, entries):
+        self.entries.update(entries)
+        self.new.update(entries)
+
+    def save(self):
+        if not self.fn or not self.new:
+            return
+        os.makedirs(os.path.dirname(self.fn), exist_ok=True)
+        with open(self.fn + ".tmp", "w") as f:
+            json.dump(self.entries, f, sort_keys=True)
+        os.replace(self.fn + ".tmp", self.fn)
+        self.new = {}
@@ -0,0 +1,187 @@
+"""
+Walk the /map tree
+
+/map/<vendor>/<chipid>/
+    .manifest
+    single/<vendor>_<chipid>_<collection>_<flavor>.jpg
+    <collection>_<flavor>/index.html
+
+Everything is done with os.scandir() so file types come from the
+directory listing instead of a stat() per entry
+Chip dirs are independent so per chip work can be fanned out over a
+process pool
+"""
+
+import concurrent.futures
+import contextlib
+import functools
+import io
+import os
+from collections import namedtuple
+from siprawn import env
+
+# Record types
+CHIP_DIR = "chip_dir"
+MANIFEST = "manifest"
+SINGLE_IMAGE = "single_image"
+MAP_DIR = "map_dir"
+"""
+type: one of the above
+path: absolute path of the file / dir
+name: basename of path
+"""
+Record = namedtuple("Record", "type vendor chipid chip_dir path name")
+
+
+def map_collection(name):
+    """
+    Map dir name => collection
+    mcmaster_mz_mit20x => mcmaster
+    """
+    return name.split("_")[0]
+
+
+def default_map_dir():
+    env.setup_env_default()
+    return env.MAP_DIR
+
+
+def chip_dirs(map_dir=None, vendor=None, chipid=None):
+    """
+    Yield (vendor, chipid, chip dir) sorted by vendor then chipid
+    vendor / chipid: only walk matching dirs
+    """
+    if map_dir is None:
+        map_dir = default_map_dir()
+    vendors = sorted((x.name, x.path) for x in os.scandir(map_dir)
+                     if x.is_dir())
+    for this_vendor, vendor_dir in vendors:
+        if vendor and this_vendor != vendor:
+            continue
+        chipids = sorted((x.name, x.path) for x in os.scandir(vendor_dir)
+                         if x.is_dir())
+        for this_chipid, chip_dir in chipids:
+            if chipid and this_chipid != chipid:
+                continue
+            yield this_vendor, this_chipid, chip_dir
+
+
+def scan_chip(vendor, chipid, chip_dir):
+    """
+    Return records for one chip dir: the chip dir itself, then its
+    manifest (if any), single/ files and map dirs, each sorted by name
+    Single images includes thumbnails, callers filter as needed
+    """
+    ret = [Record(CHIP_DIR, vendor, chipid, chip_dir, chip_dir, chipid)]
+    singles = []
+    maps = []
+    for entry in os.scandir(chip_dir):
+        if entry.name == ".manifest" and entry.is_file():
+            ret.append(
+                Record(MANIFEST, vendor, chipid, chip_dir, entry.path,
+                       entry.name))
+        elif entry.name == "single" and entry.is_dir():
+            for single in os.scandir(entry.path):
+                if single.is_file():
+                    singles.append(
+                        Record(SINGLE_IMAGE, vendor, chipid, chip_dir,
+                               single.path, single.name))
+        elif entry.is_dir() and os.path.exists(
+                os.path.join(entry.path, "index.html")):
+            maps.append(
+                Record(MAP_DIR, vendor, chipid, chip_dir, entry.path,
+                       entry.name))
+    ret += sorted(singles, key=lambda x: x.name)
+    ret += sorted(maps, key=lambda x: x.name)
+    return ret
+
+
+def walk(map_dir=None, vendor=None, chipid=None):
+    """
+    Yield every record in the tree
+    """
+    for this_vendor, this_chipid, chip_dir in chip_dirs(map_dir=map_dir,
+                                                        vendor=vendor,
+                                                        chipid=chipid):
+        for record in scan_chip(this_vendor, this_chipid, chip_dir):
+            yield record
+
+
+def _worker(fn, item):
+    """
+    Process pool entry point
+    Output is buffered so items print in order instead of interleaved
+    """
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        ret = fn(item)
+    return out.getvalue(), ret
+
+
+def ordered_map(fn, items, jobs=1, initializer=None, initargs=()):
+    """
+    Yield fn(item) for each item
+    Results (and anything fn prints) come back in item order regardless
+    of jobs
+
+    fn must be picklable when jobs > 1 (ex: module level function or a
+    functools.partial of one)
+    initializer(*initargs) runs once per worker, ex: to load a DB
+    """
+    if jobs <= 1:
+        if initializer:
+            initializer(*initargs)
+        for item in items:
+            yield fn(item)
+        return
+
+    items = list(items)
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=initializer,
+            initargs=initargs) as pool:
+        for out, ret in pool.map(_worker, [fn] * len(items), items):
+            print(out, end="")
+            yield ret
+
+
+def _scan_chip_call(fn, chip):
+    return fn(scan_chip(*chip))
+
+
+def map_chips(fn,
+              map_dir=None,
+              vendor=None,
+              chipid=None,
+              jobs=1,
+              initializer=None,
+              initargs=()):
+    """
+    Call fn(records) for each chip dir and yield the return values
+    See ordered_map()
+    """
+    return ordered_map(functools.partial(_scan_chip_call, fn),
+                       chip_dirs(map_dir=map_dir, vendor=vendor,
+                                 chipid=chipid),
+                       jobs=jobs,
+                       initializer=initializer,
+                       initargs=initargs)
+
+
+def add_walk_args(parser):
+    parser.add_argument("--vendor", help="Only walk this vendor")
+    parser.add_argument("--chipid", help="Only walk this chipid")
+    parser.add_argument("--jobs",
+                        type=int,
+                        default=1,
+                        help="Chip dirs to process in parallel")
+
+
+def walk_kwargs(args):
+    """
+    map_chips() kwargs from add_walk_args() args
+    """
+    return {
+        "vendor": args.vendor,
+        "chipid": args.chipid,
+        "jobs": args.jobs,
+    }
@@ -0,0 +1,337 @@
+"""
+Walk DokuWiki collection pages and the links on them
+
+data/pages/<collection>/start.txt has {{tag>collection}}
+data/pages/<collection>/<vendor>/<chipid>.txt
+
+Most runs only care about the URLs on each page, so LinkIndex remembers
+them per page until the page's mtime / size changes
+BacklinkIndex inverts that to find which pages link to a /map asset,
+and is kept up to date the same way
+"""
+
+import json
+import os
+import re
+from siprawn import env
+from siprawn import walk
+
+LINK_INDEX_FN = os.path.expanduser("~/.cache/siprawn/link_index.json")
+
+
+def extract_links(txt):
+    """
+    Return URLs in page order, duplicates included
+    [[https://siliconprawn.org/map/intel/80502/mz_mit5x/|MZ @ mit5x]]
+    => https://siliconprawn.org/map/intel/80502/mz_mit5x/
+    """
+    ret = []
+    for url in re.findall(r'(https?://[^\s]+)', txt):
+        ppos = url.find("|")
+        if ppos >= 0:
+            url = url[0:ppos]
+        ret.append(url)
+    return ret
+
+
+def extract_tags(txt):
+    """
+    {{tag>collection foo}} => ["collection", "foo"]
+    """
+    ret = []
+    for tags in re.findall(r'\{\{tag>([^}]*)\}\}', txt):
+        ret += tags.split()
+    return ret
+
+
+def map_asset(url):
+    """
+    Return the /map path a URL points to, or None if it isn't a map URL
+    https://siliconprawn.org/map/intel/80502/mz_mit5x/ => intel/80502/mz_mit5x/
+    Any host, we've had a few domains
+    """
+    m = re.search(r'://[^/\s]+/map/([^\s?#]+)', url)
+    if not m:
+        return None
+    asset = m.group(1)
+    parts = asset.rstrip("/").split("/")
+    # Need at least vendor/chipid
+    if len(parts) < 2:
+        return None
+    # .../map/intel/80502 => intel/80502/
+    if len(parts) == 2:
+        asset = "/".join(parts) + "/"
+    return asset
+
+
+def chip_key(asset):
+    """
+    intel/80502/mz_mit5x/ => intel/80502
+    """
+    return "/".join(asset.split("/")[:2])
+
+
+def default_pages_dir():
+    env.setup_env_default()
+    return os.path.join(env.ARCHIVE_WIKI_DIR, "data/pages")
+
+
+def all_pages(pages_dir=None):
+    """
+    Return every sorted .txt page, not just collection pages
+    """
+    if pages_dir is None:
+        pages_dir = default_pages_dir()
+    ret = []
+    for root, _dirs, files in os.walk(pages_dir):
+        for fn in files:
+            if fn.endswith(".txt"):
+                ret.append(os.path.join(root, fn))
+    return sorted(ret)
+
+
+def collection_user_dirs(pages_dir):
+    """
+    Yield user dirs that are collections
+    """
+    for entry in sorted(os.scandir(pages_dir), key=lambda x: x.name):
+        if not entry.is_dir():
+            continue
+        start_page = os.path.join(entry.path, "start.txt")
+        if not os.path.exists(start_page):
+            continue
+        # Must be a user page
+        if "{{tag>collection}}" not in open(start_page, "r").read():
+            continue
+        yield entry.path
+
+
+def collection_pages(pages_dir):
+    """
+    Return sorted .txt pages under collection user dirs
+    """
+    ret = []
+    for user_dir in collection_user_dirs(pages_dir):
+        for root, _dirs, files in os.walk(user_dir):
+            for fn in files:
+                if fn.endswith(".txt"):
+                    ret.append(os.path.join(root, fn))
+    return sorted(ret)
+
+
+def map_pages(fn, pages, jobs=1, initializer=None, initargs=()):
+    """
+    Yield fn(page) for each page, see walk.ordered_map()
+    """
+    return walk.ordered_map(fn,
+                            pages,
+                            jobs=jobs,
+                            initializer=initializer,
+                            initargs=initargs)
+
+
+class LinkIndex:
+    """
+    Page path => {"mtime": ..., "size": ..., "links": [...], "tags": [...]}
+    reused while mtime / size match
+    Only a cache: safe to delete
+
+    Workers in another process can ship their new entries back with
+    take_new() / merge()
+    """
+    def __init__(self, fn=LINK_INDEX_FN):
+        self.fn = fn
+        self.pages = {}
+        self.new_pages = {}
+        self.pruned = False
+        if fn and os.path.exists(fn):
+            with open(fn, "r") as f:
+                j = json.load(f)
+            self.pages = j["pages"]
+
+    def get(self, page_fn):
+        st = os.stat(page_fn)
+        entry = self.pages.get(page_fn)
+        if not entry or entry["mtime"] != st.st_mtime or entry[
+                "size"] != st.st_size:
+            txt = open(page_fn, "r").read()
+            entry = {
+                "mtime": st.st_mtime,
+                "size": st.st_size,
+                "links": extract_links(txt),
+                "tags": extract_tags(txt),
+            }
+            self.pages[page_fn] = entry
+            self.new_pages[page_fn] = entry
+        return entry
+
+    def prune(self, page_fns):
+        """
+        Forget pages not in page_fns, ex: deleted or renamed
+        """
+        keep = set(page_fns)
+        for page_fn in list(self.pages):
+            if page_fn not in keep:
+                del self.pages[page_fn]
+                self.new_pages.pop(page_fn, None)
+                self.pruned = True
+
+    def links(self, page_fn):
+        return self.get(page_fn)["links"]
+
+    def tags(self, page_fn):
+        return self.get(page_fn)["tags"]
+
+    def take_new(self):
+        ret = self.new_pages
+        self.new_pages = {}
+        return ret
+
+    def merge(self, pages):
+        self.pages.update(pages)
+        self.new_pages.update(pages)
+
+    def save(self):
+        if not self.fn or not (self.new_pages or self.pruned):
+            return
+        os.makedirs(os.path.dirname(self.fn), exist_ok=True)
+        with open(self.fn + ".tmp", "w") as f:
+            json.dump({
+                "pages": self.pages,
+            }, f, sort_keys=True)
+        os.replace(self.fn + ".tmp", self.fn)
+        self.new_pages = {}
+        self.pruned = False
+
+
+class BacklinkIndex:
+    """
+    /map asset => wiki pages linking to it, grouped by vendor/chipid
+    ex: "intel/80502" => {"intel/80502/mz_mit5x/":
+        ["/var/www/archive/data/pages/mcmaster/intel/80502.txt"]}
+
+    Saved next to the LinkIndex. Each update only reindexes pages whose
+    mtime / size changed, lookups go straight to the chip
+    Only a cache: safe to delete
+    """
+    def __init__(self, link_index=None, fn=None):
+        if link_index is None:
+            link_index = LinkIndex()
+        self.link_index = link_index
+        if fn is None and link_index.fn:
+            fn = os.path.splitext(link_index.fn)[0] + "_backlinks.json"
+        self.fn = fn
+        # vendor/chipid => asset => set of pages
+        self.chips = {}
+        # page => {"mtime": ..., "size": ..., "assets": [...]}
+        self.page_assets = {}
+        self.dirty = False
+        if fn and os.path.exists(fn):
+            with open(fn, "r") as f:
+                j = json.load(f)
+            self.page_assets = j["pages"]
+            for chip, assets in j["chips"].items():
+                self.chips[chip] = dict(
+                    (asset, set(page_fns)) for asset, page_fns in assets.items())
+
+    def _remove(self, page_fn):
+        entry = self.page_assets.pop(page_fn)
+        for asset in entry["assets"]:
+            chip = chip_key(asset)
+            assets = self.chips[chip]
+            assets[asset].discard(page_fn)
+            if not assets[asset]:
+                del assets[asset]
+                if not assets:
+                    del self.chips[chip]
+        self.dirty = True
+
+    def _add(self, page_fn, link_entry):
+        assets = set()
+        for url in link_entry["links"]:
+            asset = map_asset(url)
+            if asset:
+                assets.add(asset)
+        for asset in assets:
+            self.chips.setdefault(chip_key(asset), {}).setdefault(
+                asset, set()).add(page_fn)
+        self.page_assets[page_fn] = {
+            "mtime": link_entry["mtime"],
+            "size": link_entry["size"],
+            "assets": sorted(assets),
+        }
+        self.dirty = True
+
+    def update(self, pages=None):
+        """
+        Refresh from pages (default: every wiki page)
+        """
+        if pages is None:
+            pages = all_pages()
+        for page_fn in pages:
+            link_entry = self.link_index.get(page_fn)
+            entry = self.page_assets.get(page_fn)
+            if entry and entry["mtime"] == link_entry["mtime"] and entry[
+                    "size"] == link_entry["size"]:
+                continue
+            if entry:
+                self._remove(page_fn)
+            self._add(page_fn, link_entry)
+        # Deleted or renamed
+        keep = set(pages)
+        for page_fn in list(self.page_assets):
+            if page_fn not in keep:
+                self._remove(page_fn)
+        self.link_index.prune(pages)
+        return self
+
+    def assets(self):
+        """
+        Yield (asset, sorted pages) for every linked asset, sorted
+        """
+        for chip in sorted(self.chips):
+            for asset, page_fns in sorted(self.chips[chip].items()):
+                yield asset, sorted(page_fns)
+
+    def pages(self, prefix):
+        """
+        Sorted pages linking to any asset starting with prefix
+        """
+        parts = prefix.split("/")
+        if len(parts) > 2:
+            # At least vendor/chipid/: just that chip
+            chips = [parts[0] + "/" + parts[1]]
+        else:
+            # ex: intel/ or intel/805
+            chips = [chip for chip in self.chips if chip.startswith(prefix)]
+        ret = set()
+        for chip in chips:
+            for asset, page_fns in self.chips.get(chip, {}).items():
+                if asset.startswith(prefix):
+                    ret |= page_fns
+        return sorted(ret)
+
+    def chip_pages(self, vendor, chipid):
+        ret = set()
+        for page_fns in self.chips.get(f"{vendor}/{chipid}", {}).values():
+            ret |= page_fns
+        return sorted(ret)
+
+    def save(self):
+        self.link_index.save()
+        if not self.fn or not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.fn), exist_ok=True)
+        with open(self.fn + ".tmp", "w") as f:
+            json.dump(
+                {
+                    "pages": self.page_assets,
+                    "chips": dict((chip, dict(
+                        (asset, sorted(page_fns))
+                        for asset, page_fns in assets.items()))
+                                  for chip, assets in self.chips.items()),
+                },
+                f,
+                sort_keys=True)
+        os.replace(self.fn + ".tmp", self.fn)
+        self.dirty = False
@@ -0,0 +1,597 @@
+#!/usr/bin/env python3
+"""
+siprawn library unit tests
+"""
+
+import errno
+import json
+import unittest
+from unittest import mock
+import os
+import shutil
+import tempfile
+from siprawn import events
+from siprawn import metadata
+from siprawn import walk
+from siprawn import viewer
+from siprawn import plan
+from siprawn import wiki
+from siprawn import rewrite
+from siprawn import tilepack
+from siprawn import dedup
+from siprawn import usage
+from siprawn import jpegopt
+import map_jpegopt
+import asset_rename
+from PIL import Image
+try:
+    import fixmap
+except ImportError:
+    # Needs prawnmap
+    fixmap = None
+
+
+def chip_names(records):
+    return [record.name for record in records]
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="siprawn_test_")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_events_cursor(self):
+        """
+        Consumers resume from where they left off
+        """
+        fn = os.path.join(self.tmp_dir, "lib/events.jsonl")
+        self.assertEqual(list(events.read(0, fn=fn)), [])
+        events.publish(events.MAP_COMPLETED, fn=fn, vendor="intel")
+        events.publish(events.PAGE_WRITTEN, fn=fn, vendor="atmel")
+        got = list(events.read(0, fn=fn))
+        self.assertEqual([e["vendor"] for e, _cursor in got],
+                         ["intel", "atmel"])
+        cursor = got[0][1]
+        got = list(events.read(cursor, fn=fn))
+        self.assertEqual([e["type"] for e, _cursor in got],
+                         [events.PAGE_WRITTEN])
+        self.assertEqual(got[-1][1], events.end_cursor(fn=fn))
+
+        # Partial line from a writer in progress isn't consumed
+        with open(fn, "a") as f:
+            f.write('{"type": "map_')
+        self.assertEqual(list(events.read(got[-1][1], fn=fn)), [])
+
+        # Corrupt lines are skipped and the cursor moves past them
+        with open(fn, "a") as f:
+            f.write('\n[1]\n')
+        events.publish(events.PAGE_WRITTEN, fn=fn, vendor="zilog")
+        got = list(events.read(got[-1][1], fn=fn))
+        self.assertEqual([e["vendor"] for e, _cursor in got], ["zilog"])
+        self.assertEqual(got[-1][1], events.end_cursor(fn=fn))
+
+    def test_meta_index_formats(self):
+        """
+        Every DB format gives the same lookups and duplicate detection
+        """
+        meta = {}
+        metadata.add_meta_map(meta,
+                              vendor="ad",
+                              chipid="adm213",
+                              collection="mcmaster",
+                              basename="mz_mit20x")
+        for _i in range(2):
+            metadata.add_meta_image(meta,
+                                    vendor="ad",
+                                    chipid="adm213",
+                                    collection="mcmaster",
+                                    dirname="single",
+                                    basename="mz_mit20x.jpg")
+        for ext in (".json", ".ndjson", ".db"):
+            fn = os.path.join(self.tmp_dir, "meta" + ext)
+            metadata.write_meta(meta, fn)
+            index = metadata.load_meta_index(fn)
+            self.assertEqual(len(index), 3)
+            got = index.get("ad", "adm213", "map", "mz_mit20x")
+            self.assertEqual(got["collection"], "mcmaster")
+            self.assertIsNone(index.get("ad", "adm213", "map", "mz_5x"))
+            with self.assertRaises(metadata.DuplicateEntry):
+                index.get("ad", "adm213", "image", "mz_mit20x.jpg")
+
+    def test_walk(self):
+        """
+        Typed records in a stable order, serial or parallel
+        """
+        map_dir = os.path.join(self.tmp_dir, "map")
+        for fn in ("intel/i8080/.manifest",
+                   "intel/i8080/single/intel_i8080_mcmaster_mz.jpg",
+                   "intel/i8080/mcmaster_mz/index.html",
+                   "atmel/at89c51/single/atmel_at89c51_mcmaster_mz.jpg"):
+            fn = os.path.join(map_dir, fn)
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            open(fn, "w").close()
+        self.assertEqual([(r.type, r.name) for r in walk.walk(map_dir)],
+                         [(walk.CHIP_DIR, "at89c51"),
+                          (walk.SINGLE_IMAGE, "atmel_at89c51_mcmaster_mz.jpg"),
+                          (walk.CHIP_DIR, "i8080"), (walk.MANIFEST, ".manifest"),
+                          (walk.SINGLE_IMAGE, "intel_i8080_mcmaster_mz.jpg"),
+                          (walk.MAP_DIR, "mcmaster_mz")])
+        serial = list(walk.map_chips(chip_names, map_dir=map_dir))
+        self.assertEqual(
+            list(walk.map_chips(chip_names, map_dir=map_dir, jobs=2)), serial)
+        self.assertEqual(
+            list(walk.map_chips(chip_names, map_dir=map_dir, vendor="intel")),
+            serial[1:])
+
+    def test_viewer_index(self):
+        """
+        Cached metadata is reused until the page changes
+        """
+        html_fn = os.path.join(self.tmp_dir, "index.html")
+        index_fn = os.path.join(self.tmp_dir, "viewer_index.json")
+        with open(html_fn, "w") as f:
+            f.write('<script>\n    initViewer({"name": "a", "layers": []});\n')
+        index = viewer.ViewerIndex(index_fn)
+        self.assertEqual(index.get(html_fn)["name"], "a")
+        index.save()
+
+        index = viewer.ViewerIndex(index_fn)
+        self.assertEqual(index.get(html_fn)["name"], "a")
+        self.assertEqual(index.take_new(), {})
+
+        with open(html_fn, "w") as f:
+            f.write("<html>custom page</html>\n")
+        with self.assertRaises(viewer.ViewerNotFound):
+            index.get(html_fn)
+
+    def test_plan_apply_undo(self):
+        """
+        Applying then undoing a plan restores the chip dir
+        """
+        chip_dir = os.path.join(self.tmp_dir, "map/intel/i8080")
+        os.makedirs(os.path.join(chip_dir, "single"))
+        for fn in ("single/intel_i8080_mz.jpg", "single/intel_i8080_mz.thumb.jpg"):
+            open(os.path.join(chip_dir, fn), "w").close()
+        chip = plan.ChipPlan("intel", "i8080", chip_dir)
+        chip.move("single/intel_i8080_mz.jpg",
+                  "single/intel_i8080_unknown_mz.jpg")
+        chip.remove("single/intel_i8080_mz.thumb.jpg")
+        chip.manifest_add("single/intel_i8080_unknown_mz.jpg",
+                          collection="unknown",
+                          type_="image")
+        plan_fn = os.path.join(self.tmp_dir, "plan.json")
+        plan.save_plan(plan_fn, [chip], "test")
+        journal_dir = plan.default_journal_dir(plan_fn)
+
+        self.assertEqual(plan.apply_plan(plan.load_plan(plan_fn), journal_dir),
+                         0)
+        self.assertEqual(sorted(os.listdir(os.path.join(chip_dir, "single"))),
+                         ["intel_i8080_unknown_mz.jpg"])
+        self.assertTrue(os.path.exists(os.path.join(chip_dir, ".manifest")))
+        # Failures are counted, not raised
+        self.assertEqual(
+            plan.apply_plan(plan.load_plan(plan_fn), journal_dir, jobs=2), 1)
+
+        self.assertEqual(plan.undo_plan(journal_dir, jobs=2), 0)
+        self.assertEqual(sorted(os.listdir(os.path.join(chip_dir, "single"))),
+                         ["intel_i8080_mz.jpg", "intel_i8080_mz.thumb.jpg"])
+        self.assertFalse(os.path.exists(os.path.join(chip_dir, ".manifest")))
+
+    def test_plan_identity_move(self):
+        """
+        Renaming something to the name it already has (ex: a rerun) is fine
+        """
+        chip_dir = os.path.join(self.tmp_dir, "map/intel/i8080")
+        os.makedirs(os.path.join(chip_dir, "single"))
+        fn = "single/intel_i8080_mcmaster_mz.jpg"
+        open(os.path.join(chip_dir, fn), "w").close()
+        chip = plan.ChipPlan("intel", "i8080", chip_dir)
+        chip.move(fn, fn)
+        self.assertEqual(chip.moves, [])
+        # Plans written before identity moves were dropped
+        chip.moves.append((fn, fn))
+        chip.manifest_add(fn, collection="mcmaster", type_="image")
+        journal_dir = os.path.join(self.tmp_dir, "journal")
+        self.assertEqual(plan.apply_plan([chip], journal_dir), 0)
+        self.assertTrue(os.path.exists(os.path.join(chip_dir, fn)))
+        self.assertTrue(os.path.exists(os.path.join(chip_dir, ".manifest")))
+
+    @unittest.skipIf(fixmap is None, "prawnmap not installed")
+    def test_fixmap_image_size(self):
+        """
+        Smallest power of 2 tiles square covering the image
+        """
+        self.assertEqual(fixmap.groupxiv_image_size(30811, 30989), 32000)
+        self.assertEqual(fixmap.groupxiv_image_size(100, 100), 250)
+        self.assertEqual(fixmap.groupxiv_image_size(250, 10), 250)
+        self.assertEqual(fixmap.groupxiv_image_size(10, 251), 500)
+        self.assertEqual(fixmap.groupxiv_image_size(1000, 1000), 1000)
+        self.assertEqual(fixmap.groupxiv_image_size(1001, 1000), 2000)
+        self.assertEqual(
+            fixmap.groupxiv_image_size(1000, 1000, tile_size=256), 1024)
+
+    @unittest.skipIf(fixmap is None, "prawnmap not installed")
+    def test_fixmap_report_apply(self):
+        """
+        Mismatches are reported, applied with a journal, then gone
+        """
+        map_dir = os.path.join(self.tmp_dir, "map")
+        chip_dir = os.path.join(map_dir, "intel/i8080")
+        os.makedirs(os.path.join(chip_dir, "single"))
+        for flavor, layer in (("mz", {
+                "imageSize": 4096,
+                "width": 31000,
+                "height": 31000
+        }), ("ok", {
+                "imageSize": 1000,
+                "width": 600,
+                "height": 300
+        })):
+            Image.new("RGB", (600, 300)).save(
+                os.path.join(chip_dir,
+                             "single/intel_i8080_mcmaster_%s.jpg" % flavor))
+            layer.update({"URL": "l1", "tileSize": 250, "name": flavor})
+            os.makedirs(os.path.join(chip_dir, "mcmaster_" + flavor))
+            with open(
+                    os.path.join(chip_dir, "mcmaster_" + flavor,
+                                 "index.html"), "w") as f:
+                f.write("initViewer(%s);\n" % json.dumps({
+                    "name": flavor,
+                    "layers": [layer]
+                }))
+        report_fn = os.path.join(self.tmp_dir, "fixmap.json")
+        index_fn = os.path.join(self.tmp_dir, "viewer_index.json")
+
+        def run_all(apply):
+            return fixmap.run_all(report_fn,
+                                  apply=apply,
+                                  map_dir=map_dir,
+                                  viewer_index_fn=index_fn)
+
+        j = run_all(False)
+        self.assertEqual(j["errors"], [])
+        self.assertEqual([x["map"] for x in j["mismatches"]], ["mcmaster_mz"])
+        self.assertEqual(
+            j["mismatches"][0]["diffs"], {
+                "layers[0].imageSize": [4096, 1000],
+                "layers[0].width": [31000, 600],
+                "layers[0].height": [31000, 300],
+            })
+        self.assertEqual(json.load(open(report_fn)), j)
+        self.assertFalse(os.path.exists(fixmap.journal_fn(report_fn)))
+
+        j = run_all(True)
+        self.assertTrue(j["mismatches"][0]["applied"])
+        html_fn = os.path.join(chip_dir, "mcmaster_mz/index.html")
+        self.assertEqual(
+            viewer.read_viewer_meta(html_fn)["layers"][0]["imageSize"], 1000)
+        self.assertEqual(sorted(os.listdir(os.path.dirname(html_fn))),
+                         ["index.html"])
+        with open(fixmap.journal_fn(report_fn)) as f:
+            journal = [json.loads(l) for l in f]
+        self.assertEqual([x["old"]["layers"][0]["imageSize"] for x in journal],
+                         [4096])
+
+        self.assertEqual(run_all(False)["mismatches"], [])
+
+    def test_backlink_index(self):
+        """
+        Pages linking to a chip are found and follow page edits
+        """
+        pages_dir = os.path.join(self.tmp_dir, "pages")
+        a_fn = os.path.join(pages_dir, "mcmaster/intel/80502.txt")
+        b_fn = os.path.join(pages_dir, "notes.txt")
+        os.makedirs(os.path.dirname(a_fn))
+        with open(a_fn, "w") as f:
+            f.write("[[https://siliconprawn.org/map/intel/80502/mz/|mz]]\n")
+        with open(b_fn, "w") as f:
+            f.write("see https://siliconpr0n.org/map/intel/80502\n")
+        index_fn = os.path.join(self.tmp_dir, "link_index.json")
+        backlinks = wiki.BacklinkIndex(wiki.LinkIndex(index_fn))
+        backlinks.update(wiki.all_pages(pages_dir))
+        self.assertEqual(backlinks.chip_pages("intel", "80502"), [a_fn, b_fn])
+        self.assertEqual(backlinks.pages("intel/80502/mz/"), [a_fn])
+        self.assertEqual(backlinks.chip_pages("intel", "8050"), [])
+        self.assertEqual(backlinks.pages("intel/805"), [a_fn, b_fn])
+        backlinks.save()
+
+        # Lookups work straight from the saved index
+        backlinks = wiki.BacklinkIndex(wiki.LinkIndex(index_fn))
+        self.assertEqual(backlinks.chip_pages("intel", "80502"), [a_fn, b_fn])
+
+        os.unlink(b_fn)
+        with open(a_fn, "a") as f:
+            f.write("[[https://siliconprawn.org/map/intel/8080/|8080]]\n")
+        backlinks.update(wiki.all_pages(pages_dir))
+        self.assertEqual(backlinks.chip_pages("intel", "80502"), [a_fn])
+        self.assertEqual(backlinks.chip_pages("intel", "8080"), [a_fn])
+        self.assertEqual(list(backlinks.link_index.pages), [a_fn])
+        self.assertEqual(list(backlinks.assets()),
+                         [("intel/80502/mz/", [a_fn]), ("intel/8080/", [a_fn])])
+        backlinks.save()
+        backlinks = wiki.BacklinkIndex(wiki.LinkIndex(index_fn))
+        self.assertEqual(sorted(backlinks.chips), ["intel/80502", "intel/8080"])
+
+    def test_rewrite(self):
+        """
+        All patterns in one pass, longest match first, no rescanning
+        """
+        rewriter = rewrite.Rewriter({
+            "/intel/a/": "/intel/a/mcmaster_",
+            "/intel/a/single/intel_a_": "/intel/a/single/intel_a_mcmaster_",
+            "a:b": "b:c",
+            "b:c": "c:d",
+            "same": "same",
+        })
+        txt = ("[[https://siliconprawn.org/map/intel/a/|mz]]\n"
+               "https://siliconprawn.org/map/intel/a/single/intel_a_mz.jpg\n"
+               "{{:a:b:x.jpg}}\n")
+        new, counts = rewriter.apply(txt)
+        self.assertEqual(
+            new, "[[https://siliconprawn.org/map/intel/a/mcmaster_|mz]]\n"
+            "https://siliconprawn.org/map/intel/a/single/intel_a_mcmaster_mz.jpg\n"
+            "{{:b:c:x.jpg}}\n")
+        self.assertEqual(rewriter.missing(counts), ["b:c"])
+
+        fn = os.path.join(self.tmp_dir, "page.txt")
+        with open(fn, "w") as f:
+            f.write(txt)
+        self.assertEqual(rewrite.rewrite_pages([fn], rewriter.mapping), (1, 3))
+        self.assertEqual(open(fn).read(), txt)
+        self.assertEqual(
+            rewrite.rewrite_pages([fn], rewriter.mapping, dry=False, jobs=2),
+            (1, 3))
+        self.assertEqual(open(fn).read(), new)
+
+    def test_rename_own_page(self):
+        """
+        Media IDs and the vendor tag of chips sharing a prefix are left alone
+        """
+        rewriter = asset_rename.rename_rewriter("foo", "8080", "bar", "i8080")
+        txt = ("{{:mcmaster:foo:8080:pack_top.jpg?300|}}\n"
+               "{{:mcmaster:foo:8080a:pack_top.jpg?300|}}\n"
+               "https://siliconprawn.org/map/foo/8080/single/foo_8080_mz.jpg\n"
+               "https://siliconprawn.org/map/foo/8080a/single/foo_8080a_mz.jpg\n"
+               "{{tag>vendor_foo vendor_foobar vendor_foo-bar}}\n"
+               "{{tag>vendor_foo}}\n")
+        new, _counts = rewriter.apply(txt)
+        self.assertEqual(
+            new, "{{:mcmaster:bar:i8080:pack_top.jpg?300|}}\n"
+            "{{:mcmaster:foo:8080a:pack_top.jpg?300|}}\n"
+            "https://siliconprawn.org/map/bar/i8080/single/bar_i8080_mz.jpg\n"
+            "https://siliconprawn.org/map/foo/8080a/single/foo_8080a_mz.jpg\n"
+            "{{tag>vendor_bar vendor_foobar vendor_foo-bar}}\n"
+            "{{tag>vendor_bar}}\n")
+
+    def test_tilepack(self):
+        """
+        Pack then unpack gives back the same tiles
+        """
+        map_dir = os.path.join(self.tmp_dir, "mcmaster_mz")
+        tiles = {"0/0_0.jpg": b"a", "1/0_0.jpg": b"bb", "1/1_0.jpg": b""}
+        for fn, buf in tiles.items():
+            fn = os.path.join(map_dir, "l1", fn)
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            with open(fn, "wb") as f:
+                f.write(buf)
+        with open(os.path.join(map_dir, "index.html"), "w") as f:
+            f.write('initViewer({"layers": [{"URL": "l1"}]});\n')
+
+        self.assertEqual(tilepack.pack_map(map_dir), (3, 3))
+        self.assertTrue(tilepack.is_packed(map_dir))
+        self.assertEqual(sorted(os.listdir(os.path.join(map_dir, "l1"))),
+                         ["0.pack", "1.pack"])
+        packs = tilepack.PackCache()
+        for fn, buf in tiles.items():
+            self.assertEqual(
+                packs.read_tile(os.path.join(map_dir, "l1", fn)), buf)
+        self.assertIsNone(
+            packs.read_tile(os.path.join(map_dir, "l1/1/5_5.jpg")))
+
+        self.assertEqual(tilepack.unpack_map(map_dir), 3)
+        self.assertFalse(tilepack.is_packed(map_dir))
+        for fn, buf in tiles.items():
+            self.assertEqual(
+                open(os.path.join(map_dir, "l1", fn), "rb").read(), buf)
+
+    def test_dedup(self):
+        """
+        Identical tiles end up as one inode, reruns find nothing new
+        """
+        map_dirs = []
+        for name in ("mcmaster_mz", "mcmaster_mit20x"):
+            map_dir = os.path.join(self.tmp_dir, name)
+            for fn, buf in (("0/0_0.jpg", b"black"), ("1/0_0.jpg", b"black"),
+                            ("1/1_0.jpg", b"die"), ("1/1_1.jpg", b"diE")):
+                fn = os.path.join(map_dir, "l1", fn)
+                os.makedirs(os.path.dirname(fn), exist_ok=True)
+                with open(fn, "wb") as f:
+                    f.write(buf)
+            with open(os.path.join(map_dir, "index.html"), "w") as f:
+                f.write('initViewer({"layers": [{"URL": "l1"}]});\n')
+            map_dirs.append(map_dir)
+
+        stats = dedup.dedup_map(map_dirs[0], dry=True)
+        self.assertEqual(stats, {
+            "tiles": 4,
+            "duplicates": 1,
+            "bytes": 5,
+            "inodes": 1,
+            "link_limit": 0,
+            "errors": 0
+        })
+        stats = dedup.dedup_map(map_dirs[0])
+        self.assertEqual(stats["duplicates"], 1)
+        self.assertEqual(dedup.dedup_map(map_dirs[0])["duplicates"], 0)
+        st = os.stat(os.path.join(map_dirs[0], "l1/1/0_0.jpg"))
+        self.assertEqual(st.st_nlink, 2)
+
+        stats = dedup.dedup_maps(map_dirs)
+        self.assertEqual((stats["duplicates"], stats["inodes"]), (4, 4))
+        self.assertEqual(dedup.dedup_maps(map_dirs)["duplicates"], 0)
+        self.assertEqual(
+            open(os.path.join(map_dirs[1], "l1/1/1_1.jpg"), "rb").read(),
+            b"diE")
+
+        # Custom page without a viewer is skipped, not fatal
+        custom_dir = os.path.join(self.tmp_dir, "mcmaster_custom")
+        os.makedirs(custom_dir)
+        with open(os.path.join(custom_dir, "index.html"), "w") as f:
+            f.write("<html>custom</html>\n")
+        stats = dedup.dedup_maps([custom_dir] + map_dirs)
+        self.assertEqual((stats["tiles"], stats["errors"]), (8, 1))
+
+    def test_dedup_link_limit(self):
+        """
+        Hitting the hardlink limit starts a new copy instead of aborting
+        """
+        fns = []
+        for i in range(5):
+            fn = os.path.join(self.tmp_dir, "%u_0.jpg" % i)
+            with open(fn, "wb") as f:
+                f.write(b"black")
+            fns.append(fn)
+        os_link = os.link
+
+        # Pretend the filesystem allows 2 links per file
+        def link(src, dst):
+            if os.stat(src).st_nlink >= 2:
+                raise OSError(errno.EMLINK, os.strerror(errno.EMLINK))
+            os_link(src, dst)
+
+        with mock.patch("os.link", side_effect=link):
+            stats = dedup.dedup_files(fns)
+        self.assertEqual((stats["duplicates"], stats["link_limit"]), (2, 2))
+        self.assertEqual(sorted(os.stat(fn).st_nlink for fn in fns),
+                         [1, 2, 2, 2, 2])
+        for fn in fns:
+            self.assertEqual(open(fn, "rb").read(), b"black")
+
+    @unittest.skipUnless(shutil.which(jpegopt.JPEGTRAN), "needs jpegtran")
+    def test_jpegopt(self):
+        """
+        Tiles shrink, hardlinks stay, shared tiles are left alone, resumes
+        """
+        map_dirs = []
+        for name in ("mcmaster_mz", "mcmaster_mit20x"):
+            map_dir = os.path.join(self.tmp_dir, name)
+            for i, fn in enumerate(("0/0_0.jpg", "1/0_0.jpg", "1/1_0.jpg")):
+                fn = os.path.join(map_dir, "l1", fn)
+                os.makedirs(os.path.dirname(fn), exist_ok=True)
+                Image.effect_noise((64, 64), 20 + i).convert("RGB").save(
+                    fn, quality=90, optimize=False)
+            with open(os.path.join(map_dir, "index.html"), "w") as f:
+                f.write('initViewer({"layers": [{"URL": "l1"}]});\n')
+            map_dirs.append(map_dir)
+        mz, mit = map_dirs
+        # Same tile in both maps
+        pair = [os.path.join(x, "l1/1/1_0.jpg") for x in map_dirs]
+        dedup.link_over(pair[0], pair[1])
+        # Tile also used by something not being processed
+        shared_fn = os.path.join(mz, "l1/1/0_0.jpg")
+        outside_fn = os.path.join(self.tmp_dir, "outside.jpg")
+        os.link(shared_fn, outside_fn)
+        shared_buf = open(shared_fn, "rb").read()
+        pair_size = os.path.getsize(pair[0])
+
+        stats = jpegopt.optimize_maps(map_dirs, dry=True)
+        self.assertEqual(stats[mz]["optimized"], 2)
+        self.assertEqual(os.path.getsize(pair[0]), pair_size)
+
+        state_fn = os.path.join(self.tmp_dir, "jpegopt.jsonl")
+        map_jpegopt.load_done(state_fn)
+        records = map_jpegopt.run_maps(map_dirs, dry=False, state_fn=state_fn)
+        got = dict((j["map"], j) for j in records)
+        self.assertEqual(
+            (got[mz]["files"], got[mz]["optimized"], got[mz]["shared"]),
+            (3, 2, 1))
+        self.assertEqual((got[mit]["optimized"], got[mit]["errors"]), (2, 0))
+        self.assertLess(os.path.getsize(pair[0]), pair_size)
+        self.assertTrue(os.path.samefile(pair[0], pair[1]))
+        self.assertEqual(os.stat(pair[0]).st_nlink, 2)
+        self.assertTrue(os.path.samefile(shared_fn, outside_fn))
+        self.assertEqual(open(shared_fn, "rb").read(), shared_buf)
+        self.assertEqual(sorted(os.listdir(os.path.join(mz, "l1/1"))),
+                         ["0_0.jpg", "1_0.jpg"])
+
+        self.assertEqual(sorted(map_jpegopt.load_state(state_fn)),
+                         sorted(map_dirs))
+        map_jpegopt.load_done(state_fn)
+        self.assertEqual(
+            map_jpegopt.run_maps(map_dirs, dry=False, state_fn=state_fn), [])
+
+    def test_jpegopt_bad_map(self):
+        """
+        A map without a viewer is an error, retried on the next run
+        """
+        map_dir = os.path.join(self.tmp_dir, "mcmaster_custom")
+        os.makedirs(map_dir)
+        with open(os.path.join(map_dir, "index.html"), "w") as f:
+            f.write("<html>custom</html>\n")
+        state_fn = os.path.join(self.tmp_dir, "jpegopt.jsonl")
+        map_jpegopt.load_done(state_fn)
+        records = map_jpegopt.run_maps([map_dir], dry=False, state_fn=state_fn)
+        self.assertEqual([(j["map"], j["errors"]) for j in records],
+                         [(map_dir, 1)])
+        self.assertEqual(map_jpegopt.load_state(state_fn), {})
+
+    def test_usage(self):
+        """
+        Reconcile finds new / changed / gone assets, totals group up
+        """
+        map_dir = os.path.join(self.tmp_dir, "map")
+        media_root = os.path.join(self.tmp_dir, "media")
+        usage_fn = os.path.join(self.tmp_dir, "usage.db")
+        for fn in ("intel/i8080/single/intel_i8080_mcmaster_mz.jpg",
+                   "intel/i8080/mcmaster_mz/index.html",
+                   "intel/i8080/mcmaster_mz/l1/0/0_0.jpg",
+                   "atmel/at89c51/single/atmel_at89c51_bob_mz.jpg"):
+            fn = os.path.join(map_dir, fn)
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            with open(fn, "w") as f:
+                f.write("x" * 5000)
+        fn = os.path.join(media_root, "mcmaster/intel/i8080/pack_top.jpg")
+        os.makedirs(os.path.dirname(fn))
+        with open(fn, "w") as f:
+            f.write("x")
+
+        def reconcile():
+            return usage.reconcile(fn=usage_fn,
+                                   map_dir=map_dir,
+                                   media_root=media_root)
+
+        self.assertEqual(reconcile(), 4)
+        self.assertEqual(reconcile(), 0)
+        got = dict((x[0], x[2]) for x in usage.summary(fn=usage_fn))
+        self.assertEqual(got, {"mcmaster": 4, "bob": 1})
+        got = [x[:2] for x in usage.summary("chip", fn=usage_fn)]
+        self.assertEqual(got, [("intel", "i8080"), ("atmel", "at89c51")])
+        over = usage.over_quota({"bob": 1, "mcmaster": 1 << 30},
+                                fn=usage_fn)
+        self.assertEqual([x[0] for x in over], ["bob"])
+
+        shutil.rmtree(os.path.join(map_dir, "atmel"))
+        self.assertEqual(reconcile(), 1)
+        self.assertEqual([x[0] for x in usage.summary(fn=usage_fn)],
+                         ["mcmaster"])
+
+        # Tile hardlinked into another map of the collection counts once
+        total = usage.summary(fn=usage_fn)[0][1]
+        tile_fn = os.path.join(map_dir, "intel/i8080/mcmaster_mz/l1/0/0_0.jpg")
+        link_fn = os.path.join(map_dir,
+                               "intel/i8080/mcmaster_mit20x/l1/0/0_0.jpg")
+        os.makedirs(os.path.dirname(link_fn))
+        os.link(tile_fn, link_fn)
+        index_fn = os.path.join(os.path.dirname(link_fn), "../../index.html")
+        with open(index_fn, "w") as f:
+            f.write("x")
+        # New map, and whichever map comes second now shares its tile
+        self.assertEqual(reconcile(), 2)
+        self.assertEqual(usage.summary(fn=usage_fn)[0][1:],
+                         (total + usage.du(index_fn)[0], 6))
+
+
+if __name__ == "__main__":
+    unittest.main()  # run all tests
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Serve /map tiles from packed maps (see siprawn.tilepack)
+
+Regular files are served as is so this can sit in front of the whole
+/map tree, or only handle requests the web server couldn't find:
+
+nginx:
+    location /map/ { try_files $uri @tiles; }
+    location @tiles { proxy_pass http://127.0.0.1:8081; }
+
+Also a WSGI app (application) for mod_wsgi and friends
+"""
+
+import mimetypes
+import os
+from siprawn import env
+from siprawn import tilepack
+
+# Cached per process
+g_packs = tilepack.PackCache()
+g_map_dir = None
+
+
+def map_dir():
+    global g_map_dir
+    if g_map_dir is None:
+        env.setup_env_default()
+        g_map_dir = env.MAP_DIR
+    return g_map_dir
+
+
+def local_fn(path, root):
+    """
+    /map/intel/80502/mz/l1/3/2_5.jpg => <root>/intel/80502/mz/l1/3/2_5.jpg
+    None if outside of root
+    """
+    if path.startswith("/map/"):
+        path = path[len("/map"):]
+    fn = os.path.normpath(os.path.join(root, path.lstrip("/")))
+    if not fn.startswith(os.path.normpath(root) + os.sep):
+        return None
+    return fn
+
+
+def application(environ, start_response):
+    fn = local_fn(environ.get("PATH_INFO", ""), map_dir())
+    buf = None
+    if fn and os.path.isfile(fn):
+        with open(fn, "rb") as f:
+            buf = f.read()
+    elif fn:
+        buf = g_packs.read_tile(fn)
+    if buf is None:
+        start_response("404 Not Found", [("Content-Type", "text/plain")])
+        return [b"Not found\n"]
+    content_type = mimetypes.guess_type(fn)[0] or "application/octet-stream"
+    start_response("200 OK", [("Content-Type", content_type),
+                              ("Content-Length", str(len(buf))),
+                              ("Cache-Control", "public, max-age=86400")])
+    return [buf]
+
+
+def main():
+    import argparse
+    from wsgiref.simple_server import make_server
+
+    global g_map_dir
+
+    parser = argparse.ArgumentParser(description="Serve packed map tiles")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--map-dir", help="Default: env.MAP_DIR")
+    args = parser.parse_args()
+    if args.map_dir:
+        g_map_dir = args.map_dir
+    print("Serving %s on %s:%u" % (map_dir(), args.host, args.port))
+    make_server(args.host, args.port, application).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Which wiki pages link to a /map asset
+
+wiki_backlinks.py intel/80502/
+wiki_backlinks.py --check
+    report links to /map assets that don't exist
+"""
+
+import os
+from siprawn import env
+from siprawn import wiki
+
+
+def broken_links(backlinks, map_dir):
+    """
+    Yield (asset, pages) for linked assets missing from map_dir
+    """
+    for asset, page_fns in backlinks.assets():
+        if not os.path.exists(os.path.join(map_dir, asset.rstrip("/"))):
+            yield asset, page_fns
+
+
+def run(prefix=None, check=False, link_index_fn=wiki.LINK_INDEX_FN):
+    env.setup_env_default()
+
+    backlinks = wiki.BacklinkIndex(wiki.LinkIndex(link_index_fn)).update()
+    backlinks.save()
+    print("Linked assets: %u" % sum(1 for _x in backlinks.assets()))
+    if prefix:
+        page_fns = backlinks.pages(prefix)
+        print("Pages linking to %s: %u" % (prefix, len(page_fns)))
+        for page_fn in page_fns:
+            print("  " + page_fn)
+    if check:
+        nbroken = 0
+        for asset, page_fns in broken_links(backlinks, env.MAP_DIR):
+            nbroken += 1
+            print("Broken: %s" % asset)
+            for page_fn in page_fns:
+                print("  " + page_fn)
+        print("Broken assets: %u" % nbroken)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Find wiki pages linking to /map assets")
+    parser.add_argument("--check",
+                        action="store_true",
+                        help="Report links to missing assets")
+    parser.add_argument("--link-index",
+                        default=wiki.LINK_INDEX_FN,
+                        help="Cache of links found on each page")
+    parser.add_argument("prefix",
+                        nargs="?",
+                        help="Asset path under /map, ex: intel/80502/")
+    args = parser.parse_args()
+    run(prefix=args.prefix, check=args.check, link_index_fn=args.link_index)
+
+
+if __name__ == "__main__":
+    main()
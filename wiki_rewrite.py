@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Apply a find / replace mapping to every wiki page in one pass per page
+
+mapping.json:
+{
+    "siliconprawn.org/map/intel/80c186/": "siliconprawn.org/map/intel/80c186/mcmaster_",
+    "single/intel_80c186_": "single/intel_80c186_mcmaster_"
+}
+"""
+
+import json
+from siprawn import util
+from siprawn import wiki
+from siprawn import rewrite
+
+
+def run(mapping_fn, pages_dir=None, dry=True, jobs=1):
+    with open(mapping_fn, "r") as f:
+        mapping = json.load(f)
+    pages = wiki.all_pages(pages_dir)
+    print("Patterns: %u" % len(mapping))
+    print("Pages: %u" % len(pages))
+    npages, nreplacements = rewrite.rewrite_pages(pages,
+                                                  mapping,
+                                                  dry=dry,
+                                                  jobs=jobs)
+    print("Changed pages: %u" % npages)
+    print("Replacements: %u" % nreplacements)
+    if dry:
+        print("dry: nothing written")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Bulk rewrite wiki page text from a JSON mapping")
+    util.add_bool_arg(parser, "--dry", default=True)
+    parser.add_argument("--jobs",
+                        type=int,
+                        default=1,
+                        help="Pages to process in parallel")
+    parser.add_argument("--pages-dir",
+                        help="Default: archive/data/pages")
+    parser.add_argument("mapping", help="JSON object of old => new text")
+    args = parser.parse_args()
+    run(args.mapping, pages_dir=args.pages_dir, dry=args.dry, jobs=args.jobs)
+
+
+if __name__ == "__main__":
+    main()